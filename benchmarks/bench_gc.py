@@ -0,0 +1,126 @@
+"""
+Benchmark one full GC cycle of the cleaner against a fake docker daemon
+
+The daemon (fake_docker.py) simulates many images sharing base layers,
+with configurable latencies. The cleaner runs in docker threshold mode,
+so usage comes from the fake /system/df and goes down as images are deleted.
+The high threshold is set below the initial usage, so one GC cycle runs.
+
+Usage (with docker-image-cleaner installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_gc.py --images 2000 --policy prune layers
+
+Results are written as JSON lines, see results.py.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from unittest import mock
+
+import fake_docker
+from results import Results
+
+from docker_image_cleaner import cleaner
+
+
+class CycleDone(Exception):
+    """Raised instead of sleeping after the GC cycle"""
+
+
+def _stop(scheduler, wake=None):
+    raise CycleDone()
+
+
+def run_gc_cycle(
+    docker, policy, high=0.5, low=0.4, env=None, sleep=_stop, layerdb=False
+):
+    """
+    Run one GC cycle against `docker`, a fake_docker.FakeDocker
+
+    Thresholds are fractions of the initial usage, images and build cache.
+    `sleep` replaces cleaner.sleep_until_next_check, and raises CycleDone
+    to stop, after the first cycle by default.
+    With `layerdb`, layer sizes can be read from the layer database,
+    as in absolute mode, instead of estimated from image sizes.
+
+    Returns (seconds, stats).
+    """
+    usage = docker.layers_size() + docker.build_cache_size()
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, "docker.sock")
+        server = fake_docker.serve(socket_path, docker)
+        if layerdb:
+            docker.write_layerdb(tmp)
+        try:
+            environ = {
+                "DOCKER_HOST": f"unix://{socket_path}",
+                "DOCKER_IMAGE_CLEANER_PATH_TO_CHECK": tmp,
+                "DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE": "docker",
+                "DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH": str(int(usage * high)),
+                "DOCKER_IMAGE_CLEANER_THRESHOLD_LOW": str(int(usage * low)),
+                "DOCKER_IMAGE_CLEANER_POLICY": policy,
+                "DOCKER_IMAGE_CLEANER_DELAY_SECONDS": "0",
+                **(env or {}),
+            }
+            images_before = len(docker.images)
+            with mock.patch.dict(os.environ, environ), mock.patch.object(
+                cleaner, "sleep_until_next_check", sleep
+            ):
+                tic = time.perf_counter()
+                try:
+                    cleaner.main()
+                except CycleDone:
+                    pass
+                seconds = time.perf_counter() - tic
+        finally:
+            fake_docker.stop(server)
+    stats = {
+        "images_before": images_before,
+        "images_deleted": images_before - len(docker.images),
+        "bytes_before": usage,
+        "bytes_after": docker.layers_size() + docker.build_cache_size(),
+        "build_cache_bytes_after": docker.build_cache_size(),
+        "requests": docker.requests,
+    }
+    return seconds, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--policy", nargs="+", default=["prune", "lru", "layers"])
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument("--prune-latency", type=float, default=0.001)
+    parser.add_argument("--remove-latency", type=float, default=0.01)
+    parser.add_argument("--output", help="file to append JSON lines to")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = Results(args.output)
+    for n_images in args.images:
+        for policy in args.policy:
+            docker = fake_docker.FakeDocker(
+                images=n_images,
+                latency=args.latency,
+                prune_latency=args.prune_latency,
+                remove_latency=args.remove_latency,
+            )
+            seconds, stats = run_gc_cycle(docker, policy)
+            results.record(
+                "gc_cycle",
+                {
+                    "images": n_images,
+                    "policy": policy,
+                    "latency": args.latency,
+                    "prune_latency": args.prune_latency,
+                    "remove_latency": args.remove_latency,
+                },
+                seconds,
+                **stats,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark measuring disk usage of synthetic docker trees
+
+Times, for trees of several sizes:
+
+- the previous os.walk-based implementation of get_absolute_size
+- get_absolute_size at various numbers of workers
+- get_absolute_size with a warm layer size cache
+- get_absolute_size estimating from a sample, far from the threshold
+- get_used_percent
+
+Usage (with docker-image-cleaner installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_scan.py --layers 100 500
+
+Results are written as JSON lines, see results.py.
+Results depend heavily on the page cache: the tree is in cache
+right after generating it. Drop caches
+(`echo 3 > /proc/sys/vm/drop_caches`) between runs
+to measure cold scans, as on a real node.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from results import Results
+from synthetic import make_docker_tree
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.layer_cache import LayerSizeCache
+
+
+def walk_size(path):
+    """The os.walk-based size computation used before the scanner"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            f = os.path.join(dirpath, fname)
+            if os.path.isfile(f):
+                total += os.path.getsize(f)
+    return total
+
+
+def timeit(f, repeat):
+    """Return the best of `repeat` runs of f() and its result"""
+    best = None
+    for i in range(repeat):
+        tic = time.perf_counter()
+        result = f()
+        duration = time.perf_counter() - tic
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--layers", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--dirs-per-layer", type=int, default=10)
+    parser.add_argument("--files-per-dir", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--max-error", type=float, nargs="+", default=[0.05, 0.2])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="file to append JSON lines to")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = Results(args.output)
+    for layers in args.layers:
+        with tempfile.TemporaryDirectory() as root:
+            expected = make_docker_tree(
+                root,
+                layers=layers,
+                dirs_per_layer=args.dirs_per_layer,
+                files_per_dir=args.files_per_dir,
+            )
+            params = {
+                "layers": layers,
+                "files": layers * args.dirs_per_layer * args.files_per_dir,
+            }
+
+            seconds, _ = timeit(lambda: walk_size(root), args.repeat)
+            results.record("os_walk", params, seconds)
+
+            for workers in args.workers:
+                seconds, size = timeit(
+                    lambda: cleaner.get_absolute_size(root, workers=workers),
+                    args.repeat,
+                )
+                assert size * cleaner.GB == expected, f"{size} != {expected}"
+                results.record(
+                    "get_absolute_size", dict(params, workers=workers), seconds
+                )
+
+            cache = LayerSizeCache(root)
+            # warm up the cache
+            cleaner.get_absolute_size(root, cache=cache)
+            seconds, size = timeit(
+                lambda: cleaner.get_absolute_size(root, cache=cache), args.repeat
+            )
+            # hard links between layers are counted in each layer when cached
+            assert size * cleaner.GB >= expected, f"{size} < {expected}"
+            results.record("get_absolute_size_cached", params, seconds)
+
+            for max_error in args.max_error:
+                seconds, size = timeit(
+                    lambda: cleaner.get_absolute_size(
+                        root,
+                        workers=4,
+                        threshold=2 * expected,
+                        max_error=max_error,
+                    ),
+                    args.repeat,
+                )
+                results.record(
+                    "get_absolute_size_estimated",
+                    dict(params, max_error=max_error),
+                    seconds,
+                    error=size * cleaner.GB / expected - 1,
+                )
+
+            seconds, _ = timeit(lambda: cleaner.get_used_percent(root), args.repeat)
+            results.record("get_used_percent", params, seconds)
+
+
+if __name__ == "__main__":
+    main()
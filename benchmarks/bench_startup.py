@@ -0,0 +1,121 @@
+"""
+Benchmark the startup time and memory of the cleaner's kubernetes clients
+
+The cleaner runs on every node, so its startup time and idle memory
+are multiplied by the number of nodes. For each client
+(DOCKER_IMAGE_CLEANER_KUBE_CLIENT), a new Python process imports the cleaner,
+creates the client, reads its node and lists the pods on it, like main()
+does at startup, against a fake API server (fake_kube.py).
+It then repeats those requests, to time them with warm connections.
+
+Measured per client:
+
+- `seconds`: startup, from before importing the cleaner to the pods listed
+- `request_seconds`: mean time of a read_node and list of pods afterwards
+- `max_rss_mb`: peak resident memory of the process
+- `modules`: number of modules imported
+
+Usage (with docker-image-cleaner installed, e.g. `pip install -e .`):
+
+    python benchmarks/bench_startup.py --pods 10 100
+
+Results are written as JSON lines, see results.py.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+import fake_kube
+from results import Results
+
+CHILD = """
+import json, resource, sys, time
+
+tic = time.perf_counter()
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.pods import PodImages
+
+kind, host, repeat = sys.argv[1], sys.argv[2], int(sys.argv[3])
+if kind == "minimal":
+    from docker_image_cleaner.kube import KubeClient
+
+    kube = KubeClient(host)
+else:
+    import kubernetes.client
+
+    config = kubernetes.client.Configuration()
+    config.host = host
+    kube = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(config))
+kube.read_node("node-1")
+pods = PodImages(kube, "node-1")
+pods.list_pods()
+seconds = time.perf_counter() - tic
+
+tic = time.perf_counter()
+for i in range(repeat):
+    kube.read_node("node-1")
+    pods.list_pods()
+request_seconds = (time.perf_counter() - tic) / repeat
+
+print(json.dumps({
+    "seconds": seconds,
+    "request_seconds": request_seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+}))
+"""
+
+
+def run_startup(kind, host, repeat=10):
+    """Start a process using the `kind` of client, returns its measurements"""
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD, kind, host, str(repeat)],
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return json.loads(out.splitlines()[-1])
+
+
+def serve(n_pods):
+    """A fake API server with node-1, running `n_pods` pods"""
+    kube = fake_kube.FakeKube()
+    kube.add_node("node-1")
+    for i in range(n_pods):
+        kube.set_pod(f"pod-{i}", "node-1", [f"image-{i}:latest", "ubuntu:22.04"])
+    server = fake_kube.serve(kube)
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pods", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--client", nargs="+", default=["kubernetes", "minimal"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="file to append JSON lines to")
+    args = parser.parse_args()
+
+    results = Results(args.output)
+    for n_pods in args.pods:
+        server, host = serve(n_pods)
+        try:
+            for kind in args.client:
+                runs = [run_startup(kind, host) for i in range(args.repeat)]
+                # median of each measurement, startup times are noisy
+                stats = {
+                    key: statistics.median(run[key] for run in runs) for key in runs[0]
+                }
+                results.record(
+                    "startup",
+                    {"pods": n_pods, "client": kind},
+                    stats.pop("seconds"),
+                    **stats,
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
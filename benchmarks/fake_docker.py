@@ -0,0 +1,372 @@
+"""
+A stand-in docker daemon, serving the parts of the docker API the cleaner uses
+
+It listens on a unix socket and simulates a node with many images,
+with configurable latencies, so a whole GC cycle can be timed
+without a real docker daemon.
+
+Images share base layers, and some are dangling (untagged).
+Disk usage reported by /system/df is the size of the layers
+still referenced by images, so it goes down as images are deleted.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlparse
+
+from docker_image_cleaner.lru import parse_docker_time
+from docker_image_cleaner.planner import chain_ids
+
+API_VERSION = "1.43"
+MB = 2**20
+
+
+def _digest(rng):
+    return "sha256:" + "".join(rng.choice("0123456789abcdef") for _ in range(64))
+
+
+class FakeDocker:
+    """
+    State of the simulated daemon
+
+    Latencies are in seconds:
+
+    - latency: added to every request
+    - prune_latency: added per image deleted by a prune
+    - remove_latency: added per image removal
+    - pull_latency: added per image pull
+    - ping_latency: added to pings, e.g. for a daemon busy building images
+
+    `build_cache` bytes of build cache are split into 10 records,
+    oldest first. `builds` containers labelled `build=true` are running.
+    """
+
+    def __init__(
+        self,
+        images=1000,
+        bases=10,
+        layers_per_image=3,
+        dangling_fraction=0.1,
+        layer_size=50 * MB,
+        latency=0,
+        prune_latency=0,
+        remove_latency=0,
+        pull_latency=0,
+        ping_latency=0,
+        build_cache=0,
+        builds=0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.prune_latency = prune_latency
+        self.remove_latency = remove_latency
+        self.pull_latency = pull_latency
+        self.ping_latency = ping_latency
+        self.lock = threading.Lock()
+        self.shutdown = threading.Event()
+        self.requests = 0
+
+        rng = random.Random(seed)
+        base_layers = [[_digest(rng) for _ in range(3)] for _ in range(bases)]
+        self.layer_sizes = {}
+        self.images = {}
+        for i in range(images):
+            diff_ids = rng.choice(base_layers) + [
+                _digest(rng) for _ in range(layers_per_image)
+            ]
+            layers = chain_ids(diff_ids)
+            for layer in layers:
+                self.layer_sizes.setdefault(layer, rng.randint(1, 2 * layer_size))
+            dangling = rng.random() < dangling_fraction
+            created = time.strftime(
+                "%Y-%m-%dT%H:%M:%S.000000000Z",
+                time.gmtime(time.time() - rng.randint(0, 30 * 24 * 3600)),
+            )
+            image_id = _digest(rng)
+            self.images[image_id] = {
+                "Id": image_id,
+                "RepoTags": [] if dangling else [f"image-{i}:latest"],
+                "Created": created,
+                "Size": sum(self.layer_sizes[layer] for layer in layers),
+                "RootFS": {"Type": "layers", "Layers": diff_ids},
+                "Metadata": {"LastTagTime": created},
+                "_layers": layers,
+            }
+        # tagged images can be pulled again after they are deleted
+        self.registry = {
+            tag: image for image in self.images.values() for tag in image["RepoTags"]
+        }
+        self.containers = {
+            f"build-{i}": {
+                "Id": f"build-{i}",
+                "Image": "",
+                "Labels": {"build": "true"},
+                "State": "running",
+            }
+            for i in range(builds)
+        }
+        self.build_cache = [
+            {"ID": f"cache-{i}", "Size": build_cache // 10, "InUse": False}
+            for i in range(10 if build_cache else 0)
+        ]
+
+    def layers_size(self):
+        """Size of all layers referenced by images"""
+        layers = {layer for image in self.images.values() for layer in image["_layers"]}
+        return sum(self.layer_sizes[layer] for layer in layers)
+
+    def write_layerdb(self, docker_root, driver="overlay2"):
+        """Write the size of each layer to a layer database in `docker_root`, like dockerd"""
+        for layer, size in self.layer_sizes.items():
+            algo, _, digest = layer.partition(":")
+            path = os.path.join(docker_root, "image", driver, "layerdb", algo, digest)
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "size"), "w") as f:
+                f.write(str(size))
+
+    def build_cache_size(self):
+        return sum(record["Size"] for record in self.build_cache)
+
+    def prune_build_cache(self, keep_storage=0):
+        """Delete build cache, oldest first, keeping `keep_storage` bytes"""
+        with self.lock:
+            deleted = []
+            while self.build_cache and self.build_cache_size() > keep_storage:
+                deleted.append(self.build_cache.pop(0))
+        return {
+            "CachesDeleted": [record["ID"] for record in deleted] or None,
+            "SpaceReclaimed": sum(record["Size"] for record in deleted),
+        }
+
+    def find(self, ref):
+        """An image by id or tag, or None"""
+        with self.lock:
+            if ref in self.images:
+                return self.images[ref]
+            for image in self.images.values():
+                if ref in image["RepoTags"]:
+                    return image
+        return None
+
+    def pull(self, ref):
+        """Pull an image from the registry, returns it, or None if unknown"""
+        image = self.registry.get(ref)
+        if image is None:
+            return None
+        time.sleep(self.pull_latency)
+        with self.lock:
+            self.images[image["Id"]] = image
+        return image
+
+    def inspect(self, image):
+        return {key: value for key, value in image.items() if not key.startswith("_")}
+
+    def summary(self, image):
+        """An image as listed by /images/json"""
+        return {
+            "Id": image["Id"],
+            "ParentId": "",
+            "RepoTags": image["RepoTags"],
+            "RepoDigests": [],
+            "Created": int(parse_docker_time(image["Created"])),
+            "Size": image["Size"],
+        }
+
+    def delete(self, image_ids):
+        """Delete images, returns bytes freed"""
+        before = self.layers_size()
+        for image_id in image_ids:
+            self.images.pop(image_id, None)
+        return before - self.layers_size()
+
+    def prune_images(self, dangling_only):
+        with self.lock:
+            deleted = [
+                image_id
+                for image_id, image in self.images.items()
+                if not (dangling_only and image["RepoTags"])
+            ]
+            reclaimed = self.delete(deleted)
+        time.sleep(self.prune_latency * len(deleted))
+        return {
+            "ImagesDeleted": [{"Deleted": image_id} for image_id in deleted] or None,
+            "SpaceReclaimed": reclaimed,
+        }
+
+    def remove_image(self, image_id):
+        time.sleep(self.remove_latency)
+        with self.lock:
+            if image_id not in self.images:
+                return None
+            self.delete([image_id])
+        return [{"Deleted": image_id}]
+
+    def df(self):
+        with self.lock:
+            return {
+                "LayersSize": self.layers_size(),
+                "Images": [
+                    {
+                        "Id": image_id,
+                        "Size": image["Size"],
+                        "SharedSize": -1,
+                        "Containers": 0,
+                    }
+                    for image_id, image in self.images.items()
+                ],
+                "Containers": [],
+                "Volumes": [],
+                "BuildCache": list(self.build_cache),
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def docker(self):
+        return self.server.docker
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return "unix"
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        with self.docker.lock:
+            self.docker.requests += 1
+        time.sleep(self.docker.latency)
+        url = urlparse(self.path)
+        # strip the API version prefix, e.g. /v1.43/images/json
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        query = parse_qs(url.query)
+        images = self.docker.images
+
+        if method == "GET" and path == "/version":
+            return self.send_json({"ApiVersion": API_VERSION, "Version": "fake"})
+        if method == "GET" and path == "/_ping":
+            time.sleep(self.docker.ping_latency)
+            return self.send_json("OK")
+        if method == "GET" and path == "/images/json":
+            with self.docker.lock:
+                listed = [self.docker.summary(image) for image in images.values()]
+            return self.send_json(listed)
+        m = re.match(r"^/images/(.+)/json$", path)
+        if method == "GET" and m:
+            image = self.docker.find(m.group(1))
+            if image is None:
+                return self.send_json({"message": "No such image"}, 404)
+            return self.send_json(self.docker.inspect(image))
+        m = re.match(r"^/images/(.+)$", path)
+        if method == "DELETE" and m:
+            result = self.docker.remove_image(m.group(1))
+            if result is None:
+                return self.send_json({"message": "No such image"}, 404)
+            return self.send_json(result)
+        if method == "POST" and path == "/images/create":
+            ref = query["fromImage"][0] + ":" + query.get("tag", ["latest"])[0]
+            image = self.docker.pull(ref)
+            if image is None:
+                return self.send_json({"message": f"pull access denied for {ref}"}, 404)
+            # progress as JSON lines, like the real thing
+            body = "".join(
+                json.dumps(status) + "\r\n"
+                for status in (
+                    {"status": f"Pulling from {ref}"},
+                    {"status": f"Digest: {image['Id']}"},
+                    {"status": f"Downloaded newer image for {ref}"},
+                )
+            ).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if method == "POST" and path == "/images/prune":
+            filters = json.loads(query.get("filters", ["{}"])[0])
+            dangling_only = filters.get("dangling", ["true"]) != ["false"]
+            return self.send_json(self.docker.prune_images(dangling_only))
+        if method == "POST" and path == "/containers/prune":
+            return self.send_json({"ContainersDeleted": None, "SpaceReclaimed": 0})
+        if method == "POST" and path == "/build/prune":
+            keep_storage = int(query.get("keep-storage", ["0"])[0])
+            return self.send_json(self.docker.prune_build_cache(keep_storage))
+        if method == "GET" and path == "/containers/json":
+            filters = json.loads(query.get("filters", ["{}"])[0])
+            labels = filters.get("label", [])
+            # label filters are "key" or "key=value"
+            listed = [
+                container
+                for container in self.docker.containers.values()
+                if all(
+                    label in container["Labels"]
+                    or label in {f"{k}={v}" for k, v in container["Labels"].items()}
+                    for label in labels
+                )
+            ]
+            return self.send_json(listed)
+        m = re.match(r"^/containers/(.+)/json$", path)
+        if method == "GET" and m and m.group(1) in self.docker.containers:
+            return self.send_json(self.docker.containers[m.group(1)])
+        if method == "GET" and path == "/system/df":
+            return self.send_json(self.docker.df())
+        if method == "GET" and path == "/events":
+            # no events, but keep the stream open like the real thing
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.flush()
+            self.docker.shutdown.wait()
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_json({"message": f"Not implemented: {method} {path}"}, 404)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+
+class FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, docker):
+    """
+    Serve `docker`, a FakeDocker, on a unix socket in a background thread
+
+    Returns the server. Stop it with stop(server).
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = FakeDockerServer(socket_path, Handler)
+    server.docker = docker
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stop(server):
+    server.docker.shutdown.set()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,245 @@
+"""
+A fake kubernetes API server, serving coordination.k8s.io/v1 Leases,
+nodes and pods
+
+Enough of the API for leases.GCSlots: list (with a label selector),
+create, read, replace (checking resourceVersion) and delete,
+returning 404 and 409 statuses like the real thing.
+And for the node and its pods: read and (merge) patch a node,
+list and watch pods, with a field selector on spec.nodeName.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import kubernetes.client
+
+LEASES = re.compile(
+    r"^/apis/coordination\.k8s\.io/v1/namespaces/([^/]+)/leases(?:/([^/]+))?$"
+)
+NODES = re.compile(r"^/api/v1/nodes/([^/]+)$")
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch, where None deletes"""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+
+
+class FakeKube:
+    """Leases stored by (namespace, name)"""
+
+    def __init__(self):
+        self.leases = {}
+        self.nodes = {}
+        # {uid: pod}, and (resourceVersion, type, pod) events for watches
+        self.pods = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.version = 0
+        # client (host, port) of each request, to count connections
+        self.clients = []
+
+    def add_node(self, name):
+        self.nodes[name] = {
+            "kind": "Node",
+            "metadata": {"name": name, "annotations": {}},
+            "spec": {},
+        }
+
+    def set_pod(self, uid, node, images, event_type="ADDED"):
+        """Add, modify or delete (event_type="DELETED") a pod running images"""
+        pod = {
+            "kind": "Pod",
+            "metadata": {"uid": uid, "resourceVersion": self.next_version()},
+            "spec": {
+                "nodeName": node,
+                "containers": [
+                    {"name": f"c{i}", "image": image} for i, image in enumerate(images)
+                ],
+            },
+            "status": {"phase": "Running"},
+        }
+        if event_type == "DELETED":
+            self.pods.pop(uid, None)
+        else:
+            self.pods[uid] = pod
+        self.events.append((self.version, event_type, pod))
+
+    def next_version(self):
+        self.version += 1
+        return str(self.version)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, code, reason):
+        self.send_json(
+            {
+                "kind": "Status",
+                "apiVersion": "v1",
+                "status": "Failure",
+                "reason": reason,
+                "code": code,
+            },
+            code,
+        )
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length))
+
+    def route(self, method):
+        url = urlparse(self.path)
+        self.server.kube.clients.append(self.client_address)
+        if url.path == "/api/v1/pods":
+            return self.pods(parse_qs(url.query))
+        m = NODES.match(url.path)
+        if m:
+            return self.node(method, m.group(1))
+        m = LEASES.match(url.path)
+        if not m:
+            return self.send_status(404, "NotFound")
+        namespace, name = m.groups()
+        kube = self.server.kube
+        with kube.lock:
+            if name is None and method == "GET":
+                selector = parse_qs(url.query).get("labelSelector", [""])[0]
+                key, _, value = selector.partition("=")
+                items = [
+                    lease
+                    for (ns, _), lease in sorted(kube.leases.items())
+                    if ns == namespace
+                    and (
+                        not key or lease["metadata"].get("labels", {}).get(key) == value
+                    )
+                ]
+                return self.send_json(
+                    {
+                        "kind": "LeaseList",
+                        "apiVersion": "coordination.k8s.io/v1",
+                        "metadata": {"resourceVersion": str(kube.version)},
+                        "items": items,
+                    }
+                )
+            if name is None and method == "POST":
+                lease = self.read_body()
+                key = (namespace, lease["metadata"]["name"])
+                if key in kube.leases:
+                    return self.send_status(409, "AlreadyExists")
+                lease["metadata"]["namespace"] = namespace
+                lease["metadata"]["resourceVersion"] = kube.next_version()
+                kube.leases[key] = lease
+                return self.send_json(lease, 201)
+            key = (namespace, name)
+            if key not in kube.leases:
+                return self.send_status(404, "NotFound")
+            if method == "GET":
+                return self.send_json(kube.leases[key])
+            if method == "PUT":
+                lease = self.read_body()
+                current = kube.leases[key]["metadata"]["resourceVersion"]
+                if lease["metadata"].get("resourceVersion") != current:
+                    return self.send_status(409, "Conflict")
+                lease["metadata"]["resourceVersion"] = kube.next_version()
+                kube.leases[key] = lease
+                return self.send_json(lease)
+            if method == "DELETE":
+                del kube.leases[key]
+                return self.send_json({"kind": "Status", "status": "Success"})
+        self.send_status(405, "MethodNotAllowed")
+
+    def node(self, method, name):
+        kube = self.server.kube
+        with kube.lock:
+            if name not in kube.nodes:
+                return self.send_status(404, "NotFound")
+            node = kube.nodes[name]
+            if method == "PATCH":
+                if "merge-patch" not in self.headers.get("Content-Type", ""):
+                    return self.send_status(415, "UnsupportedMediaType")
+                merge_patch(node, self.read_body())
+            return self.send_json(node)
+
+    def pods(self, query):
+        kube = self.server.kube
+        selector = query.get("fieldSelector", [""])[0]
+        node = selector.partition("spec.nodeName=")[2]
+        with kube.lock:
+            if query.get("watch") != ["true"]:
+                return self.send_json(
+                    {
+                        "kind": "PodList",
+                        "metadata": {"resourceVersion": str(kube.version)},
+                        "items": [
+                            pod
+                            for pod in kube.pods.values()
+                            if not node or pod["spec"]["nodeName"] == node
+                        ],
+                    }
+                )
+            # send the events since resourceVersion, and end the watch
+            since = int(query.get("resourceVersion", ["0"])[0])
+            events = [
+                {"type": event_type, "object": pod}
+                for version, event_type, pod in kube.events
+                if version > since and (not node or pod["spec"]["nodeName"] == node)
+            ]
+        body = "".join(json.dumps(event) + "\n" for event in events).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+
+def serve(kube):
+    """Serve `kube`, a FakeKube, in a background thread, returns the server"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.kube = kube
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def coordination_api(server):
+    """A CoordinationV1Api talking to a fake server"""
+    config = kubernetes.client.Configuration()
+    config.host = f"http://127.0.0.1:{server.server_address[1]}"
+    return kubernetes.client.CoordinationV1Api(kubernetes.client.ApiClient(config))
@@ -0,0 +1,52 @@
+"""
+Machine-readable benchmark results
+
+Each measurement is one JSON object per line (JSON lines),
+so results from different runs and commits can be concatenated and compared.
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results:
+    """Collect measurements, and write them to `path` (default: stdout)"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.context = {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        }
+
+    def record(self, benchmark, params, seconds, **extra):
+        """Record that `benchmark` with `params` took `seconds`"""
+        result = {
+            "benchmark": benchmark,
+            "params": params,
+            "seconds": seconds,
+            "timestamp": time.time(),
+            **extra,
+            **self.context,
+        }
+        line = json.dumps(result)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        else:
+            sys.stdout.write(line + "\n")
+        return result
@@ -0,0 +1,102 @@
+"""
+Generate synthetic /var/lib/docker-shaped directory trees
+
+The layout mimics the overlay2 storage driver:
+
+    overlay2/<layer>/diff/...   layer contents
+    overlay2/<layer>/link       short id of the layer
+    overlay2/l/<short id>       symlink to ../<layer>/diff
+    image/overlay2/layerdb/...  layer database, mapping layers to overlay2 ids
+    image/overlay2/...          image metadata
+    containers/<id>/...         container logs and config
+
+Every file gets the same size, so the expected total is easy to compute.
+A few files are hardlinked between layers, the way docker build
+and some copy-on-write setups do.
+"""
+import os
+import random
+import string
+
+LETTERS = string.ascii_lowercase + string.digits
+
+
+def _random_id(rng, n=64):
+    return "".join(rng.choice(LETTERS) for _ in range(n))
+
+
+def _write(path, size):
+    with open(path, "wb") as f:
+        if size:
+            # sparse file: the scanner only looks at st_size
+            f.truncate(size)
+
+
+def make_docker_tree(
+    root,
+    layers=100,
+    dirs_per_layer=10,
+    files_per_dir=10,
+    file_size=1024,
+    containers=5,
+    seed=0,
+):
+    """
+    Create a synthetic docker tree in `root`
+
+    Returns the expected total size in bytes,
+    counting every hardlinked inode once and skipping symlinks.
+    """
+    rng = random.Random(seed)
+    expected = 0
+    overlay2 = os.path.join(root, "overlay2")
+    os.makedirs(os.path.join(overlay2, "l"), exist_ok=True)
+    previous_file = None
+    for i in range(layers):
+        layer_id = _random_id(rng)
+        layer = os.path.join(overlay2, layer_id)
+        diff = os.path.join(layer, "diff")
+        os.makedirs(diff)
+        short_id = _random_id(rng, 26).upper()
+        with open(os.path.join(layer, "link"), "w") as f:
+            f.write(short_id)
+        expected += len(short_id)
+        os.symlink(
+            os.path.join("..", layer_id, "diff"), os.path.join(overlay2, "l", short_id)
+        )
+        layerdb = os.path.join(
+            root, "image", "overlay2", "layerdb", "sha256", _random_id(rng)
+        )
+        os.makedirs(layerdb)
+        with open(os.path.join(layerdb, "cache-id"), "w") as f:
+            f.write(layer_id)
+        expected += len(layer_id)
+        for d in range(dirs_per_layer):
+            dirpath = os.path.join(diff, "usr", "lib", f"pkg{d}")
+            os.makedirs(dirpath)
+            for n in range(files_per_dir):
+                path = os.path.join(dirpath, f"file{n}.py")
+                _write(path, file_size)
+                expected += file_size
+            # symlinks inside layers are not counted
+            os.symlink("file0.py", os.path.join(dirpath, "link.py"))
+        if previous_file:
+            # hardlink a file from the previous layer: counted once
+            os.link(previous_file, os.path.join(diff, "hardlink"))
+        previous_file = path
+
+    image_db = os.path.join(root, "image", "overlay2", "imagedb", "content", "sha256")
+    os.makedirs(image_db)
+    for i in range(layers):
+        path = os.path.join(image_db, _random_id(rng))
+        _write(path, 512)
+        expected += 512
+
+    for i in range(containers):
+        container = os.path.join(root, "containers", _random_id(rng))
+        os.makedirs(container)
+        path = os.path.join(container, "container-json.log")
+        _write(path, file_size * 10)
+        expected += file_size * 10
+
+    return expected
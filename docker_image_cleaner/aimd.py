@@ -0,0 +1,50 @@
+"""
+Adaptive concurrency limit for requests to the docker API
+
+Additive increase, multiplicative decrease (AIMD), like TCP congestion
+control: the limit grows by one after a whole window of fast responses,
+and is halved on a slow response or a timeout,
+so we go as fast as the daemon can handle without overloading it.
+"""
+
+
+class AIMDLimit:
+    """
+    Concurrency limit between `minimum` and `maximum`
+
+    Responses slower than `target_latency` seconds count as overload.
+    """
+
+    def __init__(self, maximum, minimum=1, target_latency=5, initial=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.value = float(initial or minimum)
+        # responses to wait for after decreasing before decreasing again,
+        # so one overloaded window only halves the limit once
+        self._cooldown = 0
+
+    @property
+    def limit(self):
+        """The current limit, as a whole number of concurrent requests"""
+        return max(self.minimum, min(self.maximum, int(self.value)))
+
+    def _decrease(self):
+        if self._cooldown > 0:
+            return
+        self.value = max(self.minimum, self.value / 2)
+        self._cooldown = self.limit
+
+    def on_success(self, latency):
+        """Record a response that took `latency` seconds"""
+        self._cooldown -= 1
+        if latency > self.target_latency:
+            self._decrease()
+        else:
+            # grows by one for every `limit` fast responses
+            self.value = min(self.maximum, self.value + 1 / self.limit)
+
+    def on_timeout(self):
+        """Record a request that timed out"""
+        self._cooldown -= 1
+        self._decrease()
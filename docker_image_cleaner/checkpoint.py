@@ -0,0 +1,94 @@
+"""
+Record the progress of removing images, one batch at a time
+
+Images are removed in batches of explicit image ids, instead of one long
+prune request that can time out without telling us what it deleted.
+The plan (ids of images to remove, in order) is recorded before removing
+anything, and progress after each batch, optionally persisted to a file
+(e.g. on a hostPath), so a timeout or crash loses at most one batch.
+After a restart, images left from an interrupted plan are removed first.
+"""
+import logging
+
+from .persist import load_state, save_state
+
+STATE_VERSION = 1
+
+GB = 2**30
+
+
+class Checkpoint:
+    """Progress of removing a planned list of images, optionally persisted to `path`"""
+
+    def __init__(self, path=None):
+        self.path = path
+        # ids of planned images not attempted yet, in order
+        self.remaining = []
+        self.removed = 0
+        self.freed_bytes = 0
+        if path:
+            self.load()
+
+    def load(self):
+        """Load progress from self.path, if it exists"""
+        data = load_state(self.path, STATE_VERSION, "removal checkpoint")
+        if data is None:
+            return
+        self.remaining = data["remaining"]
+        self.removed = data["removed"]
+        self.freed_bytes = data["freed_bytes"]
+        if self.remaining:
+            logging.info(
+                f"Resuming removal interrupted after removing {self.removed} images "
+                f"({self.freed_bytes / GB:.2f}GB), {len(self.remaining)} images left"
+            )
+
+    def save(self):
+        """Persist progress to self.path, if set"""
+        if self.path:
+            save_state(
+                self.path,
+                STATE_VERSION,
+                {
+                    "remaining": self.remaining,
+                    "removed": self.removed,
+                    "freed_bytes": self.freed_bytes,
+                },
+            )
+
+    def resume(self, images):
+        """
+        Order docker Images to remove, continuing an interrupted plan
+
+        Images left from the interrupted plan come first, in planned order,
+        followed by the others. Images not in `images` (e.g. already gone,
+        or now used by a pod) are dropped from the plan.
+        """
+        if not self.remaining:
+            return list(images)
+        position = {image_id: i for i, image_id in enumerate(self.remaining)}
+        resumed = sorted(
+            (image for image in images if image.id in position),
+            key=lambda image: position[image.id],
+        )
+        return resumed + [image for image in images if image.id not in position]
+
+    def begin(self, image_ids):
+        """Record the plan, before removing anything"""
+        self.remaining = list(image_ids)
+        self.removed = 0
+        self.freed_bytes = 0
+        self.save()
+
+    def record(self, attempted_ids, removed, freed_bytes):
+        """Record a batch: ids attempted, and how many images it removed, freeing how many bytes"""
+        attempted_ids = set(attempted_ids)
+        self.remaining = [i for i in self.remaining if i not in attempted_ids]
+        self.removed += removed
+        self.freed_bytes += freed_bytes
+        self.save()
+
+    def finish(self):
+        """Record that the plan is done, or was stopped early on purpose"""
+        self.remaining = []
+        self.save()
@@ -7,15 +7,53 @@ This serves as a substitute for Kubernetes ImageGC
 which has thresholds that are not sufficiently configurable on GKE
 at this time.
 """
+import asyncio
+import contextvars
 import logging
+import math
 import os
+import signal
+import threading
 import time
-from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager
 from functools import partial
 
 import docker
 import requests
 
+from . import metrics, tracing
+from .aimd import AIMDLimit
+from .checkpoint import Checkpoint
+from .disk_usage import CATEGORIES, DockerDiskUsage
+from .image_index import ImageIndex
+from .kube import KubeClient
+from .layer_cache import LayerInodeCache, LayerSizeCache
+from .leases import GCSlots, current_namespace
+from .lru import LastUsed, pulled_at
+from .planner import (
+    estimate_layer_sizes,
+    freed_in_order,
+    image_layers,
+    plan_removal,
+    read_layer_sizes,
+)
+from .pods import PodImages, api_error
+from .policy import (
+    POLICIES,
+    needs_gc,
+    parse_age,
+    removal_order,
+    should_defer,
+    should_prune_all,
+    until_steps,
+)
+from .reserve import Reservations
+from .reserve import serve as serve_reservations
+from .rewarm import Rewarmer, parse_refs
+from .scanner import estimate_size, scan_size
+from .scheduler import PollScheduler
+
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
 
@@ -24,23 +62,88 @@ annotation_key = "hub.jupyter.org/image-cleaner-cordoned"
 GB = 2**30
 
 
-def get_absolute_size(path):
+def get_absolute_size(
+    path, workers=1, cache=None, threshold=None, max_error=0, time_budget=None
+):
     """
     Directory size in gigabytes
+
+    Subtrees are scanned by `workers` threads,
+    see scanner.scan_size.
+    Sizes of committed layers are reused from `cache`,
+    a layer_cache.LayerSizeCache, if given.
+
+    With `max_error` (a fraction) and `threshold` (in bytes),
+    the size is estimated from a sample of subtrees instead,
+    within `time_budget` seconds, see scanner.estimate_size.
     """
     # first, check permissions, existence of path with os.listdir
-    # os.walk returns an empty list if it doesn't find anything
+    # the scanner skips directories it can't read, like os.walk
     os.listdir(path)
-    total = 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for fname in filenames:
-            f = os.path.join(dirpath, fname)
-            # some files are links, skip them as they don't use
-            # up additional space
-            if os.path.isfile(f):
-                total += os.path.getsize(f)
+    if cache is not None:
+        cache.refresh()
+
+    if max_error and threshold is not None:
+        tic = time.perf_counter()
+        estimate = estimate_size(
+            path,
+            threshold,
+            max_error=max_error,
+            time_budget=time_budget,
+            workers=workers,
+            cache=cache,
+        )
+        logging.info(
+            f"Estimated {estimate.size / GB:.2f}GB used "
+            f"(between {estimate.low / GB:.2f}GB and {estimate.high / GB:.2f}GB) "
+            f"from {estimate.sampled} of {estimate.tasks} directories "
+            f"in {time.perf_counter() - tic:.1f}s"
+        )
+        size = estimate.size
+    elif cache is None:
+        return scan_size(path, workers=workers) / GB
+    else:
+        size = scan_size(path, workers=workers, cache=cache)
+
+    if cache is not None:
+        logging.info(
+            f"Reused {cache.hits} cached layer sizes, scanned {cache.misses} changed layers"
+        )
+        cache.save()
+    return size / GB
+
+
+def get_docker_size(disk_usage, path=None):
+    """
+    Usage reported by the docker daemon in gigabytes
+
+    `disk_usage` is a disk_usage.DockerDiskUsage.
+    `path` is ignored, for compatibility with get_absolute_size.
+    """
+    usage = disk_usage.get()
+    logging.info(
+        "Docker disk usage: "
+        + ", ".join(
+            f"{kind} {usage[kind]['size'] / GB:.2f}GB ({usage[kind]['reclaimable'] / GB:.2f}GB reclaimable)"
+            for kind in CATEGORIES
+        )
+    )
+    return disk_usage.total() / GB
+
+
+def recheck_docker_size(disk_usage, path=None):
+    """Like get_docker_size, asking the daemon again instead of reusing its last report"""
+    disk_usage.invalidate()
+    return get_docker_size(disk_usage, path)
+
 
-    return total / GB
+def get_usage_percent(path):
+    """Return {"blocks": % used, "inodes": % used} of the filesystem at `path`"""
+    stat = os.statvfs(path)
+    return {
+        "blocks": 100 * (1 - stat.f_bavail / stat.f_blocks),
+        "inodes": 100 * (1 - stat.f_favail / stat.f_files),
+    }
 
 
 def get_used_percent(path):
@@ -52,10 +155,7 @@ def get_used_percent(path):
     Calculated by blocks or inodes,
     which ever reports as the most full.
     """
-    stat = os.statvfs(path)
-    inodes_avail = stat.f_favail / stat.f_files
-    blocks_avail = stat.f_bavail / stat.f_blocks
-    return 100 * (1 - min(blocks_avail, inodes_avail))
+    return max(get_usage_percent(path).values())
 
 
 def cordon(kube, node):
@@ -97,70 +197,933 @@ def uncordon(kube, node):
     )
 
 
-@contextmanager
-def cordoned(kube, node):
-    """Context manager for cordoning a node"""
+def get_bytes_to_free(used, threshold, threshold_type, path):
+    """
+    Estimate how many bytes need to be freed to get `used` below `threshold`
+
+    In relative mode, the percentage is converted using the size of
+    the filesystem at `path`.
+    """
+    if threshold_type == "relative":
+        stat = os.statvfs(path)
+        return (used - threshold) / 100 * stat.f_blocks * stat.f_frsize
+    return (used - threshold) * GB
+
+
+def get_percent_size(path):
+    """Bytes in 1% of the filesystem at `path`"""
+    stat = os.statvfs(path)
+    return stat.f_blocks * stat.f_frsize / 100
+
+
+def get_inodes_to_free(threshold, path):
+    """How many inodes need to be freed to get the filesystem at `path` below `threshold` %"""
+    stat = os.statvfs(path)
+    return (1 - stat.f_favail / stat.f_files - threshold / 100) * stat.f_files
+
+
+def get_reserve_threshold(need_bytes, threshold_high, threshold_type, path):
+    """
+    Usage, in the units of the thresholds, at or below which `need_bytes` are free
+
+    In relative mode, that is blocks available on the filesystem at `path`.
+    Otherwise, it is room left below threshold_high, in GB,
+    as the filesystem may not be the docker daemon's.
+    """
+    if threshold_type == "relative":
+        stat = os.statvfs(path)
+        return 100 * (1 - need_bytes / (stat.f_blocks * stat.f_frsize))
+    return threshold_high - need_bytes / GB
+
+
+def get_free_bytes(used, threshold_high, threshold_type, path):
+    """Bytes free, in the sense of get_reserve_threshold"""
+    if threshold_type == "relative":
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    return max(int((threshold_high - used) * GB), 0)
+
+
+def get_layer_graph(images, docker_root):
+    """
+    Image -> layer graph and layer sizes of docker Images
+
+    Layer sizes are read from the layer database in `docker_root`,
+    and estimated from image sizes if it isn't available.
+
+    Returns (graph, layer_sizes), see planner.plan_removal.
+    """
+    graph = image_layers(images)
+    all_layers = {layer for layers in graph.values() for layer in layers}
+    layer_sizes = estimate_layer_sizes(
+        images, graph, read_layer_sizes(docker_root, all_layers)
+    )
+    return graph, layer_sizes
+
+
+def plan_image_removal(
+    docker_client,
+    images,
+    docker_root,
+    need_bytes,
+    policy="layers",
+    last_used=None,
+    keep=(),
+):
+    """
+    Plan which images to remove to free `need_bytes`, see policy.removal_order
+
+    Images with ids in `keep`, or used by containers, are never removed.
+    The "lru" policy orders them by `last_used`, a lru.LastUsed.
+
+    Returns (images in removal order, {image id: bytes freed}).
+    """
+    graph, layer_sizes = get_layer_graph(images, docker_root)
+    in_use = {c.attrs["Image"] for c in docker_client.containers.list(all=True)}
+    candidates = [
+        image.id for image in images if image.id not in in_use and image.id not in keep
+    ]
+    if policy == "lru":
+        last_used = {image.id: last_used.get(image) for image in images}
+    order, freed = removal_order(
+        policy, graph, layer_sizes, candidates, need_bytes, last_used=last_used
+    )
+    by_id = {image.id: image for image in images}
+    return [by_id[image_id] for image_id in order], freed
+
+
+def plan_inode_removal(images, candidates, need_inodes, inode_cache):
+    """
+    Plan which of the `candidates` to remove to free `need_inodes`
+
+    Like the "layers" policy, with layers weighed by how many inodes they use
+    instead of bytes, so the fewest images are removed when inodes run out,
+    rather than big images with few files.
+    `inode_cache` is a layer_cache.LayerInodeCache.
+
+    Returns (images in removal order, {image id: inodes freed}).
+    If no layers were found, e.g. in docker mode, `candidates` are returned
+    as they are, to be removed until usage is low enough.
+    """
+    graph = image_layers(images)
+    all_layers = {layer for layers in graph.values() for layer in layers}
+    layer_inodes = inode_cache.counts(all_layers)
+    if not layer_inodes:
+        logging.warning(f"No layers found in {inode_cache.docker_root} to count inodes")
+        return candidates, {}
+    logging.info(
+        f"Reused {inode_cache.hits} cached layer inode counts, counted {inode_cache.misses} layers"
+    )
+    plan = plan_removal(
+        graph, layer_inodes, [image.id for image in candidates], need_inodes
+    )
+    by_id = {image.id: image for image in images}
+    return [by_id[image_id] for image_id, _ in plan], dict(plan)
+
+
+def _remove_image(docker_client, image, delay_seconds):
+    """
+    Remove one image, and wait `delay_seconds`, if any
+
+    Returns how long the removal took, in seconds.
+    """
+    tic = time.perf_counter()
+    # docker_client.images.remove: https://docker-py.readthedocs.io/en/stable/images.html#docker.models.images.ImageCollection.remove
+    # force is needed to remove images with more than one tag,
+    # images used by running containers still can't be removed
+    docker_client.images.remove(image.id, force=True)
+    latency = time.perf_counter() - tic
+    metrics.docker_api_latency.labels("remove_image").observe(latency)
+    if delay_seconds:
+        time.sleep(delay_seconds)
+    return latency
+
+
+def remove_images(
+    docker_client,
+    images,
+    get_used,
+    used,
+    threshold,
+    delay_seconds,
+    estimate=False,
+    freed=None,
+    limit=None,
+    unit=GB,
+    cancel=None,
+):
+    """
+    Remove images, in order, until usage drops below `threshold`
+
+    Usage is rechecked with get_used after each removal,
+    or, if `estimate` is True (get_used is expensive),
+    estimated by subtracting the bytes each removal frees,
+    as given by `freed` ({image id: bytes}).
+    Without `freed`, the size of each image is used, which is an upper bound,
+    since layers shared with other images are not deleted.
+    `unit` is the bytes in one unit of usage: GB, or 1% of the filesystem
+    in relative mode. Removals in progress count towards `threshold`
+    by the same estimate, so no more removals start than needed.
+    With `unit=None`, e.g. when usage is inodes, they aren't counted.
+
+    No more removals start once `cancel`, a threading.Event, is set,
+    e.g. on SIGTERM, only those in progress finish.
+
+    Up to `limit.limit` images are removed concurrently, where `limit` is an
+    aimd.AIMDLimit adapting to how fast the docker daemon responds.
+    By default, images are removed one at a time.
+    Each removal is followed by a `delay_seconds` pause of its worker.
+
+    Images in use by running containers are skipped.
+    Removal stops on a timeout when already at the minimum concurrency.
+
+    Returns (removed images, estimated bytes freed, used).
+    """
+    if limit is None:
+        limit = AIMDLimit(maximum=1)
+
+    def image_size(image):
+        if freed is None:
+            return image.attrs.get("Size", 0)
+        return freed.get(image.id, 0)
+
+    def image_usage(image):
+        if unit is None:
+            return 0
+        return image_size(image) / unit
+
+    removed = []
+    freed_bytes = 0
+    # estimated usage freed by removals in progress,
+    # so we don't start more removals than needed
+    pending_used = 0
+    pending = {}
+    images = iter(images)
+    stopped = False
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=limit.maximum) as pool:
+        while True:
+            while not stopped and len(pending) < limit.limit:
+                if cancel is not None and cancel.is_set():
+                    break
+                if used - pending_used < threshold:
+                    break
+                image = next(images, None)
+                if image is None:
+                    break
+                future = pool.submit(_remove_image, docker_client, image, delay_seconds)
+                pending[future] = image
+                pending_used += image_usage(image)
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                image = pending.pop(future)
+                pending_used -= image_usage(image)
+                try:
+                    latency = future.result()
+                except docker.errors.ImageNotFound:
+                    # already gone, e.g. removed along with its child image
+                    continue
+                except docker.errors.APIError as e:
+                    # e.g. 409 Conflict when a container is using the image
+                    logging.info(
+                        f"Not removing image {image.short_id} {image.tags}: {e}"
+                    )
+                    continue
+                except requests.exceptions.ReadTimeout:
+                    logging.warning(f"Timeout removing image {image.short_id}")
+                    metrics.docker_api_timeouts.labels("remove_image").inc()
+                    if limit.limit <= limit.minimum:
+                        stopped = True
+                    limit.on_timeout()
+                    # Delay longer after a timeout, which indicates that Docker is overworked
+                    time.sleep(max(delay_seconds, 30))
+                    continue
+                limit.on_success(latency)
+                removed.append(image)
+                size = image_size(image)
+                freed_bytes += size
+                logging.info(
+                    f"Removed image {image.short_id} {image.tags} in {latency:.1f}s"
+                )
+                if estimate:
+                    used -= image_usage(image)
+                else:
+                    used = get_used()
+
+    duration = time.perf_counter() - tic
+    if removed:
+        logging.info(
+            f"Removed {len(removed)} images, about {freed_bytes / GB:.2f}GB, in {duration:.0f} seconds: "
+            f"{len(removed) / duration:.2f} images/s, {freed_bytes / duration / 2**20:.1f}MB/s "
+            f"(concurrency {limit.limit})"
+        )
+    return removed, freed_bytes, used
+
+
+def remove_in_batches(
+    docker_client,
+    images,
+    get_used,
+    used,
+    threshold,
+    delay_seconds,
+    checkpoint,
+    batch_size=20,
+    recheck=None,
+    cancel=None,
+    plan=True,
+    **kwargs,
+):
+    """
+    Remove images in batches of `batch_size`, see remove_images
+
+    The plan and the progress after each batch are recorded in `checkpoint`,
+    a checkpoint.Checkpoint, and in metrics, so a timeout or crash
+    loses at most one batch. With `plan=False`, the caller begins and
+    finishes the plan, e.g. remove_in_steps with all of its steps.
+    Between batches, usage is rechecked with `recheck()`, if given,
+    and removal stops once usage is below `threshold`.
+    It also stops when a whole batch removed nothing,
+    e.g. because the daemon keeps timing out, or once `cancel` is set,
+    leaving the rest of the plan to resume after a restart.
+
+    Returns (removed images, estimated bytes freed, used).
+    """
+    if plan:
+        checkpoint.begin(image.id for image in images)
+    removed = []
+    freed_bytes = 0
+    for start in range(0, len(images), batch_size):
+        if used < threshold or (cancel is not None and cancel.is_set()):
+            break
+        batch = images[start : start + batch_size]
+        tic = time.perf_counter()
+        with tracing.span("remove_batch", images=len(batch)) as trace:
+            batch_removed, batch_freed, used = remove_images(
+                docker_client,
+                batch,
+                get_used,
+                used,
+                threshold,
+                delay_seconds,
+                cancel=cancel,
+                **kwargs,
+            )
+            trace["removed"] = len(batch_removed)
+            trace["bytes"] = batch_freed
+        checkpoint.record(
+            [image.id for image in batch], len(batch_removed), batch_freed
+        )
+        record_deleted(
+            "images", len(batch_removed), batch_freed, time.perf_counter() - tic
+        )
+        removed.extend(batch_removed)
+        freed_bytes += batch_freed
+        if not batch_removed:
+            logging.warning(
+                f"Stopped removing images, a batch of {len(batch)} removed none"
+            )
+            break
+        if recheck is not None:
+            used = recheck()
+    if plan and not (cancel is not None and cancel.is_set()):
+        checkpoint.finish()
+    return removed, freed_bytes, used
+
+
+def remove_in_steps(
+    docker_client,
+    steps,
+    get_used,
+    used,
+    threshold,
+    delay_seconds,
+    checkpoint,
+    cancel=None,
+    **kwargs,
+):
+    """
+    Remove images in steps, e.g. those pulled longest ago first
+
+    `steps` are (description, images, remove_all) tuples. Each step removes
+    its images with remove_in_batches, until usage is below `threshold`,
+    or all of them if `remove_all`. Later steps only start while usage
+    is still above `threshold`, and `cancel` isn't set.
+    The images of all steps are recorded in `checkpoint` as one plan.
+
+    Returns (removed images, estimated bytes freed, used), like remove_in_batches.
+    """
+    checkpoint.begin([image.id for _, images, _ in steps for image in images])
+    removed = []
+    freed_bytes = 0
+    for i, (description, images, remove_all) in enumerate(steps):
+        if (i and used < threshold) or (cancel is not None and cancel.is_set()):
+            break
+        if description:
+            logging.info(f"Removing {description}")
+        with tracing.span("remove_step", images=len(images), step=description):
+            step_removed, step_freed, used = remove_in_batches(
+                docker_client,
+                images,
+                get_used,
+                used,
+                -math.inf if remove_all else threshold,
+                delay_seconds,
+                checkpoint,
+                cancel=cancel,
+                plan=False,
+                **kwargs,
+            )
+        removed.extend(step_removed)
+        freed_bytes += step_freed
+    if not (cancel is not None and cancel.is_set()):
+        checkpoint.finish()
+    return removed, freed_bytes, used
+
+
+def age_steps(images, until, now=None):
+    """
+    Steps for remove_in_steps, removing images pulled longest ago first
+
+    `until` maps ages in seconds to how they are written, e.g. {259200: "72h"}.
+    Images pulled more recently than all ages are only removed
+    if removing older ones wasn't enough, see policy.until_steps.
+    """
+    if now is None:
+        now = time.time()
+    by_id = {image.id: image for image in images}
+    ages = {image.id: now - pulled_at(image) for image in images}
+    steps = []
+    for age, ids in until_steps(ages, until):
+        step_images = [by_id[image_id] for image_id in ids]
+        if age is None:
+            description = f"the other {len(ids)} unused images"
+        else:
+            description = f"{len(ids)} unused images pulled more than {until[age]} ago"
+        steps.append((description, step_images, age is None))
+    return steps
+
+
+def prune(docker_client, kind, delay_seconds, dangling=True):
+    """
+    Prune stopped containers, or dangling images
+
+    With `dangling=False`, prune _all_ images not used by containers.
+
+    Returns (number deleted, bytes reclaimed), or None after a timeout.
+    """
+    operation = f"prune_{kind}" if dangling else f"prune_all_{kind}"
+    try:
+        # docker_client.containers.prune: https://docker-py.readthedocs.io/en/stable/containers.html#docker.models.containers.ContainerCollection.prune
+        # docker_client.images.prune: https://docker-py.readthedocs.io/en/stable/images.html#docker.models.images.ImageCollection.prune
+        with metrics.docker_api_latency.labels(operation).time():
+            if dangling:
+                pruned = getattr(docker_client, kind).prune()
+            else:
+                pruned = getattr(docker_client, kind).prune(filters={"dangling": False})
+    except requests.exceptions.ReadTimeout:
+        logging.warning(f"Timeout pruning {'' if dangling else 'all '}{kind}")
+        metrics.docker_api_timeouts.labels(operation).inc()
+        # Delay longer after a timeout, which indicates that Docker is overworked
+        time.sleep(max(delay_seconds, 30))
+        return None
+
+    # pruned looks like:
+    # {
+    #     "ImagesDeleted": [
+    #         {"Deleted": "sha256:5611ea8655"},
+    #     ],
+    #     "SpaceReclaimed": 4563228463,
+    # }
+    # with None instead of an empty list when there was nothing to delete
+    deleted = pruned[f"{kind.title()}Deleted"] or []
+    return len(deleted), pruned["SpaceReclaimed"]
+
+
+def prune_build_cache(docker_client, delay_seconds, keep_storage=0, until=""):
+    """
+    Prune the BuildKit build cache
+
+    Keeps the most recently used `keep_storage` bytes of cache,
+    and cache used more recently than `until` (e.g. "24h"), if set.
+
+    Returns (number of cache records deleted, bytes reclaimed),
+    or None after a timeout, or if the daemon can't prune build cache.
+    """
+    operation = "prune_build_cache"
+    kwargs = {}
+    if keep_storage:
+        kwargs["keep_storage"] = keep_storage
+    if until:
+        kwargs["filters"] = {"until": until}
+    try:
+        # docker_client.api.prune_builds: https://docker-py.readthedocs.io/en/stable/api.html#docker.api.build.BuildApiMixin.prune_builds
+        with metrics.docker_api_latency.labels(operation).time():
+            pruned = docker_client.api.prune_builds(**kwargs)
+    except requests.exceptions.ReadTimeout:
+        logging.warning("Timeout pruning build cache")
+        metrics.docker_api_timeouts.labels(operation).inc()
+        time.sleep(max(delay_seconds, 30))
+        return None
+    except docker.errors.DockerException as e:
+        # e.g. keep-storage and filters need API 1.39
+        logging.warning(f"Not pruning build cache: {e}")
+        return None
+
+    # pruned looks like:
+    # {
+    #     "CachesDeleted": ["ndlpt0hhvkqcdfkputsk4cq9c"],
+    #     "SpaceReclaimed": 4563228463,
+    # }
+    deleted = pruned.get("CachesDeleted") or []
+    return len(deleted), pruned.get("SpaceReclaimed") or 0
+
+
+def daemon_load(docker_client, ping_timeout, build_label=""):
+    """
+    How busy the docker daemon is, before starting GC
+
+    Returns (seconds to answer a ping, running containers labelled `build_label`).
+    A ping taking longer than `ping_timeout`, or failing, counts as taking forever.
+    Builds aren't counted (0) without `build_label`.
+    """
+    tic = time.perf_counter()
+    try:
+        # like docker_client.ping(), which can't take a shorter timeout than other requests
+        # docker_client.api is a requests.Session
+        api = docker_client.api
+        with metrics.docker_api_latency.labels("ping").time():
+            api.get(f"{api.base_url}/_ping", timeout=ping_timeout).raise_for_status()
+        ping_seconds = time.perf_counter() - tic
+    except requests.exceptions.ReadTimeout:
+        metrics.docker_api_timeouts.labels("ping").inc()
+        ping_seconds = math.inf
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Error pinging the docker daemon: {e}")
+        ping_seconds = math.inf
+    builds = 0
+    if build_label:
+        # sparse, without inspecting each container
+        builds = len(
+            docker_client.containers.list(filters={"label": build_label}, sparse=True)
+        )
+    return ping_seconds, builds
+
+
+def record_deleted(kind, n_deleted, deleted_bytes, duration):
+    """Log and record metrics for deleting `kind` (containers, build_cache or images)"""
+    logging.info(
+        f"Deleted {n_deleted} {kind.replace('_', ' ')}, freed {deleted_bytes / GB:.2f}GB in {duration:.0f} seconds."
+    )
+    metrics.prune_duration.labels(kind).observe(duration)
+    metrics.deleted.labels(kind).inc(n_deleted)
+    metrics.reclaimed_bytes.labels(kind).inc(deleted_bytes)
+
+
+async def in_executor(func, *args, **kwargs):
+    """
+    Run a blocking function in the event loop's default executor
+
+    It runs in a copy of the current context,
+    so spans it starts belong to the current span.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, func, *args, **kwargs))
+
+
+def measure_usage(get_used, path):
+    """Call get_used(path), recording how long it takes"""
+    with tracing.span("measure_usage"), metrics.scan_duration.time():
+        return get_used(path)
+
+
+def recover_cordon(kube, node):
+    """
+    Uncordon the node if we left it cordoned
+
+    e.g. after a crash, or when uncordoning failed.
+    Errors are logged, not raised, since this runs on every check.
+    """
+    try:
+        with tracing.span("recover_cordon"):
+            node_info = kube.read_node(node)
+            annotations = node_info.metadata.annotations or {}
+            if node_info.spec.unschedulable and annotations.get(annotation_key):
+                logging.warning(
+                    f"Node {node} still cordoned, possibly leftover from earlier crash of image-cleaner"
+                )
+                uncordon(kube, node)
+    except Exception as e:
+        logging.warning(f"Error checking if node {node} is cordoned: {e}")
+
+
+def start_pod_images(kube, node):
+    """
+    Start keeping track of the images pods on `node` use
+
+    Returns a pods.PodImages, or None if we aren't allowed to list pods,
+    e.g. with RBAC from before pods were protected, which only allows
+    getting and patching nodes. Images of pods are then not protected.
+    """
+    pod_images = PodImages(kube, node)
+    try:
+        pod_images.start()
+    except api_error(kube) as e:
+        logging.warning(
+            f"Not keeping images used by pods on node {node}, can't list its pods: {e}"
+        )
+        return None
+    return pod_images
+
+
+async def sleep_until_next_check(scheduler, wake=None):
+    """
+    Sleep for the interval chosen by a scheduler.PollScheduler
+
+    or until `wake`, an asyncio.Event, is set, e.g. to reserve space.
+    """
+    interval = scheduler.next_interval()
+    time_to_threshold = scheduler.time_to_threshold()
+    if time_to_threshold is not None:
+        logging.info(
+            f"Threshold projected to be reached in {time_to_threshold:.0f} seconds"
+        )
+    if interval != scheduler.interval:
+        logging.info(f"Checking again in {interval:.0f} seconds")
+    if wake is None:
+        await asyncio.sleep(interval)
+        return
+    try:
+        await asyncio.wait_for(wake.wait(), interval)
+    except asyncio.TimeoutError:
+        pass
+    wake.clear()
+
+
+@asynccontextmanager
+async def cordoned(kube, node):
+    """
+    Async context manager for cordoning a node
+
+    The node is uncordoned on the way out, including when cancelled.
+    """
+    tic = time.perf_counter()
     try:
-        cordon(kube, node)
+        with tracing.span("cordon"):
+            await in_executor(cordon, kube, node)
+        metrics.cordoned.set(1)
         yield
     finally:
-        uncordon(kube, node)
+        with tracing.span("uncordon"):
+            await in_executor(uncordon, kube, node)
+        duration = time.perf_counter() - tic
+        logging.info(f"Node {node} was cordoned for {duration:.0f} seconds")
+        metrics.cordoned.set(0)
+        metrics.cordoned_seconds.inc(duration)
+        metrics.cordon_duration.observe(duration)
+
+
+async def renew_slot(slots, slot):
+    """Renew a GC slot in the background, while we hold it"""
+    while True:
+        await asyncio.sleep(slots.lease_seconds / 3)
+        try:
+            if not await in_executor(slots.renew, slot):
+                logging.warning(f"Lost GC slot {slot}")
+                return
+        except Exception as e:
+            logging.warning(f"Error renewing GC slot {slot}: {e}")
+
+
+@asynccontextmanager
+async def gc_slot(slots, priority):
+    """
+    Async context manager for holding one of the cluster's GC slots
+
+    `slots` is a leases.GCSlots, `priority` how full the node is.
+    Waits until a slot is taken, and renews it until released.
+    If it can't be released, it is freed once its lease expires.
+    Without `slots`, there is no limit, and nothing to wait for.
+    """
+    if slots is None:
+        yield
+        return
+    retry_seconds = min(10, slots.lease_seconds / 3)
+    tic = time.perf_counter()
+    slot = None
+    try:
+        with tracing.span("gc_slot", priority=priority) as trace:
+            while slot is None:
+                try:
+                    slot = await in_executor(slots.try_acquire, priority)
+                except Exception as e:
+                    logging.warning(f"Error taking a GC slot: {e}")
+                if slot is None:
+                    logging.info(
+                        f"Waiting for one of {slots.slots} GC slots, with priority {priority:.2f}"
+                    )
+                    await asyncio.sleep(retry_seconds)
+            trace["slot"] = slot
+    except asyncio.CancelledError:
+        await in_executor(slots.stop_waiting)
+        raise
+    duration = time.perf_counter() - tic
+    logging.info(f"Took GC slot {slot} after {duration:.0f} seconds")
+    metrics.gc_slot_wait.observe(duration)
+    renewing = asyncio.ensure_future(renew_slot(slots, slot))
+    try:
+        yield
+    finally:
+        renewing.cancel()
+        try:
+            await in_executor(slots.release, slot)
+        except Exception as e:
+            logging.warning(
+                f"Error releasing GC slot {slot}, leaving it to expire: {e}"
+            )
+
+
+@asynccontextmanager
+async def not_cordoned():
+    """Async context manager for not cordoning, when there's no node to cordon"""
+    yield
 
 
 def main():
-    node = os.getenv("DOCKER_IMAGE_CLEANER_NODE_NAME")
-    if node:
+    """Run the cleaner, until SIGTERM or SIGINT"""
+    asyncio.run(async_main())
+
+
+def kubernetes_api_client():
+    """An ApiClient of the full kubernetes client, in or out of the cluster"""
+    import kubernetes.client
+    import kubernetes.config
+
+    try:
+        kubernetes.config.load_incluster_config()
+    except Exception:
+        kubernetes.config.load_kube_config()
+    return kubernetes.client.ApiClient()
+
+
+def make_kube_client(kind):
+    """
+    A client for the few kubernetes API calls we make on our node
+
+    "kubernetes" is the full kubernetes client,
+    "minimal" a kube.KubeClient, only imported and used in the cluster,
+    which starts faster and uses less memory.
+    """
+    if kind == "minimal":
+        return KubeClient.from_incluster()
+    elif kind == "kubernetes":
         import kubernetes.client
-        import kubernetes.config
 
-        try:
-            kubernetes.config.load_incluster_config()
-        except Exception:
-            kubernetes.config.load_kube_config()
-        kube = kubernetes.client.CoreV1Api()
+        return kubernetes.client.CoreV1Api(kubernetes_api_client())
+    raise ValueError(
+        f"DOCKER_IMAGE_CLEANER_KUBE_CLIENT must be 'kubernetes' or 'minimal', got '{kind}'"
+    )
+
+
+async def async_main():
+    node = os.getenv("DOCKER_IMAGE_CLEANER_NODE_NAME")
+    kube_client = os.getenv("DOCKER_IMAGE_CLEANER_KUBE_CLIENT", "kubernetes")
+    if node:
+        kube = make_kube_client(kube_client)
         # verify that we can talk to the node
-        node_info = kube.read_node(node)
+        kube.read_node(node)
         # recover from possible crash!
-        if node_info.spec.unschedulable and node_info.metadata.annotations.get(
-            annotation_key
-        ):
-            logging.warning(
-                f"Node {node} still cordoned, possibly leftover from earlier crash of image-cleaner"
-            )
-            uncordon(kube, node)
+        recover_cordon(kube, node)
 
         cordon_context = partial(cordoned, kube, node)
+        # never delete images that pods on the node use, or are about to
+        pod_images = start_pod_images(kube, node)
     else:
-        cordon_context = nullcontext
+        kube = None
+        cordon_context = not_cordoned
+        pod_images = None
 
     path_to_check = os.getenv("DOCKER_IMAGE_CLEANER_PATH_TO_CHECK", "/var/lib/docker")
     interval_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_INTERVAL_SECONDS", "300"))
+    min_interval_seconds = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_MIN_INTERVAL_SECONDS", str(interval_seconds))
+    )
+    max_interval_seconds = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_MAX_INTERVAL_SECONDS", str(interval_seconds))
+    )
     delay_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_DELAY_SECONDS", "1"))
     threshold_type = os.getenv("DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE", "relative")
     threshold_high = float(os.getenv("DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH", "80"))
+    threshold_low = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_THRESHOLD_LOW", str(threshold_high))
+    )
+    # usage above which GC isn't put off for a busy daemon
+    threshold_emergency = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_THRESHOLD_EMERGENCY", str(threshold_high))
+    )
+    busy_ping_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_BUSY_PING_SECONDS", "1"))
+    build_label = os.getenv("DOCKER_IMAGE_CLEANER_BUILD_LABEL", "")
+    busy_builds = int(os.getenv("DOCKER_IMAGE_CLEANER_BUSY_BUILDS", "1"))
+    policy = os.getenv("DOCKER_IMAGE_CLEANER_POLICY", "prune")
+    last_used_path = os.getenv("DOCKER_IMAGE_CLEANER_LAST_USED_PATH", "")
+    max_concurrency = int(os.getenv("DOCKER_IMAGE_CLEANER_MAX_CONCURRENCY", "4"))
+    target_latency = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_TARGET_LATENCY_SECONDS", "5")
+    )
     timeout_seconds = int(os.getenv("DOCKER_IMAGE_CLEANER_TIMEOUT_SECONDS", "300"))
+    metrics_port = os.getenv("DOCKER_IMAGE_CLEANER_METRICS_PORT", "")
+    scan_workers = int(os.getenv("DOCKER_IMAGE_CLEANER_SCAN_WORKERS", "4"))
+    size_cache_path = os.getenv("DOCKER_IMAGE_CLEANER_SIZE_CACHE_PATH", "")
+    df_ttl_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_DF_TTL_SECONDS", "60"))
+    estimate_max_error = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_ESTIMATE_MAX_ERROR", "0")
+    )
+    estimate_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_ESTIMATE_SECONDS", "30"))
+    image_index_path = os.getenv("DOCKER_IMAGE_CLEANER_IMAGE_INDEX_PATH", "")
+    cordon_min_images = int(os.getenv("DOCKER_IMAGE_CLEANER_CORDON_MIN_IMAGES", "1"))
+    prune_build_cache_enabled = os.getenv(
+        "DOCKER_IMAGE_CLEANER_PRUNE_BUILD_CACHE", "true"
+    ).lower() in ("true", "1", "yes")
+    build_cache_keep_storage = int(
+        os.getenv("DOCKER_IMAGE_CLEANER_BUILD_CACHE_KEEP_STORAGE", "0")
+    )
+    build_cache_until = os.getenv("DOCKER_IMAGE_CLEANER_BUILD_CACHE_UNTIL", "")
+    batch_size = int(os.getenv("DOCKER_IMAGE_CLEANER_BATCH_SIZE", "20"))
+    checkpoint_path = os.getenv("DOCKER_IMAGE_CLEANER_CHECKPOINT_PATH", "")
+    prune_until = os.getenv("DOCKER_IMAGE_CLEANER_PRUNE_UNTIL", "")
+    max_cordoned_nodes = int(os.getenv("DOCKER_IMAGE_CLEANER_MAX_CORDONED_NODES", "0"))
+    lease_namespace = os.getenv(
+        "DOCKER_IMAGE_CLEANER_LEASE_NAMESPACE", current_namespace()
+    )
+    lease_seconds = int(os.getenv("DOCKER_IMAGE_CLEANER_LEASE_SECONDS", "60"))
+    # images to pull again after GC, highest priority first
+    rewarm_images = os.getenv("DOCKER_IMAGE_CLEANER_REWARM_IMAGES", "")
+    rewarm_concurrency = int(os.getenv("DOCKER_IMAGE_CLEANER_REWARM_CONCURRENCY", "2"))
+    rewarm_seconds = float(os.getenv("DOCKER_IMAGE_CLEANER_REWARM_SECONDS", "600"))
+    rewarm_max_bytes = int(os.getenv("DOCKER_IMAGE_CLEANER_REWARM_MAX_BYTES", "0"))
+    # serve POST /reserve, for builds to ask for free space (off if unset)
+    reserve_port = os.getenv("DOCKER_IMAGE_CLEANER_RESERVE_PORT", "")
+    reserve_address = os.getenv("DOCKER_IMAGE_CLEANER_RESERVE_ADDRESS", "127.0.0.1")
+    reserve_max_timeout = float(
+        os.getenv("DOCKER_IMAGE_CLEANER_RESERVE_MAX_SECONDS", "600")
+    )
+    # JSON lines of spans for each check's phases, "-" for stdout
+    trace_path = os.getenv("DOCKER_IMAGE_CLEANER_TRACE_PATH", "")
+    # CPU profile of the first GC cycle, for pstats or snakeviz
+    profile_path = os.getenv("DOCKER_IMAGE_CLEANER_PROFILE_PATH", "")
 
     logging.info("Starting docker image cleaning with the following settings:")
     logging.info(f"DOCKER_IMAGE_CLEANER_PATH_TO_CHECK={path_to_check}")
     logging.info(f"DOCKER_IMAGE_CLEANER_INTERVAL_SECONDS={interval_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_MIN_INTERVAL_SECONDS={min_interval_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_MAX_INTERVAL_SECONDS={max_interval_seconds}")
     logging.info(f"DOCKER_IMAGE_CLEANER_DELAY_SECONDS={delay_seconds}")
     logging.info(f"DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE={threshold_type}")
     logging.info(f"DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH={threshold_high}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_THRESHOLD_LOW={threshold_low}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_THRESHOLD_EMERGENCY={threshold_emergency}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_BUSY_PING_SECONDS={busy_ping_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_BUILD_LABEL={build_label}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_BUSY_BUILDS={busy_builds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_POLICY={policy}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_LAST_USED_PATH={last_used_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_MAX_CONCURRENCY={max_concurrency}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_TARGET_LATENCY_SECONDS={target_latency}")
     logging.info(f"DOCKER_IMAGE_CLEANER_TIMEOUT_SECONDS={timeout_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_METRICS_PORT={metrics_port}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_SCAN_WORKERS={scan_workers}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_SIZE_CACHE_PATH={size_cache_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_DF_TTL_SECONDS={df_ttl_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_ESTIMATE_MAX_ERROR={estimate_max_error}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_ESTIMATE_SECONDS={estimate_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_IMAGE_INDEX_PATH={image_index_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_CORDON_MIN_IMAGES={cordon_min_images}")
+    logging.info(
+        f"DOCKER_IMAGE_CLEANER_PRUNE_BUILD_CACHE={str(prune_build_cache_enabled).lower()}"
+    )
+    logging.info(
+        f"DOCKER_IMAGE_CLEANER_BUILD_CACHE_KEEP_STORAGE={build_cache_keep_storage}"
+    )
+    logging.info(f"DOCKER_IMAGE_CLEANER_BUILD_CACHE_UNTIL={build_cache_until}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_BATCH_SIZE={batch_size}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_CHECKPOINT_PATH={checkpoint_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_PRUNE_UNTIL={prune_until}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_MAX_CORDONED_NODES={max_cordoned_nodes}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_LEASE_NAMESPACE={lease_namespace}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_LEASE_SECONDS={lease_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_REWARM_IMAGES={rewarm_images}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_REWARM_CONCURRENCY={rewarm_concurrency}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_REWARM_SECONDS={rewarm_seconds}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_REWARM_MAX_BYTES={rewarm_max_bytes}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_RESERVE_PORT={reserve_port}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_RESERVE_ADDRESS={reserve_address}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_RESERVE_MAX_SECONDS={reserve_max_timeout}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_TRACE_PATH={trace_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_PROFILE_PATH={profile_path}")
+    logging.info(f"DOCKER_IMAGE_CLEANER_KUBE_CLIENT={kube_client}")
+
+    tracing.configure(trace_path)
+
+    gc_slots = None
+    if kube is not None and max_cordoned_nodes:
+        import kubernetes.client
+
+        # Leases are only implemented by the full client
+        if isinstance(kube, KubeClient):
+            api_client = kubernetes_api_client()
+        else:
+            api_client = kube.api_client
+        # cordon at most this many nodes at a time, cluster-wide
+        gc_slots = GCSlots(
+            kubernetes.client.CoordinationV1Api(api_client),
+            lease_namespace,
+            node,
+            slots=max_cordoned_nodes,
+            lease_seconds=lease_seconds,
+        )
 
     docker_client = docker.from_env(version="auto", timeout=timeout_seconds)
+    # images, kept up to date from docker events,
+    # so listing them doesn't inspect every image every time
+    image_index = ImageIndex(path=image_index_path or None)
+    image_index.start(docker_client)
 
     # with the threshold type set to relative the thresholds are interpreted
     # as a percentage of how full the partition is. In absolute mode the
     # thresholds are interpreted as size in bytes. By default you should use
     # "relative" mode. Use "absolute" mode when you are using DIND and your
-    # nodes only have one partition.
+    # nodes only have one partition. "docker" mode also interprets thresholds
+    # as bytes, but asks the docker daemon how much it uses instead of
+    # walking the filesystem, so it works without mounting /var/lib/docker.
+    disk_usage = None
+    inode_cache = None
     if threshold_type == "relative":
         get_used = get_used_percent
+        # when inodes are fuller than blocks, images are chosen by the inodes they free
+        inode_cache = LayerInodeCache(path_to_check, workers=scan_workers)
         used_msg = "{used:.1f}% used"
         threshold_s = f"{threshold_high}% inodes or blocks"
-    elif threshold_type == "absolute":
-        get_used = get_absolute_size
+    elif threshold_type in ("absolute", "docker"):
+        if threshold_type == "absolute":
+            # committed layers never change, only rescan new and mutable ones
+            size_cache = LayerSizeCache(path_to_check, path=size_cache_path or None)
+            # with a maximum error, usage is estimated by sampling,
+            # exact only when too close to threshold_high to tell
+            get_used = partial(
+                get_absolute_size,
+                workers=scan_workers,
+                cache=size_cache,
+                threshold=threshold_high,
+                max_error=estimate_max_error,
+                time_budget=estimate_seconds,
+            )
+        else:
+            disk_usage = DockerDiskUsage(docker_client, ttl=df_ttl_seconds)
+            get_used = partial(get_docker_size, disk_usage)
         used_msg = "{used:.2f}GB used"
         threshold_s = f"{threshold_high / GB:.2f}GB"
         if threshold_high < GB:
@@ -169,113 +1132,528 @@ def main():
             )
         # units in GB
         threshold_high = threshold_high / GB
+        threshold_low = threshold_low / GB
+        threshold_emergency = threshold_emergency / GB
     else:
         raise ValueError(
-            f"DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE must be 'relative' or 'absolute', got '{threshold_type}'"
+            f"DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE must be 'relative', 'absolute' or 'docker', got '{threshold_type}'"
         )
 
-    logging.info(f"Pruning docker images when {path_to_check} has {threshold_s} used")
+    if threshold_low > threshold_high:
+        raise ValueError(
+            f"DOCKER_IMAGE_CLEANER_THRESHOLD_LOW ({threshold_low}) must not be above DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH ({threshold_high})"
+        )
 
-    while True:
-        used = get_used(path_to_check)
-        logging.info(used_msg.format(used=used))
-        if used < threshold_high:
-            # Do nothing! We have enough space
-            time.sleep(interval_seconds)
-            continue
-
-        images = docker_client.images.list(all=True)
-        if not images:
-            logging.info("No images to delete")
-            time.sleep(interval_seconds)
-            continue
+    if threshold_emergency < threshold_high:
+        raise ValueError(
+            f"DOCKER_IMAGE_CLEANER_THRESHOLD_EMERGENCY ({threshold_emergency}) must not be below DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH ({threshold_high})"
+        )
+
+    # images are removed in batches, with progress checkpointed after each one,
+    # so a timeout or crash loses at most one batch.
+    # Between batches, docker mode asks the daemon for usage again.
+    # Relative mode already rechecks after each removal,
+    # absolute mode estimates, since scanning is expensive.
+    checkpoint = Checkpoint(path=checkpoint_path or None)
+    recheck = None
+    if disk_usage is not None:
+        recheck = partial(recheck_docker_size, disk_usage)
+
+    # with the "prune" policy, all unused images are removed when removing
+    # dangling images isn't enough. With the "lru" policy, images are removed
+    # one at a time, least recently used first, until usage drops below
+    # threshold_low, so frequently used images stay on the node. The "layers"
+    # policy removes the fewest images that free enough space, taking layers
+    # shared between images into account.
+    last_used = None
+    if policy == "lru":
+        last_used = LastUsed(path=last_used_path or None)
+        last_used.start(docker_client)
+    elif policy not in POLICIES:
+        raise ValueError(
+            f"DOCKER_IMAGE_CLEANER_POLICY must be one of {', '.join(POLICIES)}, got '{policy}'"
+        )
+    # with the "prune" policy, unused images can be removed in steps instead,
+    # pulled longest ago first, e.g. more than 7d ago, then 72h, then 24h,
+    # stopping once usage is below threshold_low, so recently pulled images,
+    # the most likely to be used again, stay unless that's not enough
+    until = {parse_age(age): age.strip() for age in prune_until.split(",") if age}
+
+    # after GC, hot images that were removed are pulled again in the background,
+    # so the next pods to use them don't wait for the pull,
+    # stopping before usage gets back near threshold_high
+    rewarmer = None
+    if rewarm_images:
+        rewarmer = Rewarmer(
+            docker_client,
+            parse_refs(rewarm_images),
+            max_concurrency=rewarm_concurrency,
+            time_budget=rewarm_seconds,
+            max_bytes=rewarm_max_bytes,
+        )
+        if threshold_type == "relative":
+            rewarm_get_used = partial(get_used, path_to_check)
+        elif recheck is not None:
+            rewarm_get_used = partial(recheck, path_to_check)
         else:
-            logging.info(f"{len(images)} images available to prune")
+            # scanning is too expensive, add the size of each image pulled
+            rewarm_get_used = None
 
-        # Ensure the node is cordoned while we prune
-        with cordon_context():
-            for kind in ("containers", "images"):
-                key = f"{kind.title()}Deleted"
-                tic = time.perf_counter()
-                try:
-                    # docker_client.containers.prune: https://docker-py.readthedocs.io/en/stable/containers.html#docker.models.containers.ContainerCollection.prune
-                    # docker_client.images.prune: https://docker-py.readthedocs.io/en/stable/images.html#docker.models.images.ImageCollection.prune
-                    pruned = getattr(docker_client, kind).prune()
-                except requests.exceptions.ReadTimeout:
-                    logging.warning(f"Timeout pruning {kind}")
-                    # Delay longer after a timeout, which indicates that Docker is overworked
-                    time.sleep(max(delay_seconds, 30))
+    logging.info(f"Pruning docker images when {path_to_check} has {threshold_s} used")
+    if threshold_type == "relative":
+        metrics.threshold_high.set(threshold_high)
+    else:
+        metrics.threshold_high.set(threshold_high * GB)
+    if metrics_port:
+        metrics.start_metrics_server(int(metrics_port))
+
+    # check more often when the disk is filling up fast,
+    # less often when it isn't filling up at all
+    scheduler = PollScheduler(
+        threshold_high,
+        interval_seconds,
+        min_interval=min_interval_seconds,
+        max_interval=max_interval_seconds,
+    )
+
+    # on SIGTERM (e.g. the pod is deleted), cancel the loop,
+    # which uncordons the node on the way out if it is cordoned
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    profiler = tracing.Profiler(profile_path, loop)
+
+    # builds can ask for free space, waking the loop for a check right away
+    reservations = None
+    wake = None
+    if reserve_port:
+        wake = asyncio.Event()
+        reservations = Reservations(loop, wake, max_timeout=reserve_max_timeout)
+        serve_reservations(reservations, int(reserve_port), reserve_address)
+
+    stopping = False
+    # set on SIGTERM, so removing images in a worker thread stops
+    # before the node is uncordoned, instead of going on until done
+    stop_removing = threading.Event()
+
+    def stop(signame):
+        nonlocal stopping
+        if stopping:
+            # don't interrupt uncordoning with repeated signals
+            logging.info(f"Received {signame}, already stopping")
+            return
+        logging.info(f"Received {signame}, stopping")
+        stopping = True
+        stop_removing.set()
+        task.cancel()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop, sig.name)
+
+    try:
+        cycle = 0
+        used = None
+        while True:
+            if cycle:
+                if reservations is not None:
+                    # answer the requests the last check served
+                    reservations.finish(
+                        get_free_bytes(
+                            used, threshold_high, threshold_type, path_to_check
+                        )
+                    )
+                await sleep_until_next_check(scheduler, wake)
+            cycle += 1
+            # each check is traced as a "cycle" span, with spans for its phases,
+            # and the first one that collects garbage can be profiled
+            with tracing.span("cycle", cycle=cycle) as trace, profiler.cycle(trace):
+                if last_used is not None:
+                    await in_executor(last_used.save)
+                # measuring usage, listing images and checking the node
+                # are independent, run them at the same time
+                checks = [in_executor(measure_usage, get_used, path_to_check)]
+                if kube is not None:
+                    checks.append(in_executor(recover_cordon, kube, node))
+                used = (await asyncio.gather(*checks))[0]
+                logging.info(used_msg.format(used=used))
+                if threshold_type == "relative":
+                    metrics.observe_usage(path_to_check, percent=used)
+                else:
+                    metrics.observe_usage(path_to_check, nbytes=used * GB)
+                scheduler.record(used)
+                # thresholds of this check, lower to free space reserved by builds
+                high, low = threshold_high, threshold_low
+                reserved_bytes = 0
+                if reservations is not None:
+                    reserved_bytes, n_requests = reservations.begin()
+                if reserved_bytes:
+                    reserve_threshold = get_reserve_threshold(
+                        reserved_bytes, threshold_high, threshold_type, path_to_check
+                    )
+                    high = min(high, reserve_threshold)
+                    low = min(low, reserve_threshold)
+                    logging.info(
+                        f"{n_requests} requests to reserve up to "
+                        f"{reserved_bytes / GB:.2f}GB, collecting garbage above "
+                        + used_msg.format(used=high)
+                    )
+                    trace["reserved_bytes"] = reserved_bytes
+                if not needs_gc(used, high):
+                    # Do nothing! We have enough space
                     continue
 
-                deleted = pruned[key]
-                # pruned looks like:
-                # {
-                #     "ImagesDeleted": [
-                #         {"Deleted": "sha256:5611ea8655"},
-                #     ],
-                #     "SpaceReclaimed": 4563228463,
-                # }
-
-                deleted_bytes = pruned["SpaceReclaimed"]
-                deleted_gb = deleted_bytes / GB
-                if deleted is None:
-                    # returns None instead of empty list when nothing to delete
-                    n_deleted = 0
+                if rewarmer is not None:
+                    # don't pull while collecting garbage
+                    await in_executor(rewarmer.stop)
+                if used < threshold_emergency and not reserved_bytes:
+                    # GC competes with builds for the daemon's locks and the disk,
+                    # put it off while the daemon is busy, until usage is critical
+                    with tracing.span("daemon_load") as load_trace:
+                        ping_seconds, builds = await in_executor(
+                            daemon_load, docker_client, busy_ping_seconds, build_label
+                        )
+                        busy = ping_seconds >= busy_ping_seconds or (
+                            bool(build_label) and builds >= busy_builds
+                        )
+                        deferred = should_defer(used, threshold_emergency, busy)
+                        load_trace.update(
+                            ping_seconds=ping_seconds, builds=builds, deferred=deferred
+                        )
+                    metrics.build_containers.set(builds)
+                    if deferred:
+                        logging.info(
+                            f"Putting off GC, the docker daemon is busy: ping took "
+                            f"{ping_seconds:.2f}s, {builds} builds running"
+                        )
+                        metrics.gc_deferred.inc()
+                        continue
+
+                metrics.gc_runs.inc()
+                # which resource triggered GC: blocks or inodes in relative mode
+                if threshold_type == "relative":
+                    usage = get_usage_percent(path_to_check)
+                    resource = max(usage, key=usage.get)
+                    logging.info(
+                        f"GC triggered by {resource}: {usage['blocks']:.1f}% blocks, "
+                        f"{usage['inodes']:.1f}% inodes used"
+                    )
+                else:
+                    resource = "bytes"
+                metrics.gc_triggers.labels(resource).inc()
+                trace["resource"] = resource
+                n_images = image_index.count()
+                if not n_images:
+                    logging.info("No images to delete")
+                    continue
                 else:
-                    n_deleted = len(deleted)
+                    logging.info(f"{n_images} images available to prune")
+                # only GC cycles are worth profiling
+                trace["gc"] = True
 
-                # first prune only removes dangling images
-                # check if it deleted enough, or if we should continue pruning all images
+                # Stopped containers, build cache and dangling images can't be used
+                # by new pods, so they are deleted, and the other images to remove
+                # are planned, without cordoning the node.
+                # Only removing images that pods could start using again is cordoned.
+                kinds = ["containers", "images"]
+                if prune_build_cache_enabled:
+                    # build cache is cheaper to lose than any image, prune it first
+                    kinds.insert(1, "build_cache")
                 prune_all_images = False
-                if kind == "images":
-                    if not deleted:
-                        # found no dangling images to prune,
-                        # no need to check space again
-                        prune_all_images = True
+                # what pruning build cache and dangling images freed,
+                # counted towards getting below threshold_low
+                n_reclaimed = reclaimed_bytes = 0
+                for kind in kinds:
+                    if (
+                        disk_usage is not None
+                        and kind in ("containers", "build_cache")
+                        and not (await in_executor(disk_usage.get))[kind][
+                            "reclaimable_count"
+                        ]
+                    ):
+                        # the daemon told us there is nothing to prune
+                        logging.info(f"No {kind.replace('_', ' ')} to prune")
+                        continue
+                    tic = time.perf_counter()
+                    with tracing.span(f"prune_{kind}") as prune_trace:
+                        if kind == "build_cache":
+                            pruned = await in_executor(
+                                prune_build_cache,
+                                docker_client,
+                                delay_seconds,
+                                keep_storage=build_cache_keep_storage,
+                                until=build_cache_until,
+                            )
+                        else:
+                            pruned = await in_executor(
+                                prune, docker_client, kind, delay_seconds
+                            )
+                        if pruned is not None:
+                            prune_trace["deleted"], prune_trace["bytes"] = pruned
+                    if pruned is None:
+                        continue
+                    n_deleted, deleted_bytes = pruned
+                    record_deleted(
+                        kind, n_deleted, deleted_bytes, time.perf_counter() - tic
+                    )
+                    if kind == "containers":
+                        continue
+                    n_reclaimed += n_deleted
+                    reclaimed_bytes += deleted_bytes
+
+                    if kind == "images":
+                        # first prune only removes dangling images
+                        # check if it deleted enough, or if we should continue pruning all images
+                        if n_reclaimed:
+                            # check used again after pruning build cache and dangling images
+                            # if nothing was deleted, no need to check space again
+                            logging.info(
+                                "Checking if pruning build cache and dangling images freed enough space"
+                            )
+                            if threshold_type in ("absolute", "docker"):
+                                # we can estimate change in absolute usage without calling get_used
+                                # absolute get_used is very expensive
+                                used -= reclaimed_bytes / GB
+                            else:
+                                # inode-based get_used is very cheap to recalculate
+                                used = await in_executor(get_used, path_to_check)
+                        prune_all_images = should_prune_all(n_reclaimed, used, low)
+                        dangling_msg = (
+                            f"Pruning {n_deleted} dangling images and build cache "
+                            f"freed only {reclaimed_bytes / GB:.2f}GB"
+                        )
+
+                if prune_all_images:
+                    with tracing.span("plan", policy=policy) as plan_trace:
+                        # plan, uncordoned
+                        # catch up with what pruning deleted, if events haven't yet
+                        with tracing.span("reconcile_index"):
+                            await in_executor(image_index.reconcile, docker_client)
+                        images = image_index.images(all=False)
+                        keep = set()
+                        if pod_images is not None:
+                            keep = {
+                                image.id
+                                for image in images
+                                if pod_images.protects(image)
+                            }
+                            logging.info(
+                                f"Keeping {len(keep)} images used by pods on node {node}"
+                            )
+                        # deleting big images with few files barely helps
+                        # when inodes run out, images are chosen by inodes instead
+                        # (except with the "lru" policy, which is about recency)
+                        by_inodes = resource == "inodes" and policy != "lru"
+                        if policy == "prune" or by_inodes:
+                            containers = await in_executor(
+                                docker_client.containers.list, all=True
+                            )
+                            in_use = {c.attrs["Image"] for c in containers}
+                            candidates = [
+                                image
+                                for image in images
+                                if image.id not in in_use and image.id not in keep
+                            ]
+                            # newest first, so images built on top of other images
+                            # are removed before the images they depend on
+                            candidates.sort(
+                                key=lambda image: image.attrs.get("Created") or "",
+                                reverse=True,
+                            )
+                            freed = None
+                            if by_inodes:
+                                need_inodes = get_inodes_to_free(low, path_to_check)
+                                candidates, freed_inodes = await in_executor(
+                                    plan_inode_removal,
+                                    images,
+                                    candidates,
+                                    need_inodes,
+                                    inode_cache,
+                                )
+                                logging.info(
+                                    f"{dangling_msg}, removing {len(candidates)} images to free "
+                                    f"{sum(freed_inodes.values())} of {need_inodes:.0f} inodes needed"
+                                )
+                            elif until:
+                                logging.info(
+                                    f"{dangling_msg}, removing up to {len(candidates)} unused images, "
+                                    "pulled longest ago first"
+                                )
+                            else:
+                                logging.info(
+                                    f"{dangling_msg}, removing _all_ {len(candidates)} unused images"
+                                )
+                        else:
+                            need_bytes = get_bytes_to_free(
+                                used, low, threshold_type, path_to_check
+                            )
+                            # freed bytes count only layers not shared with images we keep
+                            candidates, freed = await in_executor(
+                                plan_image_removal,
+                                docker_client,
+                                images,
+                                path_to_check,
+                                need_bytes,
+                                policy=policy,
+                                last_used=last_used,
+                                keep=keep,
+                            )
+                            if policy == "lru":
+                                logging.info(
+                                    f"{dangling_msg}, removing least recently used images"
+                                )
+                            else:
+                                logging.info(
+                                    f"{dangling_msg}, removing {len(candidates)} images to free "
+                                    f"{sum(freed.values()) / GB:.2f}GB of {need_bytes / GB:.2f}GB needed"
+                                )
+                        # continue a plan interrupted by a crash first
+                        candidates = checkpoint.resume(candidates)
+                        plan_trace["candidates"] = len(candidates)
+                        plan_trace["resource"] = resource
+                        if policy == "prune" and until:
+                            steps = age_steps(candidates, until)
+                            # removal stops below threshold_low, estimated from
+                            # layers freed in step order, as image sizes count
+                            # shared layers once per image
+                            graph, layer_sizes = await in_executor(
+                                get_layer_graph, images, path_to_check
+                            )
+                            freed = freed_in_order(
+                                graph,
+                                layer_sizes,
+                                [image.id for _, step, _ in steps for image in step],
+                            )
+                        else:
+                            # remove all candidates when pruning,
+                            # unless they were planned to free enough inodes
+                            # (with nothing to keep, in one prune request)
+                            steps = [
+                                (None, candidates, policy == "prune" and not by_inodes)
+                            ]
+                        plan_trace["steps"] = len(steps)
+                        prune_at_once = (
+                            policy == "prune"
+                            and not until
+                            and not by_inodes
+                            and not keep
+                        )
+
+                    # execute, cordoned unless the plan is too small to be worth it
+                    slots = None
+                    if len(candidates) >= cordon_min_images:
+                        context = cordon_context
+                        slots = gc_slots
                     else:
-                        # check used again after pruning dangling images
-                        # if dangling images didn't cross the threshold,
-                        # delete all images
                         logging.info(
-                            "Checking if pruning dangling images freed enough space"
+                            f"Not cordoning to remove {len(candidates)} images, "
+                            f"fewer than DOCKER_IMAGE_CLEANER_CORDON_MIN_IMAGES={cordon_min_images}"
                         )
-                        if threshold_type == "absolute":
-                            # we can estimate change in absolute usage without calling get_used
-                            # absolute get_used is very expensive
-                            used -= deleted_gb
+                        metrics.cordons_skipped.inc()
+                        context = not_cordoned
+                    # removals in progress count towards threshold_low,
+                    # by the bytes they are expected to free
+                    if threshold_type != "relative":
+                        unit = GB
+                    elif resource == "blocks":
+                        unit = get_percent_size(path_to_check)
+                    else:
+                        # inodes freed aren't known in bytes
+                        unit = None
+                    # the fullest nodes get GC slots first
+                    async with gc_slot(slots, used / high), context():
+                        if prune_at_once:
+                            # a single request, with nothing to keep, stop at or resume
+                            tic = time.perf_counter()
+                            with tracing.span("prune_all_images") as remove_trace:
+                                pruned = await in_executor(
+                                    prune,
+                                    docker_client,
+                                    "images",
+                                    delay_seconds,
+                                    dangling=False,
+                                )
+                                if pruned is not None:
+                                    (
+                                        remove_trace["deleted"],
+                                        remove_trace["bytes"],
+                                    ) = pruned
+                            removed = []
+                            if pruned is not None:
+                                n_deleted, deleted_bytes = pruned
+                                record_deleted(
+                                    "images",
+                                    n_deleted,
+                                    deleted_bytes,
+                                    time.perf_counter() - tic,
+                                )
+                                if threshold_type == "relative":
+                                    used = await in_executor(get_used, path_to_check)
+                                else:
+                                    used -= deleted_bytes / GB
                         else:
-                            # inode-based get_used is very cheap to recalculate
-                            used = get_used(path_to_check)
-                        prune_all_images = used > threshold_high
+                            # in batches, recording progress and metrics after each one
+                            with tracing.span(
+                                "remove_images", candidates=len(candidates)
+                            ) as remove_trace:
+                                removing = asyncio.ensure_future(
+                                    in_executor(
+                                        remove_in_steps,
+                                        docker_client,
+                                        steps,
+                                        partial(get_used, path_to_check),
+                                        used,
+                                        low,
+                                        delay_seconds,
+                                        checkpoint,
+                                        batch_size=batch_size,
+                                        recheck=recheck,
+                                        estimate=threshold_type != "relative",
+                                        freed=freed,
+                                        unit=unit,
+                                        cancel=stop_removing,
+                                        limit=AIMDLimit(
+                                            maximum=max_concurrency,
+                                            target_latency=target_latency,
+                                        ),
+                                    )
+                                )
+                                try:
+                                    removed, deleted_bytes, used = await asyncio.shield(
+                                        removing
+                                    )
+                                except asyncio.CancelledError:
+                                    # stopped, let removals in progress finish
+                                    # before uncordoning, no more will start
+                                    await removing
+                                    raise
+                                remove_trace["removed"] = len(removed)
+                                remove_trace["bytes"] = deleted_bytes
+                    if last_used is not None:
+                        for image in removed:
+                            last_used.forget(image)
 
-                if kind == "images" and prune_all_images:
-                    # Deleting dangling images didn't free enough
-                    logging.info(
-                        f"Pruning {n_deleted} dangling images freed only {deleted_gb:.2f}GB, pruning _all_ images"
+                if disk_usage is not None:
+                    # we deleted things, don't reuse usage from before pruning
+                    disk_usage.invalidate()
+                # in case we missed events about the images we deleted
+                with tracing.span("reconcile_index"):
+                    await in_executor(image_index.reconcile, docker_client)
+                if rewarmer is not None and not reserved_bytes:
+                    # not while builds are waiting for the space
+                    rewarmer.start(
+                        image_index.images(all=False),
+                        used,
+                        # leave room for pods to pull images before the next GC
+                        0.9 * threshold_high,
+                        get_used=rewarm_get_used,
                     )
-                    try:
-                        # prune again, this time with `dangling=False` filter,
-                        # which deletes _all_ images instead of just dangling ones
-                        pruned = docker_client.images.prune(filters={"dangling": False})
-                    except requests.exceptions.ReadTimeout:
-                        logging.warning("Timeout pruning all images")
-                        # Delay longer after a timeout, which indicates that Docker is overworked
-                        time.sleep(max(delay_seconds, 30))
-                        continue
-                    deleted = pruned[key]
-                    if deleted:
-                        n_deleted += len(deleted)
-                    # recalculate deleted gb
-                    deleted_bytes += pruned["SpaceReclaimed"]
-                    deleted_gb = deleted_bytes / GB
-
-                toc = time.perf_counter()
-                duration = toc - tic
-                logging.info(
-                    f"Deleted {n_deleted} {kind}, freed {deleted_gb:.2f}GB in {duration:.0f} seconds."
-                )
 
-        time.sleep(interval_seconds)
+                # usage dropped because we deleted things, not a sign of an idle disk
+                scheduler.reset()
+
+    except asyncio.CancelledError:
+        if rewarmer is not None:
+            rewarmer.stop(wait=False)
+        logging.info("Stopped")
 
 
 if __name__ == "__main__":
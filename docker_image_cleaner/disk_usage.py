@@ -0,0 +1,106 @@
+"""
+Disk usage as reported by the docker daemon
+
+Used by the "docker" threshold type,
+which asks the daemon's /system/df endpoint instead of walking
+/var/lib/docker, so /var/lib/docker doesn't need to be mounted.
+"""
+import time
+
+CATEGORIES = ("images", "containers", "volumes", "build_cache")
+
+
+def _category(size=0, reclaimable=0, count=0, reclaimable_count=0):
+    return {
+        "size": size,
+        "reclaimable": reclaimable,
+        "count": count,
+        "reclaimable_count": reclaimable_count,
+    }
+
+
+def summarize_df(df):
+    """
+    Summarize the response of /system/df by category
+
+    Returns a dict with the keys in CATEGORIES, each a dict with
+    size, reclaimable bytes, count of items and count of reclaimable items.
+
+    /system/df reference: https://docs.docker.com/engine/api/v1.43/#tag/System/operation/SystemDataUsage
+    """
+    usage = {}
+
+    images = df.get("Images") or []
+    # LayersSize counts layers shared between images once
+    usage["images"] = _category(size=df.get("LayersSize") or 0, count=len(images))
+    for image in images:
+        if image.get("Containers", 0) > 0:
+            continue
+        # SharedSize is -1 when it wasn't calculated
+        shared = max(image.get("SharedSize", 0), 0)
+        usage["images"]["reclaimable"] += image.get("Size", 0) - shared
+        usage["images"]["reclaimable_count"] += 1
+
+    usage["containers"] = _category()
+    for container in df.get("Containers") or []:
+        size = container.get("SizeRw") or 0
+        usage["containers"]["size"] += size
+        usage["containers"]["count"] += 1
+        if container.get("State") != "running":
+            usage["containers"]["reclaimable"] += size
+            usage["containers"]["reclaimable_count"] += 1
+
+    usage["volumes"] = _category()
+    for volume in df.get("Volumes") or []:
+        usage_data = volume.get("UsageData") or {}
+        # Size is -1 when it wasn't calculated
+        size = max(usage_data.get("Size", 0), 0)
+        usage["volumes"]["size"] += size
+        usage["volumes"]["count"] += 1
+        if usage_data.get("RefCount") == 0:
+            usage["volumes"]["reclaimable"] += size
+            usage["volumes"]["reclaimable_count"] += 1
+
+    usage["build_cache"] = _category()
+    for record in df.get("BuildCache") or []:
+        size = record.get("Size") or 0
+        usage["build_cache"]["size"] += size
+        usage["build_cache"]["count"] += 1
+        if not record.get("InUse"):
+            usage["build_cache"]["reclaimable"] += size
+            usage["build_cache"]["reclaimable_count"] += 1
+
+    return usage
+
+
+class DockerDiskUsage:
+    """
+    Disk usage from the docker daemon, cached for `ttl` seconds
+
+    so repeated checks within one GC cycle don't hit the daemon again.
+    """
+
+    def __init__(self, docker_client, ttl=60, clock=time.monotonic):
+        self.docker_client = docker_client
+        self.ttl = ttl
+        self.clock = clock
+        self._usage = None
+        self._fetched_at = None
+
+    def invalidate(self):
+        """Forget the cached usage, e.g. after deleting things"""
+        self._usage = None
+
+    def get(self):
+        """Return the usage by category, see summarize_df"""
+        now = self.clock()
+        if self._usage is None or now - self._fetched_at >= self.ttl:
+            # docker_client.df: https://docker-py.readthedocs.io/en/stable/client.html#docker.client.DockerClient.df
+            self._usage = summarize_df(self.docker_client.df())
+            self._fetched_at = now
+        return self._usage
+
+    def total(self):
+        """Total bytes used, in all categories"""
+        usage = self.get()
+        return sum(usage[kind]["size"] for kind in CATEGORIES)
@@ -0,0 +1,273 @@
+"""
+A local index of docker images, their tags, layers and sizes
+
+docker_client.images.list() inspects every image, one request each.
+Instead, the index is built once, stored in SQLite
+(e.g. on a hostPath, to survive restarts), and kept current
+from the docker events stream in a background thread.
+On (re)start, one image list request finds what changed,
+and only new images are inspected.
+
+Images from the index have the parts of the docker Image interface
+the cleaner uses: id, short_id, tags and attrs.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import docker
+
+from . import metrics
+
+# bump when the schema changes, the index is then rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    parent TEXT,
+    size INTEGER,
+    created TEXT,
+    last_tag_time TEXT,
+    layers TEXT
+);
+CREATE TABLE IF NOT EXISTS refs (
+    ref TEXT,
+    image_id TEXT,
+    kind TEXT,
+    PRIMARY KEY (ref, kind)
+);
+CREATE INDEX IF NOT EXISTS refs_image ON refs (image_id);
+"""
+
+# image events that may add an image or change its tags
+UPDATE_ACTIONS = {"pull", "tag", "untag", "import", "load", "build"}
+
+
+class IndexedImage:
+    """An image from the index, looking enough like a docker Image"""
+
+    def __init__(self, id, tags, digests, parent, size, created, last_tag_time, layers):
+        self.id = id
+        self.tags = tags
+        self.attrs = {
+            "Id": id,
+            "RepoTags": tags,
+            "RepoDigests": digests,
+            "Parent": parent,
+            "Size": size,
+            "Created": created,
+            "Metadata": {"LastTagTime": last_tag_time},
+            "RootFS": {"Type": "layers", "Layers": layers},
+        }
+
+    @property
+    def short_id(self):
+        if self.id.startswith("sha256:"):
+            return self.id[:19]
+        return self.id[:12]
+
+    def __repr__(self):
+        return f"<IndexedImage: {self.short_id} {self.tags}>"
+
+
+class ImageIndex:
+    """
+    Images on the docker daemon, in SQLite at `path` (default: in memory)
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ":memory:"
+        self._lock = threading.Lock()
+        # used from the events thread and executor threads, behind the lock
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            if version:
+                logging.info(f"Rebuilding image index {self.path} for a new schema")
+            self.db.executescript(
+                "DROP TABLE IF EXISTS images; DROP TABLE IF EXISTS refs;"
+            )
+        self.db.executescript(SCHEMA)
+        self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+
+    def count(self):
+        """Number of images, including intermediate images"""
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def ids(self):
+        with self._lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM images")}
+
+    def images(self, all=True):
+        """
+        Indexed images, like docker_client.images.list(all=all)
+
+        Without `all`, intermediate images (untagged parents of other images)
+        are left out.
+        """
+        with self._lock:
+            refs = {}
+            for ref, image_id, kind in self.db.execute(
+                "SELECT ref, image_id, kind FROM refs ORDER BY ref"
+            ):
+                refs.setdefault(image_id, {"tag": [], "digest": []})[kind].append(ref)
+            rows = self.db.execute(
+                "SELECT id, parent, size, created, last_tag_time, layers FROM images"
+            ).fetchall()
+        parents = {row[1] for row in rows if row[1]}
+        images = []
+        for image_id, parent, size, created, last_tag_time, layers in rows:
+            image_refs = refs.get(image_id, {"tag": [], "digest": []})
+            if not all and not image_refs["tag"] and image_id in parents:
+                continue
+            images.append(
+                IndexedImage(
+                    image_id,
+                    image_refs["tag"],
+                    image_refs["digest"],
+                    parent,
+                    size,
+                    created,
+                    last_tag_time,
+                    json.loads(layers),
+                )
+            )
+        return images
+
+    def _set_refs(self, image_id, kind, refs):
+        self.db.execute(
+            "DELETE FROM refs WHERE image_id = ? AND kind = ?", (image_id, kind)
+        )
+        for ref in refs:
+            # a tag moves from the image it was on
+            self.db.execute(
+                "INSERT OR REPLACE INTO refs (ref, image_id, kind) VALUES (?, ?, ?)",
+                (ref, image_id, kind),
+            )
+
+    def add(self, attrs):
+        """Add or update an image, from its docker inspect attrs"""
+        layers = (attrs.get("RootFS") or {}).get("Layers") or []
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO images "
+                "(id, parent, size, created, last_tag_time, layers) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    attrs["Id"],
+                    attrs.get("Parent") or "",
+                    attrs.get("Size", 0),
+                    attrs.get("Created"),
+                    (attrs.get("Metadata") or {}).get("LastTagTime"),
+                    json.dumps(layers),
+                ),
+            )
+            self._set_refs(attrs["Id"], "tag", attrs.get("RepoTags") or [])
+            self._set_refs(attrs["Id"], "digest", attrs.get("RepoDigests") or [])
+            self.db.commit()
+
+    def remove(self, image_id):
+        """Remove an image that was deleted"""
+        with self._lock:
+            self.db.execute("DELETE FROM images WHERE id = ?", (image_id,))
+            self.db.execute("DELETE FROM refs WHERE image_id = ?", (image_id,))
+            self.db.commit()
+
+    def update_image(self, docker_client, ref):
+        """Update an image by id or tag, by inspecting it"""
+        try:
+            attrs = docker_client.api.inspect_image(ref)
+        except docker.errors.ImageNotFound:
+            if ref.startswith("sha256:"):
+                self.remove(ref)
+            return
+        self.add(attrs)
+
+    def reconcile(self, docker_client):
+        """
+        Bring the index up to date with one image list request
+
+        Only images missing from the index are inspected.
+        Tags and sizes of known images are updated from the list.
+        """
+        tic = time.perf_counter()
+        # docker_client.api.images: https://docker-py.readthedocs.io/en/stable/api.html#docker.api.image.ImageApiMixin.images
+        with metrics.docker_api_latency.labels("list_images").time():
+            summaries = docker_client.api.images(all=True)
+        current = {summary["Id"]: summary for summary in summaries}
+        known = self.ids()
+        for image_id in known - set(current):
+            self.remove(image_id)
+        for image_id in set(current) - known:
+            self.update_image(docker_client, image_id)
+        updates = []
+        for image_id, summary in current.items():
+            if image_id not in known:
+                continue
+            tags = [t for t in summary.get("RepoTags") or [] if t != "<none>:<none>"]
+            digests = [
+                d for d in summary.get("RepoDigests") or [] if d != "<none>@<none>"
+            ]
+            updates.append((image_id, tags, digests, summary.get("Size", 0)))
+        with self._lock:
+            for image_id, tags, digests, size in updates:
+                self.db.execute(
+                    "UPDATE images SET size = ? WHERE id = ?", (size, image_id)
+                )
+                self._set_refs(image_id, "tag", tags)
+                self._set_refs(image_id, "digest", digests)
+            self.db.commit()
+        logging.info(
+            f"Indexed {len(current)} images ({len(set(current) - known)} new, "
+            f"{len(known - set(current))} gone) in {time.perf_counter() - tic:.1f}s"
+        )
+
+    def apply_event(self, docker_client, event):
+        """Apply an image event from docker_client.events"""
+        action = event.get("Action") or event.get("status")
+        ref = event.get("Actor", {}).get("ID") or event.get("id")
+        if not ref:
+            return
+        if action == "delete":
+            self.remove(ref)
+        elif action in UPDATE_ACTIONS:
+            self.update_image(docker_client, ref)
+
+    def follow_events(self, docker_client, since=None, retry_seconds=10):
+        """
+        Apply image events, forever
+
+        Reconnects if the event stream is interrupted,
+        replaying events since the last one we saw.
+        """
+        while True:
+            try:
+                # docker_client.events: https://docker-py.readthedocs.io/en/stable/client.html#docker.client.DockerClient.events
+                events = docker_client.events(
+                    since=since, decode=True, filters={"type": "image"}
+                )
+                for event in events:
+                    self.apply_event(docker_client, event)
+                    since = event.get("time", since)
+            except Exception as e:
+                logging.warning(f"Error following docker image events: {e}")
+            time.sleep(retry_seconds)
+
+    def start(self, docker_client):
+        """Reconcile the index, then follow image events in a background thread"""
+        # replay events that happen while reconciling
+        since = int(time.time())
+        self.reconcile(docker_client)
+        thread = threading.Thread(
+            target=self.follow_events,
+            args=(docker_client,),
+            kwargs={"since": since},
+            daemon=True,
+        )
+        thread.start()
+        return thread
@@ -0,0 +1,225 @@
+"""
+A minimal kubernetes API client, for a smaller footprint on every node
+
+The cleaner only reads and patches its node, and lists and watches the pods
+on it. The full kubernetes client takes a lot longer to import and uses a lot
+more memory than that needs, multiplied by the number of nodes.
+
+KubeClient talks to the API server directly, with one requests Session,
+which keeps connections alive between requests.
+It has the same methods as kubernetes.client.CoreV1Api for what the cleaner
+uses, and returns objects with the same attributes (e.g. pod.spec.node_name),
+so the rest of the cleaner doesn't need to know which client it uses.
+"""
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SERVICE_ACCOUNT = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+
+class ApiError(Exception):
+    """An error response from the API server, like kubernetes.client.ApiException"""
+
+    def __init__(self, status, reason, body=None):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super().__init__(f"({status}) {reason}")
+
+
+# fields whose names aren't plain camelCase
+_FIELDS = {
+    "image_id": "imageID",
+    "container_id": "containerID",
+    "pod_ip": "podIP",
+    "pod_ips": "podIPs",
+    "host_ip": "hostIP",
+    "host_ips": "hostIPs",
+}
+# fields that are maps of arbitrary keys, dicts in the client's models too
+_MAPS = {"annotations", "labels", "nodeSelector", "capacity", "allocatable"}
+
+
+def _camel(name):
+    """snake_case attribute name to camelCase field name"""
+    if name in _FIELDS:
+        return _FIELDS[name]
+    first, *rest = name.split("_")
+    return first + "".join(part.title() for part in rest)
+
+
+class KubeObject:
+    """
+    Attribute access to a kubernetes API object, like the client's models
+
+    Missing fields are None, like unset fields of models,
+    and maps like annotations are dicts.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, name):
+        field = _camel(name)
+        if field in _MAPS:
+            return self._data.get(field)
+        return _wrap(self._data.get(field))
+
+    def to_dict(self):
+        return self._data
+
+
+def _wrap(value):
+    if isinstance(value, dict):
+        return KubeObject(value)
+    if isinstance(value, list):
+        return [_wrap(item) for item in value]
+    return value
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+class KubeClient:
+    """
+    The few kubernetes API calls the cleaner makes
+
+    `host` is the API server's URL, `token` a bearer token,
+    or a function returning it, `ca` the CA bundle to verify it with.
+    """
+
+    def __init__(self, host, token=None, ca=None, timeout=30, pool_size=4):
+        self.host = host.rstrip("/")
+        self._token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+        if ca:
+            self.session.verify = ca
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_incluster(cls, **kwargs):
+        """Client for the API server of the cluster we run in, with our service account"""
+        host = os.environ.get("KUBERNETES_SERVICE_HOST")
+        port = os.environ.get("KUBERNETES_SERVICE_PORT", "443")
+        if not host:
+            raise RuntimeError(
+                "Not running in a kubernetes cluster, KUBERNETES_SERVICE_HOST is unset"
+            )
+        if ":" in host:
+            # IPv6
+            host = f"[{host}]"
+        token_path = os.path.join(SERVICE_ACCOUNT, "token")
+        return cls(
+            f"https://{host}:{port}",
+            token=_RotatingToken(token_path),
+            ca=os.path.join(SERVICE_ACCOUNT, "ca.crt"),
+            **kwargs,
+        )
+
+    def _headers(self, content_type=None):
+        headers = {"Accept": "application/json"}
+        token = self._token() if callable(self._token) else self._token
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
+    def _request(self, method, path, body=None, content_type=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        data = None if body is None else json.dumps(body)
+        r = self.session.request(
+            method,
+            self.host + path,
+            data=data,
+            headers=self._headers(content_type),
+            **kwargs,
+        )
+        if r.status_code >= 400:
+            try:
+                reason = r.json().get("reason") or r.reason
+            except ValueError:
+                reason = r.reason
+            raise ApiError(r.status_code, reason, r.text)
+        return r
+
+    def read_node(self, name):
+        return _wrap(self._request("GET", f"/api/v1/nodes/{name}").json())
+
+    def patch_node(self, name, body):
+        """Patch a node, with a strategic merge patch like CoreV1Api.patch_node"""
+        r = self._request(
+            "PATCH",
+            f"/api/v1/nodes/{name}",
+            body,
+            content_type="application/strategic-merge-patch+json",
+        )
+        return _wrap(r.json())
+
+    def list_pod_for_all_namespaces(self, field_selector=None):
+        params = {"fieldSelector": field_selector} if field_selector else {}
+        return _wrap(self._request("GET", "/api/v1/pods", params=params).json())
+
+    def watch_pod_for_all_namespaces(
+        self, field_selector=None, resource_version=None, timeout_seconds=300
+    ):
+        """
+        Watch pods, yielding events like kubernetes.watch.Watch().stream
+
+        i.e. dicts with "type", "object" and "raw_object".
+        """
+        params = {"watch": "true", "timeoutSeconds": str(timeout_seconds)}
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        if resource_version:
+            params["resourceVersion"] = resource_version
+        with self._request(
+            "GET",
+            "/api/v1/pods",
+            params=params,
+            stream=True,
+            # the server ends the watch after timeout_seconds
+            timeout=(self.timeout, timeout_seconds + self.timeout),
+        ) as r:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                raw = event.get("object", {})
+                yield {
+                    "type": event.get("type"),
+                    "object": _wrap(raw),
+                    "raw_object": raw,
+                }
+
+
+class _RotatingToken:
+    """
+    A service account token, read again every minute
+
+    Projected service account tokens are rotated by the kubelet.
+    """
+
+    def __init__(self, path, max_age=60):
+        self.path = path
+        self.max_age = max_age
+        self._token = None
+        self._read_at = 0
+
+    def __call__(self):
+        now = time.monotonic()
+        if self._token is None or now - self._read_at > self.max_age:
+            self._token = _read(self.path)
+            self._read_at = now
+        return self._token
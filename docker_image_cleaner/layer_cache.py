@@ -0,0 +1,179 @@
+"""
+Cache the sizes of committed overlay2 layers
+
+Image layers in /var/lib/docker/overlay2/<id>/diff never change
+once committed, so their sizes only need to be computed once.
+Committed layers are those listed in the docker layer database
+(image/overlay2/layerdb/sha256/*/cache-id).
+Container layers (layerdb/mounts) are mutable and are always rescanned.
+
+Entries are keyed by layer id and the mtime of the layer's diff directory,
+and are evicted when the layer disappears from the layer database.
+The cache can be persisted to a JSON file (e.g. on a hostPath),
+so it survives restarts of the cleaner.
+
+LayerInodeCache does the same for the number of inodes in each layer,
+to choose images to remove when inodes run out before blocks.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+from .persist import load_state, save_state
+from .scanner import count_inodes
+
+CACHE_VERSION = 1
+
+
+def committed_layers(docker_root, driver="overlay2"):
+    """
+    Return the set of committed layer directory ids
+
+    These are the `cache-id`s of image layers in docker's layer database.
+    """
+    pattern = os.path.join(docker_root, "image", driver, "layerdb", "sha256", "*")
+    layers = set()
+    for layer in glob(pattern):
+        try:
+            with open(os.path.join(layer, "cache-id")) as f:
+                layers.add(f.read().strip())
+        except OSError:
+            # layer being created or deleted
+            continue
+    return layers
+
+
+class LayerSizeCache:
+    """
+    Cache of layer sizes, optionally persisted to `path`
+
+    Used by scanner.scan_size via `lookup` and `store`.
+    Call `refresh` before each scan and `save` after it.
+    """
+
+    def __init__(self, docker_root, path=None, driver="overlay2"):
+        self.docker_root = docker_root
+        self.layer_dir = os.path.join(os.path.normpath(docker_root), driver)
+        self.driver = driver
+        self.path = path
+        self.sizes = {}
+        self.committed = set()
+        # diff mtimes recorded at lookup, so changes during the scan are not cached
+        self._mtimes = {}
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def load(self):
+        """Load the cache from self.path, if it exists"""
+        data = load_state(self.path, CACHE_VERSION, "layer size cache")
+        if data is None:
+            return
+        self.sizes = data["layers"]
+        logging.info(f"Loaded {len(self.sizes)} layer sizes from {self.path}")
+
+    def save(self):
+        """Persist the cache to self.path, if set"""
+        if self.path:
+            save_state(self.path, CACHE_VERSION, {"layers": self.sizes})
+
+    def refresh(self):
+        """
+        Update the set of committed layers
+
+        Evicts entries for layers that have been deleted.
+        """
+        self.committed = committed_layers(self.docker_root, self.driver)
+        self._mtimes = {}
+        self.hits = self.misses = 0
+        for layer_id in list(self.sizes):
+            if layer_id not in self.committed:
+                del self.sizes[layer_id]
+
+    def _layer_id(self, dirpath):
+        """Return the layer id of a directory, if it is a committed layer"""
+        if os.path.dirname(os.path.normpath(dirpath)) != self.layer_dir:
+            return None
+        layer_id = os.path.basename(dirpath)
+        if layer_id in self.committed:
+            return layer_id
+        return None
+
+    def lookup(self, dirpath):
+        """Return the cached size of `dirpath`, or None if it needs scanning"""
+        layer_id = self._layer_id(dirpath)
+        if layer_id is None:
+            return None
+        try:
+            mtime = os.stat(os.path.join(dirpath, "diff")).st_mtime_ns
+        except OSError:
+            return None
+        entry = self.sizes.get(layer_id)
+        if entry is not None and entry["mtime"] == mtime:
+            self.hits += 1
+            return entry["size"]
+        self.misses += 1
+        self._mtimes[layer_id] = mtime
+        return None
+
+    def store(self, dirpath, size):
+        """Record the scanned size of `dirpath`, if it is a committed layer"""
+        layer_id = self._layer_id(dirpath)
+        if layer_id is None or layer_id not in self._mtimes:
+            return
+        self.sizes[layer_id] = {"mtime": self._mtimes.pop(layer_id), "size": size}
+
+
+class LayerInodeCache:
+    """
+    Cache of the number of inodes in committed layers, by chain ID
+
+    Layers are found from their chain ID (as in planner.image_layers)
+    through the layer database, and counted once, with `workers` threads.
+    Kept in memory only, counting is cheaper than scanning sizes.
+    """
+
+    def __init__(self, docker_root, driver="overlay2", workers=4):
+        self.docker_root = docker_root
+        self.driver = driver
+        self.workers = workers
+        self.inodes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _diff_dir(self, layer):
+        """The diff directory of a layer, or None if it isn't in the layer database"""
+        algo, _, digest = layer.partition(":")
+        layerdb = os.path.join(
+            self.docker_root, "image", self.driver, "layerdb", algo, digest
+        )
+        try:
+            with open(os.path.join(layerdb, "cache-id")) as f:
+                cache_id = f.read().strip()
+        except OSError:
+            return None
+        return os.path.join(self.docker_root, self.driver, cache_id, "diff")
+
+    def counts(self, layers):
+        """
+        {chain ID: inodes} of `layers`, all the layers of current images
+
+        Cached layers not in `layers` have been deleted, and are evicted.
+        Layers that can't be found are left out.
+        """
+        layers = set(layers)
+        for layer in set(self.inodes) - layers:
+            del self.inodes[layer]
+        missing = [layer for layer in layers if layer not in self.inodes]
+        self.hits = len(layers) - len(missing)
+        self.misses = 0
+        dirs = {layer: self._diff_dir(layer) for layer in missing}
+        dirs = {layer: path for layer, path in dirs.items() if path}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for layer, n in zip(dirs, pool.map(count_inodes, dirs.values())):
+                if n:
+                    self.inodes[layer] = n
+                    self.misses += 1
+        return {layer: self.inodes[layer] for layer in layers if layer in self.inodes}
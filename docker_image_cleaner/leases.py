@@ -0,0 +1,226 @@
+"""
+Limit how many nodes are cordoned for GC at the same time, cluster-wide
+
+Cordoning is only done while holding one of `slots` Leases
+(coordination.k8s.io/v1), named <name>-0 ... <name>-<slots - 1>.
+Leases expire when their holder stops renewing them,
+e.g. after a crash, so a slot is never lost for good.
+
+Nodes waiting for a slot say so with a "waiting" Lease of their own,
+annotated with their priority (how full they are).
+A free slot is only taken by a node if fewer nodes with a higher priority
+are waiting than there are free slots, so the fullest nodes go first.
+
+Leases are updated with their resourceVersion, so when two nodes try to
+take the same slot, only one succeeds, and the other tries again later.
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+# all our Leases have this label, set to the name
+LABEL = "hub.jupyter.org/image-cleaner-gc"
+# "slot" or "waiting"
+ROLE_LABEL = "hub.jupyter.org/image-cleaner-gc-role"
+PRIORITY_ANNOTATION = "hub.jupyter.org/image-cleaner-priority"
+
+
+def current_namespace(default="default"):
+    """The namespace we are running in, from our service account"""
+    path = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip()
+    return default
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def expired(lease, now):
+    """Whether a Lease's holder stopped renewing it"""
+    spec = lease.spec
+    if not spec.holder_identity or spec.renew_time is None:
+        return True
+    duration = timedelta(seconds=spec.lease_duration_seconds or 0)
+    return spec.renew_time + duration < now
+
+
+def _priority(lease):
+    annotations = lease.metadata.annotations or {}
+    try:
+        return float(annotations.get(PRIORITY_ANNOTATION, 0))
+    except ValueError:
+        return 0
+
+
+class GCSlots:
+    """
+    `slots` Leases in `namespace`, to hold while cordoning
+
+    `coordination` is a kubernetes.client.CoordinationV1Api,
+    `holder` identifies this cleaner, e.g. the node name.
+    """
+
+    def __init__(
+        self,
+        coordination,
+        namespace,
+        holder,
+        slots=1,
+        name="docker-image-cleaner-gc",
+        lease_seconds=60,
+        clock=_now,
+    ):
+        self.coordination = coordination
+        self.namespace = namespace
+        self.holder = holder
+        self.slots = slots
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+
+    def slot_names(self):
+        return [f"{self.name}-{i}" for i in range(self.slots)]
+
+    def waiting_name(self):
+        return f"{self.name}-waiting-{self.holder}"
+
+    def _lease(self, name, role, priority=None, resource_version=None):
+        import kubernetes.client
+
+        now = self.clock()
+        annotations = None
+        if priority is not None:
+            annotations = {PRIORITY_ANNOTATION: str(priority)}
+        return kubernetes.client.V1Lease(
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=name,
+                labels={LABEL: self.name, ROLE_LABEL: role},
+                annotations=annotations,
+                resource_version=resource_version,
+            ),
+            spec=kubernetes.client.V1LeaseSpec(
+                holder_identity=self.holder,
+                lease_duration_seconds=self.lease_seconds,
+                acquire_time=now,
+                renew_time=now,
+            ),
+        )
+
+    def list_leases(self):
+        """Our slot and waiting Leases, by name"""
+        leases = self.coordination.list_namespaced_lease(
+            self.namespace, label_selector=f"{LABEL}={self.name}"
+        )
+        return {lease.metadata.name: lease for lease in leases.items}
+
+    def _write(self, name, lease, existing):
+        """Create or replace a Lease, returns False if someone else changed it first"""
+        import kubernetes.client
+
+        try:
+            if existing is None:
+                self.coordination.create_namespaced_lease(self.namespace, lease)
+            else:
+                self.coordination.replace_namespaced_lease(name, self.namespace, lease)
+        except kubernetes.client.ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        return True
+
+    def try_acquire(self, priority):
+        """
+        Take a free slot, if it's our turn
+
+        `priority` is how urgently we need one, e.g. usage as a fraction of
+        the threshold. Returns the name of the slot Lease, or None.
+        """
+        now = self.clock()
+        leases = self.list_leases()
+        slots = {name: leases.get(name) for name in self.slot_names()}
+        for name, lease in slots.items():
+            if lease is not None and lease.spec.holder_identity == self.holder:
+                # e.g. held since before a restart
+                if not expired(lease, now):
+                    self.renew(name)
+                    return name
+        free = [
+            name
+            for name, lease in slots.items()
+            if lease is None or expired(lease, now)
+        ]
+        ahead = [
+            lease
+            for lease in leases.values()
+            if (lease.metadata.labels or {}).get(ROLE_LABEL) == "waiting"
+            and lease.spec.holder_identity != self.holder
+            and not expired(lease, now)
+            and (_priority(lease), lease.spec.holder_identity) > (priority, self.holder)
+        ]
+        if len(ahead) < len(free):
+            name = free[len(ahead)]
+            existing = slots[name]
+            lease = self._lease(
+                name,
+                "slot",
+                resource_version=existing.metadata.resource_version
+                if existing
+                else None,
+            )
+            if self._write(name, lease, existing):
+                if self.waiting_name() in leases:
+                    self.stop_waiting()
+                return name
+        self._wait(priority, leases.get(self.waiting_name()))
+        return None
+
+    def _wait(self, priority, existing):
+        """Record that we are waiting for a slot, with `priority`"""
+        name = self.waiting_name()
+        lease = self._lease(
+            name,
+            "waiting",
+            priority=priority,
+            resource_version=existing.metadata.resource_version if existing else None,
+        )
+        self._write(name, lease, existing)
+
+    def stop_waiting(self):
+        """Stop waiting for a slot, e.g. after taking one"""
+        import kubernetes.client
+
+        try:
+            self.coordination.delete_namespaced_lease(
+                self.waiting_name(), self.namespace
+            )
+        except kubernetes.client.ApiException as e:
+            if e.status != 404:
+                raise
+
+    def renew(self, name):
+        """Renew a slot we hold, returns False if we lost it"""
+        lease = self.coordination.read_namespaced_lease(name, self.namespace)
+        if lease.spec.holder_identity != self.holder:
+            return False
+        lease.spec.renew_time = self.clock()
+        return self._write(name, lease, lease)
+
+    def release(self, name):
+        """Give up a slot, if we still hold it"""
+        import kubernetes.client
+
+        try:
+            lease = self.coordination.read_namespaced_lease(name, self.namespace)
+        except kubernetes.client.ApiException as e:
+            if e.status == 404:
+                return
+            raise
+        if lease.spec.holder_identity != self.holder:
+            return
+        lease.spec.holder_identity = None
+        lease.spec.renew_time = None
+        if self._write(name, lease, lease):
+            logging.info(f"Released GC slot {name}")
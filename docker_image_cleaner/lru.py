@@ -0,0 +1,161 @@
+"""
+Track when images were last used, to delete least recently used images first
+
+Image use is recorded from docker container create and start events,
+followed in a background thread.
+Images never seen in use count as used when they were last tagged,
+i.e. pulled or built.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from .persist import load_state, save_state
+from .pods import image_refs, normalize_ref
+
+STATE_VERSION = 1
+
+
+def parse_docker_time(timestamp):
+    """
+    Parse a timestamp from the docker API to seconds since the epoch
+
+    Docker timestamps have nanoseconds (2023-10-10T10:10:10.123456789Z),
+    which datetime can't parse, so sub-second precision is dropped.
+    Returns 0 for missing timestamps.
+    """
+    if not timestamp:
+        return 0
+    dt = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+    return max(dt.replace(tzinfo=timezone.utc).timestamp(), 0)
+
+
+def pulled_at(image):
+    """When a docker Image was pulled (or tagged, or built), in seconds since the epoch"""
+    metadata = image.attrs.get("Metadata") or {}
+    return parse_docker_time(metadata.get("LastTagTime")) or parse_docker_time(
+        image.attrs.get("Created")
+    )
+
+
+class LastUsed:
+    """
+    When each image was last used, optionally persisted to `path`
+
+    Uses are recorded by image reference, as found in container events,
+    which may be an image id, a tag or a digest. They are normalized
+    (e.g. ubuntu -> ubuntu:latest) to match the tags and digests of docker Images.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.last_used = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path:
+            self.load()
+
+    def load(self):
+        """Load recorded uses from self.path, if it exists"""
+        data = load_state(self.path, STATE_VERSION, "image last-used record")
+        if data is None:
+            return
+        # normalize refs saved by versions that didn't
+        for ref, timestamp in data["last_used"].items():
+            self.record(ref, timestamp)
+        logging.info(
+            f"Loaded last use of {len(self.last_used)} images from {self.path}"
+        )
+
+    def save(self):
+        """Persist recorded uses to self.path, if set and anything changed"""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            last_used = dict(self.last_used)
+            self._dirty = False
+        save_state(self.path, STATE_VERSION, {"last_used": last_used})
+
+    def record(self, ref, timestamp=None):
+        """Record that image `ref` was used at `timestamp` (default: now)"""
+        if timestamp is None:
+            timestamp = time.time()
+        ref = normalize_ref(ref)
+        with self._lock:
+            if timestamp > self.last_used.get(ref, 0):
+                self.last_used[ref] = timestamp
+                self._dirty = True
+
+    def forget(self, image):
+        """Forget an image that has been deleted"""
+        with self._lock:
+            for ref in image_refs(image):
+                if self.last_used.pop(ref, None) is not None:
+                    self._dirty = True
+
+    def get(self, image):
+        """When a docker Image was last used, in seconds since the epoch"""
+        with self._lock:
+            used = max(self.last_used.get(ref, 0) for ref in image_refs(image))
+        if used:
+            return used
+        # never seen in use, fall back on when it was pulled or built
+        return pulled_at(image)
+
+    def record_running(self, docker_client):
+        """Record all images of currently running containers as used now"""
+        for container in docker_client.containers.list():
+            self.record(container.attrs["Image"])
+            self.record(container.attrs["Config"]["Image"])
+
+    def record_event(self, event):
+        """Record a container event from docker_client.events"""
+        ref = event.get("Actor", {}).get("Attributes", {}).get("image") or event.get(
+            "from"
+        )
+        if not ref:
+            return
+        self.record(ref, event.get("time"))
+
+    def follow_events(self, docker_client, retry_seconds=10):
+        """
+        Record container create and start events, forever
+
+        Reconnects if the event stream is interrupted,
+        replaying events since the last one we saw.
+        """
+        since = None
+        while True:
+            try:
+                # docker_client.events: https://docker-py.readthedocs.io/en/stable/client.html#docker.client.DockerClient.events
+                events = docker_client.events(
+                    since=since,
+                    decode=True,
+                    filters={"type": "container", "event": ["create", "start"]},
+                )
+                for event in events:
+                    self.record_event(event)
+                    since = event.get("time", since)
+            except Exception as e:
+                logging.warning(f"Error following docker events: {e}")
+            time.sleep(retry_seconds)
+
+    def start(self, docker_client):
+        """Start recording image uses in a background thread"""
+        self.record_running(docker_client)
+        thread = threading.Thread(
+            target=self.follow_events, args=(docker_client,), daemon=True
+        )
+        thread.start()
+        return thread
+
+
+def lru_order(images, last_used):
+    """
+    Sort images by last use, least recently used first
+
+    `last_used` is a LastUsed for docker Images,
+    or a {image id: timestamp} dict for image ids.
+    """
+    return sorted(images, key=last_used.get)
@@ -0,0 +1,149 @@
+"""
+Prometheus metrics for the cleaner
+
+Metrics are always collected, and served on /metrics
+when DOCKER_IMAGE_CLEANER_METRICS_PORT is set.
+
+prometheus_client reference: https://prometheus.github.io/client_python/
+"""
+import logging
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+prefix = "docker_image_cleaner"
+
+# buckets for operations that can take from milliseconds to several minutes
+duration_buckets = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+used_percent = Gauge(
+    f"{prefix}_used_percent",
+    "Disk usage of the checked path in %, for whichever of blocks or inodes is fuller",
+)
+used_bytes = Gauge(
+    f"{prefix}_used_bytes",
+    "Bytes used, as measured by the threshold type",
+)
+used_inodes = Gauge(
+    f"{prefix}_used_inodes",
+    "Inodes used on the filesystem of the checked path",
+)
+threshold_high = Gauge(
+    f"{prefix}_threshold_high",
+    "Usage above which GC is triggered, in % for relative thresholds, bytes otherwise",
+)
+deleted = Counter(
+    f"{prefix}_deleted",
+    "Docker objects deleted",
+    ["kind"],
+)
+reclaimed_bytes = Counter(
+    f"{prefix}_reclaimed_bytes",
+    "Bytes reclaimed by deleting docker objects (estimated when removing single images)",
+    ["kind"],
+)
+scan_duration = Histogram(
+    f"{prefix}_scan_duration_seconds",
+    "Time taken to measure disk usage",
+    buckets=duration_buckets,
+)
+prune_duration = Histogram(
+    f"{prefix}_prune_duration_seconds",
+    "Time taken to delete each kind of docker object in a GC cycle",
+    ["kind"],
+    buckets=duration_buckets,
+)
+docker_api_latency = Histogram(
+    f"{prefix}_docker_api_latency_seconds",
+    "Latency of docker API requests",
+    ["operation"],
+    buckets=duration_buckets,
+)
+docker_api_timeouts = Counter(
+    f"{prefix}_docker_api_timeouts",
+    "Docker API requests that timed out",
+    ["operation"],
+)
+cordoned = Gauge(
+    f"{prefix}_cordoned",
+    "Whether the node is currently cordoned by the cleaner",
+)
+cordoned_seconds = Counter(
+    f"{prefix}_cordoned_seconds",
+    "Time the node has spent cordoned by the cleaner",
+)
+cordon_duration = Histogram(
+    f"{prefix}_cordon_duration_seconds",
+    "Time the node was cordoned for each GC cycle that cordoned it",
+    buckets=duration_buckets,
+)
+cordons_skipped = Counter(
+    f"{prefix}_cordons_skipped",
+    "GC cycles that removed images without cordoning, because they removed few",
+)
+gc_slot_wait = Histogram(
+    f"{prefix}_gc_slot_wait_seconds",
+    "Time waited for one of the cluster's GC slots before cordoning",
+    buckets=duration_buckets,
+)
+gc_runs = Counter(
+    f"{prefix}_gc_runs",
+    "GC cycles started because usage was above the high threshold",
+)
+gc_triggers = Counter(
+    f"{prefix}_gc_triggers",
+    "GC cycles started, by the resource that was above the threshold",
+    ["resource"],
+)
+gc_deferred = Counter(
+    f"{prefix}_gc_deferred",
+    "Checks that put off GC because the docker daemon was busy",
+)
+build_containers = Gauge(
+    f"{prefix}_build_containers",
+    "Running build containers when GC was last needed",
+)
+rewarm_pull_duration = Histogram(
+    f"{prefix}_rewarm_pull_duration_seconds",
+    "Time taken to pull each hot image again after GC",
+    buckets=duration_buckets,
+)
+rewarm_pulled_bytes = Counter(
+    f"{prefix}_rewarm_pulled_bytes",
+    "Size of the hot images pulled again after GC (layers already there included)",
+)
+
+
+def observe_usage(path, percent=None, nbytes=None):
+    """
+    Record disk usage after a check
+
+    `percent` or `nbytes` is what get_used measured,
+    depending on the threshold type.
+    The other values are taken from the filesystem of `path`, if it exists,
+    which it may not in docker mode.
+    """
+    if percent is not None:
+        used_percent.set(percent)
+    if nbytes is not None:
+        used_bytes.set(nbytes)
+
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return
+    if not (stat.f_blocks and stat.f_files):
+        return
+    used_inodes.set(stat.f_files - stat.f_ffree)
+    if nbytes is None:
+        used_bytes.set((stat.f_blocks - stat.f_bfree) * stat.f_frsize)
+    if percent is None:
+        inodes_avail = stat.f_favail / stat.f_files
+        blocks_avail = stat.f_bavail / stat.f_blocks
+        used_percent.set(100 * (1 - min(blocks_avail, inodes_avail)))
+
+
+def start_metrics_server(port):
+    """Serve metrics on http://0.0.0.0:{port}/metrics"""
+    logging.info(f"Serving metrics on port {port}")
+    start_http_server(port)
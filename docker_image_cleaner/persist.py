@@ -0,0 +1,40 @@
+"""
+Persist state to JSON files
+
+Used for caches and records that should survive restarts of the cleaner,
+e.g. when stored on a hostPath volume.
+"""
+import json
+import logging
+import os
+
+
+def load_state(path, version, description="state"):
+    """
+    Load versioned state saved with save_state
+
+    Returns None if `path` doesn't exist, can't be read,
+    or was saved with a different version.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable {description} {path}: {e}")
+        return None
+    if not isinstance(data, dict) or data.get("version") != version:
+        logging.warning(f"Ignoring {description} {path} with a different version")
+        return None
+    return data
+
+
+def save_state(path, version, data):
+    """Save state to `path`, atomically"""
+    data = dict(data, version=version)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    # atomic, so a crash can't leave a truncated file behind
+    os.replace(tmp_path, path)
@@ -0,0 +1,187 @@
+"""
+Plan which images to remove to free a given amount of space
+
+Removing an image only frees the layers no other image uses,
+so the size of an image is a poor measure of what removing it reclaims.
+The planner builds an image -> layer graph and repeatedly picks
+the image whose removal frees the most bytes right now,
+recomputing after each simulated removal.
+
+Layers are identified by their chain ID, which identifies a layer
+together with all layers below it, like docker's layer database does.
+"""
+import hashlib
+import os
+
+
+def chain_ids(diff_ids):
+    """
+    Compute layer chain IDs from the diff IDs in an image's RootFS.Layers
+
+    ref: https://github.com/opencontainers/image-spec/blob/main/config.md#layer-chainid
+    """
+    chain = []
+    for diff_id in diff_ids:
+        if chain:
+            parent = chain[-1]
+            diff_id = (
+                "sha256:"
+                + hashlib.sha256(f"{parent} {diff_id}".encode("utf8")).hexdigest()
+            )
+        chain.append(diff_id)
+    return chain
+
+
+def image_layers(images):
+    """
+    Build the image -> layer graph of docker Images
+
+    Returns {image id: [layer chain IDs]}
+    """
+    return {
+        image.id: chain_ids((image.attrs.get("RootFS") or {}).get("Layers") or [])
+        for image in images
+    }
+
+
+def read_layer_sizes(docker_root, layers, driver="overlay2"):
+    """
+    Read the sizes of layers from docker's layer database
+
+    Returns {chain ID: bytes} for the layers that were found.
+    """
+    sizes = {}
+    for layer in layers:
+        algo, _, digest = layer.partition(":")
+        path = os.path.join(docker_root, "image", driver, "layerdb", algo, digest)
+        try:
+            with open(os.path.join(path, "size")) as f:
+                sizes[layer] = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return sizes
+
+
+def estimate_layer_sizes(images, graph, known_sizes=None):
+    """
+    Fill in the sizes of layers missing from `known_sizes`
+
+    The part of each image's Size not accounted for by known layers
+    is split evenly between its unknown layers.
+    Used when the layer database isn't available, e.g. in docker mode.
+    """
+    sizes = dict(known_sizes or {})
+    for image in images:
+        layers = graph[image.id]
+        unknown = [layer for layer in layers if layer not in sizes]
+        if not unknown:
+            continue
+        known = sum(sizes[layer] for layer in layers if layer in sizes)
+        remaining = max(image.attrs.get("Size", 0) - known, 0)
+        for layer in unknown:
+            sizes[layer] = remaining // len(unknown)
+    return sizes
+
+
+def freed_bytes(graph, layer_sizes, removed):
+    """Bytes freed by removing the set of images `removed`"""
+    kept = set()
+    for image_id, layers in graph.items():
+        if image_id not in removed:
+            kept.update(layers)
+    layers = {layer for image_id in removed for layer in graph[image_id]}
+    return sum(layer_sizes.get(layer, 0) for layer in layers - kept)
+
+
+def freed_in_order(graph, layer_sizes, order):
+    """
+    Bytes freed by each removal, when removing images in a given order
+
+    Returns {image id: bytes freed}
+    """
+    refcount = {}
+    for layers in graph.values():
+        for layer in set(layers):
+            refcount[layer] = refcount.get(layer, 0) + 1
+    freed = {}
+    for image_id in order:
+        freed[image_id] = 0
+        for layer in set(graph[image_id]):
+            refcount[layer] -= 1
+            if refcount[layer] == 0:
+                freed[image_id] += layer_sizes.get(layer, 0)
+    return freed
+
+
+def plan_removal(graph, layer_sizes, candidates, need_bytes):
+    """
+    Choose images to remove to free at least `need_bytes`
+
+    graph: {image id: [layers]} for _all_ images,
+        including those that can't be removed, whose layers are kept.
+    layer_sizes: {layer: bytes}
+    candidates: ids of images that may be removed
+
+    Images are chosen greedily, each time picking the image whose removal
+    frees the most bytes given what has been removed already.
+    Ties, including when no image frees anything on its own
+    because all its layers are shared, are broken by the image's share
+    of its layers (size / number of remaining images using each layer),
+    so removing a group of images sharing layers is eventually planned.
+    Afterwards, images that turn out not to be needed are dropped from the plan,
+    e.g. one picked early when a group picked later frees enough on its own.
+
+    Returns a list of (image id, bytes freed) in removal order,
+    stopping once `need_bytes` would be freed.
+    Images that would free nothing at the end of the plan are left out.
+    """
+    refcount = {}
+    for layers in graph.values():
+        for layer in set(layers):
+            refcount[layer] = refcount.get(layer, 0) + 1
+
+    def score(image_id):
+        layers = set(graph[image_id])
+        unique = sum(
+            layer_sizes.get(layer, 0) for layer in layers if refcount[layer] == 1
+        )
+        share = sum(layer_sizes.get(layer, 0) / refcount[layer] for layer in layers)
+        return unique, share
+
+    remaining = set(candidates)
+    plan = []
+    planned_bytes = 0
+    while remaining and planned_bytes < need_bytes:
+        # sorted for a deterministic choice between equal scores
+        image_id = max(sorted(remaining), key=score)
+        unique, share = score(image_id)
+        if share == 0:
+            # nothing left to gain
+            break
+        plan.append((image_id, unique))
+        planned_bytes += unique
+        remaining.remove(image_id)
+        for layer in set(graph[image_id]):
+            refcount[layer] -= 1
+
+    if planned_bytes >= need_bytes:
+        chosen = {image_id for image_id, _ in plan}
+        # try dropping the images freeing the least first
+        for image_id, _ in sorted(plan, key=lambda step: step[1]):
+            without = chosen - {image_id}
+            if freed_bytes(graph, layer_sizes, without) >= need_bytes:
+                chosen = without
+        # recompute what each step frees, without the dropped images
+        removed = set()
+        steps = []
+        for image_id, _ in plan:
+            if image_id not in chosen:
+                continue
+            before = freed_bytes(graph, layer_sizes, removed)
+            removed.add(image_id)
+            steps.append((image_id, freed_bytes(graph, layer_sizes, removed) - before))
+        plan = steps
+
+    while plan and plan[-1][1] == 0:
+        plan.pop()
+    return plan
@@ -0,0 +1,202 @@
+"""
+Keep track of the images pods on this node use, or are about to use
+
+Pods scheduled on the node are listed once, then kept up to date
+by watching for changes, in a background thread.
+An index of the image references of those pods is updated incrementally,
+so asking whether an image is protected doesn't call the kubernetes API.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from functools import partial
+
+from .kube import ApiError, KubeClient
+
+# pods in these phases don't need their images anymore
+FINISHED_PHASES = {"Succeeded", "Failed"}
+
+
+def normalize_ref(ref):
+    """
+    Normalize an image reference to how docker names images
+
+    e.g.
+
+    - ubuntu -> ubuntu:latest
+    - docker.io/library/ubuntu:22.04 -> ubuntu:22.04
+    - docker-pullable://ubuntu@sha256:abc -> ubuntu@sha256:abc
+    - docker://sha256:abc -> sha256:abc
+    """
+    for prefix in ("docker-pullable://", "docker://"):
+        if ref.startswith(prefix):
+            ref = ref[len(prefix) :]
+    if ref.startswith("sha256:"):
+        return ref
+    for prefix in ("docker.io/library/", "docker.io/"):
+        if ref.startswith(prefix):
+            ref = ref[len(prefix) :]
+            break
+    name, at, _ = ref.partition("@")
+    if not at and ":" not in name.rsplit("/", 1)[-1]:
+        ref += ":latest"
+    return ref
+
+
+def pod_image_refs(pod):
+    """Normalized references of the images a kubernetes V1Pod uses"""
+    if pod.status and pod.status.phase in FINISHED_PHASES:
+        return frozenset()
+    refs = set()
+    spec = pod.spec
+    for containers in (
+        spec.containers,
+        spec.init_containers,
+        spec.ephemeral_containers,
+    ):
+        for container in containers or []:
+            if container.image:
+                refs.add(normalize_ref(container.image))
+    status = pod.status
+    if status:
+        for statuses in (
+            status.container_statuses,
+            status.init_container_statuses,
+            status.ephemeral_container_statuses,
+        ):
+            for container_status in statuses or []:
+                # the image id is the digest or id of the image actually used
+                if container_status.image_id:
+                    refs.add(normalize_ref(container_status.image_id))
+    return frozenset(refs)
+
+
+def image_refs(image):
+    """Normalized references of a docker Image: id, tags and digests"""
+    refs = {image.id}
+    refs.update(normalize_ref(tag) for tag in image.tags)
+    refs.update(normalize_ref(d) for d in image.attrs.get("RepoDigests") or [])
+    return refs
+
+
+def api_error(kube):
+    """The exception raised for error responses by `kube`, like 403 Forbidden"""
+    if isinstance(kube, KubeClient):
+        return ApiError
+    import kubernetes.client
+
+    return kubernetes.client.ApiException
+
+
+class PodImages:
+    """
+    Images used by pods on `node`, from a watch-backed cache of its pods
+
+    `kube` is a kubernetes.client.CoreV1Api, or a kube.KubeClient.
+    """
+
+    def __init__(self, kube, node):
+        self.kube = kube
+        self.node = node
+        self.field_selector = f"spec.nodeName={node}"
+        # {pod uid: image refs}
+        self.pods = {}
+        self.refcount = Counter()
+        self.resource_version = None
+        self._lock = threading.Lock()
+
+    def update(self, uid, refs):
+        """Set the image refs used by pod `uid`"""
+        with self._lock:
+            old = self.pods.pop(uid, frozenset())
+            if refs:
+                self.pods[uid] = refs
+            self.refcount.subtract(old)
+            self.refcount.update(refs)
+            for ref in old - refs:
+                if self.refcount[ref] <= 0:
+                    del self.refcount[ref]
+
+    def refs(self):
+        """All image references used by pods on the node"""
+        with self._lock:
+            return set(self.refcount)
+
+    def protects(self, image):
+        """Whether a docker Image is used by a pod on the node"""
+        with self._lock:
+            return any(ref in self.refcount for ref in image_refs(image))
+
+    def apply(self, event_type, pod):
+        """Apply an ADDED, MODIFIED or DELETED watch event"""
+        if event_type == "DELETED":
+            self.update(pod.metadata.uid, frozenset())
+        else:
+            self.update(pod.metadata.uid, pod_image_refs(pod))
+        self.resource_version = pod.metadata.resource_version
+
+    def list_pods(self):
+        """List the pods on the node, replacing the cache"""
+        pods = self.kube.list_pod_for_all_namespaces(field_selector=self.field_selector)
+        listed = {pod.metadata.uid: pod_image_refs(pod) for pod in pods.items}
+        for uid in set(self.pods) - set(listed):
+            self.update(uid, frozenset())
+        for uid, refs in listed.items():
+            self.update(uid, refs)
+        self.resource_version = pods.metadata.resource_version
+        logging.info(
+            f"{len(self.pods)} pods on node {self.node} use {len(self.refs())} images"
+        )
+
+    def watch(self, timeout_seconds=300):
+        """
+        Apply changes to pods on the node, until the watch times out
+
+        Returns False if the watch expired, and pods need to be listed again.
+        """
+        if isinstance(self.kube, KubeClient):
+            stream = self.kube.watch_pod_for_all_namespaces
+        else:
+            import kubernetes.watch
+
+            stream = partial(
+                kubernetes.watch.Watch().stream, self.kube.list_pod_for_all_namespaces
+            )
+        try:
+            for event in stream(
+                field_selector=self.field_selector,
+                resource_version=self.resource_version,
+                timeout_seconds=timeout_seconds,
+            ):
+                if event["type"] == "ERROR":
+                    # e.g. 410 Gone, when our resource version is too old
+                    logging.info(f"Pod watch error: {event['raw_object']}")
+                    return False
+                self.apply(event["type"], event["object"])
+        except api_error(self.kube) as e:
+            if e.status == 410:
+                return False
+            raise
+        return True
+
+    def follow(self, retry_seconds=10):
+        """Keep the cache up to date, forever"""
+        listed = True
+        while True:
+            try:
+                if not listed:
+                    self.list_pods()
+                    listed = True
+                listed = self.watch()
+            except Exception as e:
+                logging.warning(f"Error watching pods on node {self.node}: {e}")
+                listed = False
+                time.sleep(retry_seconds)
+
+    def start(self):
+        """List pods on the node, and keep watching them in a background thread"""
+        self.list_pods()
+        thread = threading.Thread(target=self.follow, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,100 @@
+"""
+Decide when to collect garbage, and which images to remove
+
+These decisions work on plain data (usage numbers, the image -> layer graph),
+not on the docker API, so they are shared by the cleaner's main loop
+and the offline simulator (simulate.py).
+"""
+import re
+
+from .lru import lru_order
+from .planner import freed_in_order, plan_removal
+
+# "prune" deletes all unused images when pruning dangling images isn't enough,
+# "lru" removes least recently used images first,
+# "layers" removes the fewest images that free enough space
+POLICIES = ("prune", "lru", "layers")
+
+# units of ages like "72h" or "1h30m", like docker's `until` filter, and days
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 24 * 3600}
+
+
+def needs_gc(used, threshold_high):
+    """Whether usage is high enough to start a GC cycle"""
+    return used >= threshold_high
+
+
+def should_defer(used, threshold_emergency, busy):
+    """
+    Whether to put off a GC cycle because the docker daemon is `busy`
+
+    Only while usage is below the emergency threshold, above it GC can't wait.
+    """
+    return busy and used < threshold_emergency
+
+
+def should_prune_all(n_deleted, used, threshold_low):
+    """
+    Whether to delete more than dangling images
+
+    The first prunes only remove build cache and dangling images.
+    If they found nothing (`n_deleted` is 0), or usage is still above
+    the low threshold, more images need to go.
+    """
+    return not n_deleted or used > threshold_low
+
+
+def removal_order(policy, graph, layer_sizes, candidates, need_bytes, last_used=None):
+    """
+    Order in which to remove images with the "lru" or "layers" policy
+
+    graph: {image id: [layers]} for all images, see planner.plan_removal
+    layer_sizes: {layer: bytes}
+    candidates: ids of images that may be removed
+    need_bytes: bytes to free, the "layers" policy plans only that much
+    last_used: {image id: when it was last used}, for the "lru" policy
+
+    Returns (image ids in removal order, {image id: bytes freed}).
+    """
+    if policy == "lru":
+        order = lru_order(candidates, last_used)
+        return order, freed_in_order(graph, layer_sizes, order)
+    if policy == "layers":
+        plan = plan_removal(graph, layer_sizes, candidates, need_bytes)
+        return [image_id for image_id, _ in plan], dict(plan)
+    raise ValueError(f"No removal order for policy {policy!r}")
+
+
+def parse_age(age):
+    """Seconds in an age like "7d", "72h" or "1h30m" """
+    age = age.strip()
+    parts = re.findall(r"(\d+(?:\.\d+)?)([smhd])", age)
+    if not parts or "".join(n + unit for n, unit in parts) != age:
+        raise ValueError(f"Age must be like 7d, 72h or 1h30m, got {age!r}")
+    return sum(float(n) * AGE_UNITS[unit] for n, unit in parts)
+
+
+def until_steps(ages, until):
+    """
+    Split images to prune into steps, oldest first
+
+    Like pruning with docker's `until` filter at each age of a ladder,
+    e.g. 7d, then 72h, then 24h, then everything.
+
+    ages: {image id: seconds since it was pulled}, in removal order
+    until: ages in seconds, in any order
+
+    Returns [(age, image ids pulled more than `age` ago)] from the oldest
+    age down, then (None, all other image ids), each in removal order.
+    Steps without images are left out.
+    """
+    steps = []
+    remaining = list(ages)
+    for age in sorted(until, reverse=True):
+        step = [image_id for image_id in remaining if ages[image_id] > age]
+        if step:
+            steps.append((age, step))
+            remaining = [image_id for image_id in remaining if ages[image_id] <= age]
+    if remaining:
+        steps.append((None, remaining))
+    return steps
@@ -0,0 +1,138 @@
+"""
+Reserve disk space on demand, for builds
+
+The cleaner checks usage every DOCKER_IMAGE_CLEANER_INTERVAL_SECONDS,
+so a build can fill the disk between checks and fail.
+With DOCKER_IMAGE_CLEANER_RESERVE_PORT set, a client on the node
+(e.g. a BinderHub build pod) can ask for free space before it needs it:
+
+    POST /reserve?bytes=10737418240&timeout=300
+
+This wakes the main loop, which runs a check right away, collecting garbage
+until at least that many bytes are free, and answers once it is done:
+
+- 200 if enough space is free
+- 507 if it isn't, even after collecting garbage
+- 503 if the check didn't finish within `timeout` seconds
+
+with a JSON body of {"requested_bytes": ..., "free_bytes": ...}.
+Requests arriving while the loop sleeps, or during a check, are served
+together by the next check, which frees enough for the largest of them.
+"""
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GB = 2**30
+
+
+class Reservations:
+    """
+    Requests for free space, shared between the server threads and the main loop
+
+    `wake` is an asyncio.Event on `loop`, set when a request arrives.
+    The main loop calls begin() at the start of each check,
+    and finish() at the end.
+    """
+
+    def __init__(self, loop, wake, max_timeout=600):
+        self.loop = loop
+        self.wake = wake
+        self.max_timeout = max_timeout
+        self._cond = threading.Condition()
+        # [{"bytes": requested, "free": free bytes once answered}]
+        self._pending = []
+        self._current = []
+
+    def reserve(self, nbytes, timeout):
+        """
+        Ask for `nbytes` to be free, waiting up to `timeout` seconds
+
+        Called from server threads. Returns the free bytes after the next
+        check, or None if it didn't finish in time.
+        """
+        request = {"bytes": nbytes, "free": None}
+        with self._cond:
+            self._pending.append(request)
+        self.loop.call_soon_threadsafe(self.wake.set)
+        with self._cond:
+            self._cond.wait_for(
+                lambda: request["free"] is not None, min(timeout, self.max_timeout)
+            )
+            if request["free"] is None:
+                # give up, whichever check it is waiting for
+                for requests in (self._pending, self._current):
+                    if request in requests:
+                        requests.remove(request)
+        return request["free"]
+
+    def begin(self):
+        """
+        Start serving the requests waiting so far
+
+        Returns (bytes to free for the largest request, number of requests).
+        """
+        with self._cond:
+            self._current.extend(self._pending)
+            self._pending = []
+            need = max((request["bytes"] for request in self._current), default=0)
+            return need, len(self._current)
+
+    def finish(self, free_bytes):
+        """Answer the requests served by this check, with the bytes now free"""
+        with self._cond:
+            for request in self._current:
+                request["free"] = free_bytes
+            self._current = []
+            self._cond.notify_all()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/reserve":
+            return self.send_json({"message": "Not found"}, 404)
+        query = parse_qs(url.query)
+        try:
+            nbytes = int(query["bytes"][0])
+            timeout = float(query.get("timeout", ["300"])[0])
+        except (KeyError, ValueError):
+            return self.send_json(
+                {"message": "bytes (an integer) is required, timeout must be a number"},
+                400,
+            )
+        logging.info(
+            f"{self.address_string()} asked for {nbytes / GB:.2f}GB free within {timeout:.0f}s"
+        )
+        free = self.server.reservations.reserve(nbytes, timeout)
+        if free is None:
+            status = 503
+        elif free < nbytes:
+            status = 507
+        else:
+            status = 200
+        self.send_json({"requested_bytes": nbytes, "free_bytes": free}, status)
+
+
+def serve(reservations, port, address="127.0.0.1"):
+    """Serve reservations on http://{address}:{port}/reserve in a background thread"""
+    logging.info(f"Serving space reservations on {address}:{port}")
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    server.reservations = reservations
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
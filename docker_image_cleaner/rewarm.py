@@ -0,0 +1,159 @@
+"""
+Pull hot images back after GC
+
+Removing all unused images also removes images that are expensive to be
+missing, e.g. the default singleuser image of a JupyterHub, adding minutes
+to the next spawn on the node. After a GC cycle, a configured list of
+hot images, highest priority first, is pulled again in a background thread,
+if missing, with a limit on concurrent pulls, time and bytes pulled.
+No more pulls start once usage gets near the high threshold,
+or when the next GC cycle starts.
+"""
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import metrics, tracing
+from .pods import image_refs, normalize_ref
+
+GB = 2**30
+
+
+def parse_refs(value):
+    """Image references from a comma-separated list, in priority order"""
+    refs = []
+    for ref in value.split(","):
+        ref = normalize_ref(ref.strip()) if ref.strip() else None
+        if ref and ref not in refs:
+            refs.append(ref)
+    return refs
+
+
+def missing_refs(refs, images):
+    """References in `refs` not found among docker `images`, in order"""
+    present = set()
+    for image in images:
+        present.update(image_refs(image))
+    return [ref for ref in refs if ref not in present]
+
+
+def _pull(docker_client, ref):
+    tic = time.perf_counter()
+    with tracing.span("rewarm_pull", image=ref) as trace:
+        # docker_client.images.pull: https://docker-py.readthedocs.io/en/stable/images.html#docker.models.images.ImageCollection.pull
+        image = docker_client.images.pull(ref)
+        trace["bytes"] = image.attrs.get("Size", 0)
+    return time.perf_counter() - tic, image
+
+
+class Rewarmer:
+    """
+    Pull `refs` (normalized, highest priority first) when they are missing
+
+    Up to `max_concurrency` pulls run at the same time. No more pulls start
+    after `time_budget` seconds, or once `max_bytes` have been pulled, if set.
+    """
+
+    def __init__(
+        self, docker_client, refs, max_concurrency=2, time_budget=600, max_bytes=0
+    ):
+        self.docker_client = docker_client
+        self.refs = refs
+        self.max_concurrency = max_concurrency
+        self.time_budget = time_budget
+        self.max_bytes = max_bytes
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self, images, used, limit, get_used=None):
+        """
+        Pull hot images missing from docker `images`, until usage reaches `limit`
+
+        Usage (`used`, in the units of the thresholds) is rechecked with
+        get_used() after each pull, or, without get_used, estimated by adding
+        the size of each pulled image.
+        Image sizes include layers shared with images already there,
+        so bytes pulled are an upper bound of what was downloaded.
+
+        Returns (pulled references, bytes pulled).
+        """
+        refs = iter(missing_refs(self.refs, images))
+        pulled = []
+        pulled_bytes = 0
+        pending = {}
+        tic = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            while True:
+                while len(pending) < self.max_concurrency and not self._stop.is_set():
+                    if used >= limit:
+                        logging.info(
+                            "Stopped pulling hot images, usage is near the threshold"
+                        )
+                        self._stop.set()
+                        break
+                    if time.perf_counter() - tic > self.time_budget:
+                        logging.info(
+                            f"Stopped pulling hot images after {self.time_budget:.0f} seconds"
+                        )
+                        self._stop.set()
+                        break
+                    if self.max_bytes and pulled_bytes >= self.max_bytes:
+                        logging.info(
+                            f"Stopped pulling hot images after {pulled_bytes / GB:.2f}GB"
+                        )
+                        self._stop.set()
+                        break
+                    ref = next(refs, None)
+                    if ref is None:
+                        break
+                    # pull spans belong to the GC cycle that started the rewarm
+                    context = contextvars.copy_context()
+                    future = pool.submit(context.run, _pull, self.docker_client, ref)
+                    pending[future] = ref
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ref = pending.pop(future)
+                    try:
+                        duration, image = future.result()
+                    except Exception as e:
+                        logging.warning(f"Error pulling hot image {ref}: {e}")
+                        continue
+                    size = image.attrs.get("Size", 0)
+                    logging.info(
+                        f"Pulled hot image {ref}, {size / GB:.2f}GB, in {duration:.1f}s"
+                    )
+                    metrics.rewarm_pull_duration.observe(duration)
+                    metrics.rewarm_pulled_bytes.inc(size)
+                    pulled.append(ref)
+                    pulled_bytes += size
+                    if get_used is None:
+                        used += size / GB
+                    else:
+                        used = get_used()
+        if pulled:
+            logging.info(
+                f"Pulled {len(pulled)} hot images, about {pulled_bytes / GB:.2f}GB, "
+                f"in {time.perf_counter() - tic:.0f} seconds"
+            )
+        return pulled, pulled_bytes
+
+    def start(self, *args, **kwargs):
+        """Call run() in a background thread"""
+        self._stop.clear()
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self.run, *args), kwargs=kwargs, daemon=True
+        )
+        self._thread.start()
+        return self._thread
+
+    def stop(self, wait=True):
+        """Start no more pulls, and wait for those in progress to finish"""
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,285 @@
+"""
+Measure the size of directory trees
+
+Used for the absolute threshold mode, where /var/lib/docker
+may contain millions of files.
+
+Directories are listed with os.scandir,
+so each file costs a single lstat instead of the
+isfile + getsize pair of os.walk based scanning.
+Subtrees (e.g. overlay2/<layer>) are scanned in parallel threads,
+which works because scandir and stat release the GIL.
+
+When only whether usage is above a threshold matters,
+estimate_size scans a random sample of the subtrees instead,
+and extrapolates with a confidence interval.
+"""
+import math
+import os
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# split the tree into one task per directory at this depth,
+# e.g. /var/lib/docker/overlay2/<layer>
+SPLIT_DEPTH = 2
+
+
+def _scan_dir(dirpath, total, links, subdirs):
+    """
+    Scan one directory, without descending into subdirectories
+
+    Sizes of regular files with a single link are added to `total`,
+    which is returned.
+    Files with more than one link are recorded in `links` by inode,
+    so they are only counted once.
+    Subdirectories are appended to `subdirs`.
+
+    Symlinks are not followed, and are not counted.
+    """
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink > 1:
+                        links[(st.st_dev, st.st_ino)] = st.st_size
+                    else:
+                        total += st.st_size
+            except OSError:
+                # file removed while scanning
+                continue
+    return total
+
+
+def _scan_tree(top):
+    """
+    Scan a whole subtree
+
+    Returns (total, links), see _scan_dir.
+    Like os.walk, directories that cannot be read are skipped,
+    e.g. layers removed while we are scanning.
+    """
+    total = 0
+    links = {}
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            total = _scan_dir(dirpath, total, links, stack)
+        except OSError:
+            continue
+    return total, links
+
+
+def _split(path, split_depth):
+    """
+    Scan the top `split_depth` levels of `path`
+
+    Returns (total, links, dirs), see _scan_dir,
+    where `dirs` are the directories at `split_depth`, left to scan.
+    Raises OSError if `path` itself cannot be read.
+    """
+    total = 0
+    links = {}
+    level = [path]
+    for depth in range(split_depth):
+        subdirs = []
+        for dirpath in level:
+            try:
+                total = _scan_dir(dirpath, total, links, subdirs)
+            except OSError:
+                if dirpath == path:
+                    raise
+        level = subdirs
+    return total, links, level
+
+
+def _scan_trees(tasks, workers):
+    """Scan subtrees with a pool of `workers` threads, returns a list of (total, links)"""
+    if workers > 1 and len(tasks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_scan_tree, tasks))
+    return [_scan_tree(task) for task in tasks]
+
+
+def _cached(dirs, cache):
+    """
+    Split directories into those with a size in `cache`, and those without
+
+    Returns (total cached size, directories to scan).
+    """
+    total = 0
+    tasks = []
+    for dirpath in dirs:
+        size = cache.lookup(dirpath) if cache else None
+        if size is None:
+            tasks.append(dirpath)
+        else:
+            total += size
+    return total, tasks
+
+
+def scan_size(path, workers=1, split_depth=SPLIT_DEPTH, cache=None):
+    """
+    Total size in bytes of the files in a directory tree
+
+    Directories `split_depth` levels below `path` are scanned
+    as separate tasks by a pool of `workers` threads.
+
+    If given, `cache` (a layer_cache.LayerSizeCache) is asked for the size
+    of each task before scanning it, and is given the sizes it didn't have.
+    Hard links between cached directories are counted in each of them.
+
+    Symlinks are not followed,
+    and files with multiple hard links are only counted once.
+
+    Raises OSError if `path` itself cannot be read.
+    """
+    total, links, level = _split(path, split_depth)
+    # everything below split_depth is scanned in the pool
+    cached, tasks = _cached(level, cache)
+    total += cached
+    results = _scan_trees(tasks, workers)
+
+    for task, (task_total, task_links) in zip(tasks, results):
+        if cache:
+            cache.store(task, task_total + sum(task_links.values()))
+        total += task_total
+        links.update(task_links)
+
+    return total + sum(links.values())
+
+
+def count_inodes(top):
+    """
+    Number of distinct inodes in a directory tree, including `top`
+
+    Hard links are counted once, symlinks are counted but not followed.
+    Inode numbers come from the directory listings, without a stat per file.
+    Returns 0 if `top` cannot be read, e.g. a layer being removed.
+    """
+    inodes = set()
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    inodes.add(entry.inode())
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            if dirpath == top:
+                return 0
+            continue
+    return len(inodes) + 1
+
+
+SizeEstimate = namedtuple("SizeEstimate", ["size", "low", "high", "sampled", "tasks"])
+
+
+def _extrapolate(known, samples, population, z):
+    """
+    Estimate a total from a simple random sample of subtree sizes
+
+    `known` bytes are counted exactly, `samples` are sizes of
+    subtrees sampled from `population` subtrees.
+    Returns (estimate, low, high), the bounds of a normal confidence interval
+    with `z` standard errors, using the finite population correction.
+    """
+    n = len(samples)
+    sampled = sum(samples)
+    if n >= population:
+        return known + sampled, known + sampled, known + sampled
+    mean = sampled / n
+    if n < 2:
+        # no idea of the spread yet
+        return known + population * mean, known + sampled, math.inf
+    variance = sum((size - mean) ** 2 for size in samples) / (n - 1)
+    standard_error = (
+        population
+        * math.sqrt(variance / n)
+        * math.sqrt((population - n) / (population - 1))
+    )
+    estimate = known + population * mean
+    # we know at least the sampled subtrees are there
+    low = max(estimate - z * standard_error, known + sampled)
+    return estimate, low, estimate + z * standard_error
+
+
+def estimate_size(
+    path,
+    threshold,
+    max_error=0.05,
+    time_budget=None,
+    workers=1,
+    split_depth=SPLIT_DEPTH,
+    cache=None,
+    z=1.96,
+    min_samples=10,
+    rng=random,
+):
+    """
+    Estimate the total size in bytes of a directory tree, see scan_size
+
+    Only whether the size is above or below `threshold` matters,
+    so instead of scanning every directory `split_depth` levels below `path`,
+    a random sample of them is scanned, and the total extrapolated.
+    Sampling continues until the confidence interval (`z` standard errors)
+    is within `max_error` (a fraction) of the estimate,
+    or `time_budget` seconds have passed.
+    If the interval then includes `threshold`, the rest is scanned after all,
+    and the size is exact.
+
+    Sizes from `cache` are exact, only directories not in it are sampled.
+    Hard links between sampled directories are counted in each of them.
+
+    Returns a SizeEstimate: (size, low, high, sampled, tasks),
+    with the number of directories scanned and the number that needed scanning.
+    """
+    tic = time.perf_counter()
+    total, links, level = _split(path, split_depth)
+    cached, tasks = _cached(level, cache)
+    known = total + sum(links.values()) + cached
+    order = list(tasks)
+    rng.shuffle(order)
+    # {task: (total, links)}
+    scanned = {}
+
+    def scan(batch):
+        for task, (task_total, task_links) in zip(batch, _scan_trees(batch, workers)):
+            if cache:
+                cache.store(task, task_total + sum(task_links.values()))
+            scanned[task] = (task_total, task_links)
+
+    def bounds():
+        samples = [t + sum(task_links.values()) for t, task_links in scanned.values()]
+        return _extrapolate(known, samples, len(order), z)
+
+    round_size = max(workers, min_samples)
+    while len(scanned) < len(order):
+        scan(order[len(scanned) : len(scanned) + round_size])
+        if len(scanned) < len(order):
+            estimate, low, high = bounds()
+            if high - estimate <= max_error * estimate:
+                break
+            if time_budget is not None and time.perf_counter() - tic >= time_budget:
+                break
+
+    estimate, low, high = bounds()
+    if len(scanned) < len(order) and low <= threshold <= high:
+        # too close to call, scan the rest
+        scan(order[len(scanned) :])
+
+    if len(scanned) == len(order):
+        # exact, counting hard links once, like scan_size
+        for task_total, task_links in scanned.values():
+            total += task_total
+            links.update(task_links)
+        size = total + cached + sum(links.values())
+        return SizeEstimate(size, size, size, len(scanned), len(order))
+    return SizeEstimate(estimate, low, high, len(scanned), len(order))
@@ -0,0 +1,101 @@
+"""
+Decide how long to wait before checking disk usage again
+
+Keeps a short history of usage samples to estimate how fast the disk fills.
+The closer the projected time to reach the threshold, the sooner we check
+again, so a build burst doesn't fill the disk between two checks.
+When the disk isn't filling up and is far from the threshold,
+checks back off, which saves expensive scans in absolute mode.
+"""
+import time
+from collections import deque
+
+
+class PollScheduler:
+    """
+    Choose the interval until the next usage check
+
+    Intervals stay between `min_interval` and `max_interval` seconds,
+    starting from `interval`.
+    `used` and `threshold` can be in any unit, as long as it is the same.
+    """
+
+    # check again after this fraction of the projected time to the threshold
+    safety_factor = 0.5
+    # back off only when at least this fraction of the threshold is free
+    idle_headroom = 0.1
+    # multiply the interval by this when backing off
+    backoff_factor = 2
+
+    def __init__(
+        self,
+        threshold,
+        interval,
+        min_interval=None,
+        max_interval=None,
+        history=10,
+        clock=time.monotonic,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.min_interval = interval if min_interval is None else min_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.samples = deque(maxlen=history)
+        self.clock = clock
+        self._last_interval = interval
+
+    def record(self, used):
+        """Record a usage sample, taken now"""
+        self.samples.append((self.clock(), used))
+
+    def reset(self):
+        """
+        Forget the usage history
+
+        e.g. after deleting images, which isn't representative of the fill rate.
+        """
+        self.samples.clear()
+        self._last_interval = self.interval
+
+    def fill_rate(self):
+        """
+        Estimated change in usage per second
+
+        The least-squares slope of the recorded samples,
+        or None if there aren't enough samples.
+        """
+        if len(self.samples) < 2:
+            return None
+        n = len(self.samples)
+        mean_t = sum(t for t, used in self.samples) / n
+        mean_used = sum(used for t, used in self.samples) / n
+        var_t = sum((t - mean_t) ** 2 for t, used in self.samples)
+        if var_t == 0:
+            return None
+        cov = sum((t - mean_t) * (used - mean_used) for t, used in self.samples)
+        return cov / var_t
+
+    def time_to_threshold(self):
+        """Projected seconds until usage reaches the threshold, or None"""
+        rate = self.fill_rate()
+        if not rate or rate <= 0:
+            return None
+        used = self.samples[-1][1]
+        return max(self.threshold - used, 0) / rate
+
+    def next_interval(self):
+        """Seconds to wait before the next check"""
+        rate = self.fill_rate()
+        if rate is None:
+            interval = self.interval
+        elif rate > 0:
+            interval = self.safety_factor * self.time_to_threshold()
+        else:
+            used = self.samples[-1][1]
+            if self.threshold - used >= self.idle_headroom * self.threshold:
+                interval = self._last_interval * self.backoff_factor
+            else:
+                interval = self.interval
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self._last_interval = interval
+        return interval
@@ -0,0 +1,394 @@
+"""
+Replay a trace of image use through the cleaner's decisions, offline
+
+Answers "how many re-pulls would this configuration cause?"
+before changing thresholds or policy in production.
+
+A trace is a file of JSON lines, one event per line, in time order,
+with `time` in seconds:
+
+    {"time": 0, "event": "pull", "image": "jupyter/base:1", "layers": [{"id": "l1", "size": 1000}]}
+    {"time": 5, "event": "start", "image": "jupyter/base:1"}
+    {"time": 60, "event": "stop", "image": "jupyter/base:1"}
+    {"time": 90, "event": "usage", "bytes": 5000}
+
+- pull: an image is pulled or built, with its layers (shared layers have the same id).
+  Pulling a reference again with different layers leaves the old image dangling.
+- start/stop: a container using the image starts or stops.
+  Starting an image that is no longer on the node pulls it again.
+- usage: bytes used by everything that isn't an image,
+  e.g. container filesystems and logs.
+
+Disk usage is the size of the layers of images on the node,
+plus the last reported other usage.
+Usage is checked like the cleaner does, at intervals chosen by a
+scheduler.PollScheduler, and the GC cycle (dangling images first,
+then the policy, see policy.py) runs on the state at that point in the trace.
+Images used by running containers are never deleted.
+
+GC cycles take no time in the trace. Time cordoned is estimated instead
+from `remove_seconds` per image removed.
+Like the cleaner, only deleting tagged images is cordoned,
+and only when at least `cordon_min_images` are planned for removal.
+With `prune_until` ages, the prune policy removes images pulled
+longer ago than each age first, like DOCKER_IMAGE_CLEANER_PRUNE_UNTIL.
+
+Usage:
+
+    python -m docker_image_cleaner.simulate trace.jsonl --threshold-high 80e9 --threshold-low 60e9 --policy prune lru layers
+"""
+import argparse
+import json
+import logging
+import sys
+
+from .policy import (
+    POLICIES,
+    needs_gc,
+    parse_age,
+    removal_order,
+    should_prune_all,
+    until_steps,
+)
+from .scheduler import PollScheduler
+
+GB = 2**30
+
+
+def load_trace(path):
+    """Read a trace of JSON lines from a file path, or "-" for stdin"""
+    if path == "-":
+        return [json.loads(line) for line in sys.stdin if line.strip()]
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Node:
+    """The images and containers on a simulated node"""
+
+    def __init__(self):
+        self.layer_sizes = {}
+        # {image id: [layer ids]}, images currently on the node
+        self.images = {}
+        # image id currently tagged by each reference
+        self.tags = {}
+        # layers of the version of each reference pulled last
+        self.latest = {}
+        # image ids of running containers, by reference
+        self.running = {}
+        self.last_used = {}
+        # when each image was last pulled
+        self.pulled = {}
+        self.other_bytes = 0
+        self._versions = {}
+
+    def layers(self):
+        """Layers of images on the node"""
+        return {layer for layers in self.images.values() for layer in layers}
+
+    def used(self):
+        """Bytes used on the node"""
+        return self.other_bytes + sum(self.layer_sizes[l] for l in self.layers())
+
+    def missing_bytes(self, layers):
+        """Bytes of `layers` not on the node, which a pull has to download"""
+        return sum(self.layer_sizes[l] for l in set(layers) - self.layers())
+
+    def image_id(self, ref, layers):
+        """A distinct id for each version of a reference"""
+        versions = self._versions.setdefault(ref, [])
+        if layers not in versions:
+            versions.append(layers)
+        return f"{ref}@{versions.index(layers)}"
+
+    def pull(self, ref, layers, now):
+        """
+        Pull `ref`, returns its image id
+
+        An image previously tagged `ref` with other layers becomes dangling.
+        """
+        image_id = self.image_id(ref, layers)
+        self.tags[ref] = image_id
+        self.images[image_id] = layers
+        self.latest[ref] = layers
+        self.last_used[image_id] = now
+        self.pulled[image_id] = now
+        return image_id
+
+    def dangling(self):
+        """Ids of images without a tag"""
+        return sorted(set(self.images) - set(self.tags.values()))
+
+    def in_use(self):
+        """Ids of images used by running containers"""
+        return {image_id for ids in self.running.values() for image_id in ids}
+
+    def delete(self, image_ids):
+        """Delete images, returns bytes freed"""
+        before = self.used()
+        for image_id in image_ids:
+            self.images.pop(image_id)
+            for ref, tagged in list(self.tags.items()):
+                if tagged == image_id:
+                    del self.tags[ref]
+        return before - self.used()
+
+
+class Simulation:
+    """
+    Replay a trace through one cleaner configuration
+
+    Thresholds are in bytes, like the "absolute" and "docker" threshold types.
+    """
+
+    def __init__(
+        self,
+        policy="prune",
+        threshold_high=80 * GB,
+        threshold_low=None,
+        interval=300,
+        min_interval=None,
+        max_interval=None,
+        remove_seconds=2,
+        cordon_min_images=1,
+        prune_until=(),
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"policy must be one of {', '.join(POLICIES)}, got {policy!r}"
+            )
+        self.policy = policy
+        self.threshold_high = threshold_high
+        self.threshold_low = threshold_high if threshold_low is None else threshold_low
+        self.remove_seconds = remove_seconds
+        self.cordon_min_images = cordon_min_images
+        self.prune_until = prune_until
+        self.now = 0
+        self.node = Node()
+        self.scheduler = PollScheduler(
+            threshold_high,
+            interval,
+            min_interval=min_interval,
+            max_interval=max_interval,
+            clock=lambda: self.now,
+        )
+        # images deleted by the cleaner, whose next use is a re-pull
+        self.deleted = set()
+        self.stats = {
+            "gc_runs": 0,
+            "images_deleted": 0,
+            "bytes_deleted": 0,
+            "repulls": 0,
+            "repulled_bytes": 0,
+            "peak_bytes": 0,
+            "cordoned_seconds": 0,
+        }
+
+    def run(self, trace):
+        """Replay all events of `trace`, returns stats"""
+        next_check = None
+        for event in trace:
+            t = event["time"]
+            if next_check is None:
+                next_check = t
+            while next_check <= t:
+                self.now = next_check
+                next_check += self.check()
+            self.now = t
+            self.apply(event)
+        return self.stats
+
+    def _pull(self, ref, layers):
+        image_id = self.node.image_id(ref, layers)
+        if image_id in self.deleted:
+            self.deleted.discard(image_id)
+            self.stats["repulls"] += 1
+            self.stats["repulled_bytes"] += self.node.missing_bytes(layers)
+        return self.node.pull(ref, layers, self.now)
+
+    def apply(self, event):
+        """Apply one trace event to the node"""
+        node = self.node
+        kind = event["event"]
+        ref = event.get("image")
+        t = event["time"]
+        if kind == "pull":
+            layers = []
+            for layer in event["layers"]:
+                node.layer_sizes[layer["id"]] = layer["size"]
+                layers.append(layer["id"])
+            self._pull(ref, layers)
+        elif kind == "start":
+            if ref not in node.latest:
+                raise ValueError(f"Image {ref} started before it was pulled, at {t}")
+            image_id = node.tags.get(ref)
+            if image_id is None:
+                # deleted, pull the last version again
+                image_id = self._pull(ref, node.latest[ref])
+            node.running.setdefault(ref, []).append(image_id)
+            node.last_used[image_id] = t
+        elif kind == "stop":
+            if node.running.get(ref):
+                node.running[ref].pop(0)
+        elif kind == "usage":
+            node.other_bytes = event["bytes"]
+        else:
+            raise ValueError(f"Unknown event {kind!r} at {t}")
+        self.stats["peak_bytes"] = max(self.stats["peak_bytes"], node.used())
+
+    def check(self):
+        """Check usage, collect garbage if needed, returns seconds until the next check"""
+        used = self.node.used()
+        self.scheduler.record(used)
+        if needs_gc(used, self.threshold_high):
+            self.gc()
+            self.scheduler.reset()
+        return self.scheduler.next_interval()
+
+    def _delete(self, image_ids, cordoned=False):
+        freed = self.node.delete(image_ids)
+        self.deleted.update(image_ids)
+        self.stats["images_deleted"] += len(image_ids)
+        self.stats["bytes_deleted"] += freed
+        if cordoned:
+            self.stats["cordoned_seconds"] += self.remove_seconds * len(image_ids)
+        return freed
+
+    def gc(self):
+        """One GC cycle, like the cleaner's main loop"""
+        node = self.node
+        self.stats["gc_runs"] += 1
+        in_use = node.in_use()
+        dangling = [i for i in node.dangling() if i not in in_use]
+        # pruned, uncordoned
+        self._delete(dangling)
+        used = node.used()
+        if not should_prune_all(len(dangling), used, self.threshold_low):
+            return
+        candidates = sorted(set(node.images) - in_use)
+        cordoned = len(candidates) >= self.cordon_min_images
+        if self.policy == "prune":
+            if not self.prune_until:
+                self._delete(candidates, cordoned)
+                return
+            ages = {i: self.now - node.pulled[i] for i in candidates}
+            for age, step in until_steps(ages, self.prune_until):
+                if age is None and used >= self.threshold_low:
+                    # the ladder wasn't enough, prune everything else
+                    self._delete(step, cordoned)
+                    return
+                for image_id in step:
+                    if used < self.threshold_low:
+                        return
+                    used -= self._delete([image_id], cordoned)
+            return
+        order, _ = removal_order(
+            self.policy,
+            node.images,
+            node.layer_sizes,
+            candidates,
+            used - self.threshold_low,
+            last_used=node.last_used,
+        )
+        # remove one at a time, until below the low threshold
+        for image_id in order:
+            if used < self.threshold_low:
+                break
+            used -= self._delete([image_id], cordoned)
+
+
+def simulate(trace, **kwargs):
+    """Replay `trace` with one configuration, see Simulation"""
+    return Simulation(**kwargs).run(trace)
+
+
+def format_report(results):
+    """Format {policy: stats} as a table"""
+    rows = [
+        ("gc runs", "gc_runs", "{}"),
+        ("images deleted", "images_deleted", "{}"),
+        ("GB deleted", "bytes_deleted", "{:.2f}"),
+        ("re-pulls", "repulls", "{}"),
+        ("GB re-pulled", "repulled_bytes", "{:.2f}"),
+        ("peak GB used", "peak_bytes", "{:.2f}"),
+        ("seconds cordoned", "cordoned_seconds", "{:.0f}"),
+    ]
+    policies = list(results)
+    lines = [f"{'':<18}" + "".join(f"{policy:>12}" for policy in policies)]
+    for label, key, fmt in rows:
+        values = []
+        for policy in policies:
+            value = results[policy][key]
+            if key.endswith("bytes"):
+                value = value / GB
+            values.append(f"{fmt.format(value):>12}")
+        lines.append(f"{label:<18}" + "".join(values))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a trace of image pulls, container starts and disk usage through the cleaner's decisions"
+    )
+    parser.add_argument("trace", help="JSON lines trace file, or - for stdin")
+    parser.add_argument(
+        "--policy",
+        nargs="+",
+        default=["prune"],
+        choices=POLICIES,
+        help="policies to compare",
+    )
+    parser.add_argument(
+        "--threshold-high", type=float, required=True, help="in bytes, e.g. 80e9"
+    )
+    parser.add_argument(
+        "--threshold-low", type=float, help="in bytes (default: threshold-high)"
+    )
+    parser.add_argument("--interval", type=float, default=300)
+    parser.add_argument("--min-interval", type=float)
+    parser.add_argument("--max-interval", type=float)
+    parser.add_argument(
+        "--remove-seconds",
+        type=float,
+        default=2,
+        help="time cordoned per image removed",
+    )
+    parser.add_argument(
+        "--cordon-min-images",
+        type=int,
+        default=1,
+        help="cordon only when removing at least this many images",
+    )
+    parser.add_argument(
+        "--prune-until",
+        nargs="+",
+        default=[],
+        help="with the prune policy, remove images pulled longer ago than these ages first, e.g. 7d 72h 24h",
+    )
+    parser.add_argument("--json", action="store_true", help="output JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.WARNING)
+    trace = load_trace(args.trace)
+    results = {}
+    for policy in args.policy:
+        results[policy] = simulate(
+            trace,
+            policy=policy,
+            threshold_high=args.threshold_high,
+            threshold_low=args.threshold_low,
+            interval=args.interval,
+            min_interval=args.min_interval,
+            max_interval=args.max_interval,
+            remove_seconds=args.remove_seconds,
+            cordon_min_images=args.cordon_min_images,
+            prune_until=[parse_age(age) for age in args.prune_until],
+        )
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print(format_report(results))
+
+
+if __name__ == "__main__":
+    main()
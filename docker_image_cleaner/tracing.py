@@ -0,0 +1,170 @@
+"""
+Trace where the time of each check and GC cycle goes
+
+Phases of the main loop (measuring usage, pruning, planning,
+cordoning, removing batches of images...) are wrapped in spans.
+When DOCKER_IMAGE_CLEANER_TRACE_PATH is set, each finished span is written
+as one JSON line, e.g.:
+
+    {"name": "prune_images", "cycle": 3, "id": 12, "parent": 9, "start": 1700000000.1, "duration": 2.5, "deleted": 4}
+
+`parent` is the id of the enclosing span, e.g. the "cycle" span.
+Spans started in executor threads (see cleaner.in_executor) keep their parent.
+
+Profiling (see Profiler) captures a CPU profile of one whole GC cycle,
+including the threads it starts, to a file readable by pstats or snakeviz.
+"""
+import contextvars
+import cProfile
+import itertools
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_output = None
+_ids = itertools.count(1)
+# (cycle, span id) of the current span
+_current = contextvars.ContextVar("span", default=(0, None))
+
+
+def configure(path):
+    """Write spans to `path`, appending, or to stdout if "-". Tracing is off if empty"""
+    global _output
+    if _output is not None and _output is not sys.stdout:
+        _output.close()
+    if not path:
+        _output = None
+    elif path == "-":
+        _output = sys.stdout
+    else:
+        _output = open(path, "a", buffering=1)
+
+
+@contextmanager
+def span(name, cycle=None, **attrs):
+    """
+    Time a phase, as a context manager
+
+    Yields a dict of attributes to record with the span,
+    which the phase may add to (e.g. how many images it deleted).
+    `cycle` starts a new cycle, other spans belong to the enclosing one.
+    """
+    if _output is None:
+        yield attrs
+        return
+    parent_cycle, parent = _current.get()
+    if cycle is None:
+        cycle = parent_cycle
+    span_id = next(_ids)
+    token = _current.set((cycle, span_id))
+    start = time.time()
+    tic = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        record = {
+            "name": name,
+            "cycle": cycle,
+            "id": span_id,
+            "parent": parent,
+            "start": start,
+            "duration": time.perf_counter() - tic,
+        }
+        record.update(attrs)
+        line = json.dumps(record, default=str)
+        with _lock:
+            _output.write(line + "\n")
+
+
+class Profiler:
+    """
+    CPU profile of one GC cycle, written to `path`
+
+    Profile each cycle with cycle(), or call start() before it and
+    stop(gc=...) after it. Cycles that don't collect garbage are discarded,
+    the first one that does is written, and profiling stops.
+
+    cProfile only profiles the thread that enables it,
+    so each thread started while profiling gets its own profile,
+    merged when writing. Work sent to the event loop's executor
+    is profiled by giving `loop` a new executor, with new threads.
+    """
+
+    def __init__(self, path, loop=None):
+        self.path = path
+        self.loop = loop
+        self.done = not path
+        self._profiles = []
+        self._main = None
+        self._executor = None
+
+    def _profile_thread(self, frame, event, arg):
+        # first profile event in a new thread, start its own profile
+        profile = cProfile.Profile()
+        with _lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        if self.done:
+            return
+        self._profiles = []
+        threading.setprofile(self._profile_thread)
+        if self.loop is not None:
+            self._executor = ThreadPoolExecutor()
+            self.loop.set_default_executor(self._executor)
+        self._main = cProfile.Profile()
+        self._main.enable()
+
+    def stop(self, gc=True):
+        """Stop profiling, writing the profile if this cycle collected garbage"""
+        if self.done:
+            return
+        self._main.disable()
+        threading.setprofile(None)
+        if self._executor is not None:
+            # threads exit, and stop adding to their profiles.
+            # Don't wait for a discarded cycle, e.g. when cancelled
+            self._executor.shutdown(wait=gc)
+            self.loop.set_default_executor(ThreadPoolExecutor())
+            self._executor = None
+        if not gc:
+            return
+        stats = pstats.Stats(self._main)
+        with _lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        stats.dump_stats(self.path)
+        logging.info(
+            f"Wrote CPU profile of a GC cycle ({len(profiles) + 1} threads) to {self.path}"
+        )
+        self.done = True
+
+    @contextmanager
+    def cycle(self, attrs):
+        """
+        Profile one cycle, as a context manager
+
+        `attrs` are the cycle's span attributes,
+        the profile is written if the cycle set attrs["gc"].
+        """
+        self.start()
+        gc = False
+        try:
+            yield
+            gc = attrs.get("gc", False)
+        finally:
+            self.stop(gc=gc)
@@ -26,6 +26,7 @@ setup(
     entry_points={
         "console_scripts": [
             "docker-image-cleaner = docker_image_cleaner.__main__:main",
+            "docker-image-cleaner-simulate = docker_image_cleaner.simulate:main",
         ]
     },
     python_requires=">=3.8",
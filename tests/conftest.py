@@ -1,12 +1,17 @@
 import os
 import sys
+import threading
 import time
+from pathlib import Path
 from unittest import mock
 
 import docker
 import pytest
 import requests
 
+# the fake docker daemon and kubernetes API server live with the benchmarks
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
 dind_container_name = "test-image-cleaner-dind"
 
 
@@ -181,6 +186,63 @@ def absolute_threshold():
         yield
 
 
+class FakeImage:
+    """A docker Image, with the attributes the cleaner reads"""
+
+    def __init__(
+        self,
+        id,
+        tags=(),
+        size=2**30,
+        created="2023-01-01T00:00:00Z",
+        layers=(),
+        digests=(),
+    ):
+        self.id = id
+        self.short_id = id[:12]
+        self.tags = list(tags)
+        self.attrs = {
+            "Size": size,
+            "Created": created,
+            "Metadata": {},
+            "RootFS": {"Layers": list(layers)},
+            "RepoDigests": list(digests),
+        }
+
+
+class FakeImages:
+    """docker_client.images, removing images with `latency`, or raising `errors` by id"""
+
+    def __init__(self, errors=None, latency=0):
+        self.removed = []
+        self.errors = errors or {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    def remove(self, image_id, force=False):
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            time.sleep(self.latency)
+            if image_id in self.errors:
+                raise self.errors[image_id]
+            with self.lock:
+                self.removed.append(image_id)
+        finally:
+            with self.lock:
+                self.concurrent -= 1
+
+
+class FakeClient:
+    """A docker client, for removing images"""
+
+    def __init__(self, errors=None, latency=0):
+        self.images = FakeImages(errors, latency)
+
+
 class Slept(Exception):
     """Exception for raising instead of sleeping"""
 
@@ -193,5 +255,18 @@ def sleep_stops():
     def raise_slept(t):
         raise Slept(t)
 
-    with mock.patch("time.sleep", raise_slept):
+    async def async_raise_slept(t):
+        raise Slept(t)
+
+    with mock.patch("time.sleep", raise_slept), mock.patch(
+        "asyncio.sleep", async_raise_slept
+    ):
+        yield
+
+
+@pytest.fixture
+def no_sleep():
+    """Cap sleeps instead of skipping them, FakeImages sleeps to simulate latency"""
+    real_sleep = time.sleep
+    with mock.patch("time.sleep", lambda t: real_sleep(min(t, 0.01))):
         yield
@@ -0,0 +1,35 @@
+from docker_image_cleaner.aimd import AIMDLimit
+
+
+def test_additive_increase():
+    limit = AIMDLimit(maximum=4, target_latency=1)
+    assert limit.limit == 1
+    limit.on_success(0.1)
+    assert limit.limit == 2
+    # one more per window of `limit` fast responses
+    limit.on_success(0.1)
+    assert limit.limit == 2
+    limit.on_success(0.1)
+    assert limit.limit == 3
+    for i in range(20):
+        limit.on_success(0.1)
+    assert limit.limit == 4
+
+
+def test_multiplicative_decrease():
+    limit = AIMDLimit(maximum=16, target_latency=1, initial=16)
+    limit.on_success(5)
+    assert limit.limit == 8
+    # the rest of the overloaded window doesn't decrease further
+    for i in range(7):
+        limit.on_timeout()
+    assert limit.limit == 8
+    limit.on_timeout()
+    assert limit.limit == 4
+
+
+def test_minimum():
+    limit = AIMDLimit(maximum=4, minimum=2, target_latency=1)
+    assert limit.limit == 2
+    limit.on_timeout()
+    assert limit.limit == 2
@@ -0,0 +1,59 @@
+"""
+Run the benchmarks at a tiny scale, so they don't break unnoticed
+
+See test_gc_cycle.py for the behavior of GC cycles against the fake docker daemon.
+"""
+import json
+
+import fake_docker
+import pytest
+from bench_gc import run_gc_cycle
+from bench_startup import run_startup
+from bench_startup import serve as serve_kube
+from results import Results
+from synthetic import make_docker_tree
+
+from docker_image_cleaner import cleaner
+
+
+def test_synthetic_tree(tmpdir):
+    expected = make_docker_tree(
+        str(tmpdir), layers=5, dirs_per_layer=2, files_per_dir=3
+    )
+    assert cleaner.get_absolute_size(str(tmpdir), workers=2) * cleaner.GB == expected
+
+
+@pytest.mark.parametrize("policy", ["prune", "lru", "layers"])
+def test_gc_cycle(policy):
+    docker = fake_docker.FakeDocker(images=50)
+    dangling = [i for i, image in docker.images.items() if not image["RepoTags"]]
+    seconds, stats = run_gc_cycle(docker, policy, high=0.5, low=0.4)
+    assert stats["images_deleted"] > 0
+    assert not set(dangling) & set(docker.images)
+    if policy == "prune":
+        assert stats["bytes_after"] == 0
+    else:
+        # images are deleted one by one, until below the low threshold
+        assert 0 < stats["bytes_after"] < 0.5 * stats["bytes_before"]
+
+
+@pytest.mark.parametrize("kind", ["kubernetes", "minimal"])
+def test_startup(kind):
+    server, host = serve_kube(3)
+    try:
+        stats = run_startup(kind, host, repeat=2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert stats["seconds"] > 0
+    assert stats["max_rss_mb"] > 0
+
+
+def test_results(tmpdir):
+    path = tmpdir.join("results.jsonl")
+    results = Results(str(path))
+    results.record("a", {"n": 1}, 0.5, extra=1)
+    results.record("b", {"n": 2}, 1.5)
+    records = [json.loads(line) for line in path.readlines()]
+    assert [r["benchmark"] for r in records] == ["a", "b"]
+    assert records[0]["extra"] == 1
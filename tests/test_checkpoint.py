@@ -0,0 +1,155 @@
+import threading
+from unittest import mock
+
+import pytest
+import requests
+from conftest import FakeClient, FakeImage
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.checkpoint import Checkpoint
+
+
+def test_checkpoint_resume(tmpdir):
+    path = str(tmpdir.join("checkpoint.json"))
+    checkpoint = Checkpoint(path)
+    checkpoint.begin(["a", "b", "c", "d"])
+    checkpoint.record(["a", "b"], 1, 100)
+
+    # after a crash
+    checkpoint = Checkpoint(path)
+    assert checkpoint.remaining == ["c", "d"]
+    assert (checkpoint.removed, checkpoint.freed_bytes) == (1, 100)
+    images = [FakeImage(i) for i in ["x", "d", "y", "c"]]
+    assert [image.id for image in checkpoint.resume(images)] == ["c", "d", "x", "y"]
+
+    checkpoint.finish()
+    assert Checkpoint(path).remaining == []
+    assert Checkpoint(path).resume(images) == images
+
+
+def test_remove_in_batches(no_sleep):
+    client = FakeClient()
+    images = [FakeImage(f"sha256:{i}") for i in range(10)]
+    checkpoint = Checkpoint()
+    usage = iter([4])
+    # 10GB used, each image is 1GB, rechecking finds that less is used
+    removed, freed, used = cleaner.remove_in_batches(
+        client,
+        images,
+        None,
+        10,
+        5,
+        0,
+        checkpoint,
+        batch_size=3,
+        recheck=lambda: next(usage),
+        estimate=True,
+    )
+    # estimated 7GB used after the first batch, but 4GB when rechecked
+    assert removed == images[:3]
+    assert used == 4
+    assert checkpoint.remaining == []
+    assert (checkpoint.removed, checkpoint.freed_bytes) == (3, 3 * cleaner.GB)
+
+
+def test_remove_in_batches_crash(tmpdir, no_sleep):
+    path = str(tmpdir.join("checkpoint.json"))
+    client = FakeClient(errors={"sha256:4": RuntimeError("crash")})
+    images = [FakeImage(f"sha256:{i}") for i in range(10)]
+    with pytest.raises(RuntimeError):
+        cleaner.remove_in_batches(
+            client,
+            images,
+            None,
+            100,
+            0,
+            0,
+            Checkpoint(path),
+            batch_size=3,
+            estimate=True,
+        )
+    # at most one batch of progress is lost
+    checkpoint = Checkpoint(path)
+    assert checkpoint.removed == 3
+    assert checkpoint.remaining == [image.id for image in images[3:]]
+
+
+def test_remove_in_batches_stops(no_sleep):
+    timeout = requests.exceptions.ReadTimeout("timeout")
+    client = FakeClient(errors={f"sha256:{i}": timeout for i in range(10)})
+    images = [FakeImage(f"sha256:{i}") for i in range(10)]
+    with mock.patch.object(
+        cleaner, "remove_images", wraps=cleaner.remove_images
+    ) as remove_images:
+        removed, freed, used = cleaner.remove_in_batches(
+            client, images, None, 10, 0, 0, Checkpoint(), batch_size=3, estimate=True
+        )
+    # the first batch stops at the first timeout, and no more batches are tried
+    assert removed == []
+    assert remove_images.call_count == 1
+
+
+def test_remove_in_steps(no_sleep):
+    client = FakeClient()
+    day = 24 * 3600
+    now = 100 * day
+    images = [
+        FakeImage(f"sha256:{i}", created=f"1970-01-{i + 1:02}T00:00:00Z")
+        for i in range(10)
+    ]
+    steps = cleaner.age_steps(images, {95 * day: "95d", 98 * day: "98d"}, now=now)
+    # pulled more than 98 days ago, then more than 95 days ago, then the others
+    assert [len(images) for _, images, _ in steps] == [2, 3, 5]
+    assert [remove_all for _, _, remove_all in steps] == [False, False, True]
+    assert steps[1][0] == "3 unused images pulled more than 95d ago"
+    removed, freed, used = cleaner.remove_in_steps(
+        client, steps, None, 10, 7, 0, Checkpoint(), estimate=True
+    )
+    # below the threshold during the first step, the others stay
+    assert removed == images[:4]
+    assert used == 6
+
+
+def test_remove_in_steps_plan(no_sleep):
+    client = FakeClient()
+    images = [FakeImage(f"sha256:{i}") for i in range(10)]
+    steps = [("older", images[:4], False), ("newer", images[4:], True)]
+    checkpoint = Checkpoint()
+    with mock.patch.object(checkpoint, "begin", wraps=checkpoint.begin) as begin:
+        cleaner.remove_in_steps(
+            client, steps, None, 10, 7, 0, checkpoint, batch_size=3, estimate=True
+        )
+    # one plan for all steps, done once usage is below the threshold
+    begin.assert_called_once()
+    assert begin.call_args[0][0] == [image.id for image in images]
+    assert checkpoint.remaining == []
+
+
+def test_remove_in_steps_cancel(no_sleep):
+    client = FakeClient()
+    images = [FakeImage(f"sha256:{i}") for i in range(10)]
+    steps = [("older", images[:4], False), ("newer", images[4:], True)]
+    cancel = threading.Event()
+    checkpoint = Checkpoint()
+    record = checkpoint.record
+
+    def record_and_cancel(*args):
+        record(*args)
+        cancel.set()
+
+    with mock.patch.object(checkpoint, "record", record_and_cancel):
+        removed, freed, used = cleaner.remove_in_steps(
+            client,
+            steps,
+            None,
+            10,
+            0,
+            0,
+            checkpoint,
+            batch_size=3,
+            cancel=cancel,
+            estimate=True,
+        )
+    # stopped after the first batch, the rest of the plan is kept to resume
+    assert removed == images[:3]
+    assert checkpoint.remaining == [image.id for image in images[3:]]
@@ -1,12 +1,17 @@
+import asyncio
 import os
 from pathlib import Path
 from unittest import mock
 
 import docker
 import pytest
-from conftest import Slept
+import requests
+from conftest import FakeImage, Slept
+from kubernetes.client import ApiException, V1ListMeta, V1PodList
 
-from docker_image_cleaner import cleaner
+from docker_image_cleaner import cleaner, planner
+from docker_image_cleaner.layer_cache import LayerInodeCache
+from docker_image_cleaner.lru import LastUsed
 
 here = Path(__file__).resolve().parent
 test_image = here.joinpath("test-image")
@@ -104,6 +109,181 @@ def test_get_absolute_size(tmpdir):
     assert 1.9 < get_used() < 2.2
 
 
+def test_get_usage_percent(tmpdir):
+    usage = cleaner.get_usage_percent(str(tmpdir))
+    assert set(usage) == {"blocks", "inodes"}
+    assert cleaner.get_used_percent(str(tmpdir)) == pytest.approx(max(usage.values()))
+    inodes = cleaner.get_inodes_to_free(usage["inodes"] - 1, str(tmpdir))
+    assert inodes == pytest.approx(os.statvfs(str(tmpdir)).f_files / 100, rel=0.01)
+
+
+def test_plan_inode_removal(tmpdir):
+    # "big" has one big file, "many" has many small files
+    images = []
+    for name, files in [("big", 1), ("many", 100), ("other", 10)]:
+        chain = planner.chain_ids([f"sha256:{name}"])
+        digest = chain[0][len("sha256:") :]
+        layerdb = tmpdir.join("image", "overlay2", "layerdb", "sha256", digest)
+        layerdb.join("cache-id").write(name, ensure=True)
+        diff = tmpdir.join("overlay2", name, "diff").ensure(dir=True)
+        for i in range(files):
+            diff.join(str(i)).write("x")
+        images.append(
+            FakeImage(f"sha256:{name}", [f"{name}:latest"], layers=[f"sha256:{name}"])
+        )
+    cache = LayerInodeCache(str(tmpdir))
+    planned, freed = cleaner.plan_inode_removal(images, images[:2], 50, cache)
+    assert [image.id for image in planned] == ["sha256:many"]
+    assert freed == {"sha256:many": 101}
+    # layers not found
+    cache = LayerInodeCache(str(tmpdir.join("nosuchdir")))
+    assert cleaner.plan_inode_removal(images, images[:2], 50, cache) == (
+        images[:2],
+        {},
+    )
+
+
+@pytest.mark.parametrize("policy", ["lru", "layers"])
+def test_plan_image_removal_in_use(tmpdir, policy):
+    images = [
+        FakeImage(f"sha256:{name}", [f"{name}:latest"], layers=[f"sha256:{name}"])
+        for name in "abc"
+    ]
+    client = mock.Mock()
+    client.containers.list.return_value = [mock.Mock(attrs={"Image": "sha256:a"})]
+    planned, freed = cleaner.plan_image_removal(
+        client,
+        images,
+        str(tmpdir),
+        3 * cleaner.GB,
+        policy=policy,
+        last_used=LastUsed(),
+        keep={"sha256:b"},
+    )
+    # images of containers are kept, like those in `keep`
+    assert planned == images[2:]
+
+
+def test_prune():
+    client = mock.Mock()
+    client.images.prune.return_value = {
+        "ImagesDeleted": [{"Deleted": "sha256:a"}, {"Untagged": "a:latest"}],
+        "SpaceReclaimed": 100,
+    }
+    client.containers.prune.return_value = {
+        "ContainersDeleted": None,
+        "SpaceReclaimed": 0,
+    }
+    assert cleaner.prune(client, "images", 0) == (2, 100)
+    client.images.prune.assert_called_with()
+    assert cleaner.prune(client, "images", 0, dangling=False) == (2, 100)
+    client.images.prune.assert_called_with(filters={"dangling": False})
+    assert cleaner.prune(client, "containers", 0) == (0, 0)
+
+
+def test_remove_image_delay(sleep_stops):
+    client = mock.Mock()
+    image = FakeImage("sha256:a")
+    # no delay, no sleep
+    assert cleaner._remove_image(client, image, 0) >= 0
+    client.images.remove.assert_called_with("sha256:a", force=True)
+    with pytest.raises(Slept):
+        cleaner._remove_image(client, image, 1)
+
+
+def test_prune_build_cache():
+    client = mock.Mock()
+    client.api.prune_builds.return_value = {
+        "CachesDeleted": ["a", "b"],
+        "SpaceReclaimed": 100,
+    }
+    assert cleaner.prune_build_cache(client, 0) == (2, 100)
+    client.api.prune_builds.assert_called_with()
+    cleaner.prune_build_cache(client, 0, keep_storage=10, until="24h")
+    client.api.prune_builds.assert_called_with(
+        keep_storage=10, filters={"until": "24h"}
+    )
+    client.api.prune_builds.return_value = {
+        "CachesDeleted": None,
+        "SpaceReclaimed": 0,
+    }
+    assert cleaner.prune_build_cache(client, 0) == (0, 0)
+    # e.g. an old daemon, pruning images goes on without it
+    client.api.prune_builds.side_effect = docker.errors.InvalidVersion("too old")
+    assert cleaner.prune_build_cache(client, 0, keep_storage=10) is None
+
+
+def test_daemon_load():
+    client = mock.Mock()
+    client.api.base_url = "http+docker://localhost"
+    client.containers.list.return_value = [mock.Mock(), mock.Mock()]
+    ping_seconds, builds = cleaner.daemon_load(client, 1, build_label="build=true")
+    assert 0 <= ping_seconds < 1
+    assert builds == 2
+    client.api.get.assert_called_with("http+docker://localhost/_ping", timeout=1)
+    client.containers.list.assert_called_with(
+        filters={"label": "build=true"}, sparse=True
+    )
+    client.api.get.side_effect = requests.exceptions.ReadTimeout()
+    assert cleaner.daemon_load(client, 1) == (float("inf"), 0)
+    client.api.get.side_effect = requests.exceptions.ConnectionError()
+    assert cleaner.daemon_load(client, 1) == (float("inf"), 0)
+
+
+def test_cordoned_cancelled():
+    kube = mock.Mock()
+
+    async def gc():
+        async with cleaner.cordoned(kube, "node"):
+            await asyncio.sleep(60)
+
+    async def cancel_gc():
+        task = asyncio.ensure_future(gc())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_gc())
+    # cordoned, then uncordoned
+    assert kube.patch_node.call_count == 2
+    assert kube.patch_node.call_args.args[1]["spec"]["unschedulable"] is False
+
+
+def test_recover_cordon():
+    kube = mock.Mock()
+    node_info = kube.read_node.return_value
+    node_info.spec.unschedulable = True
+    node_info.metadata.annotations = {cleaner.annotation_key: "true"}
+    cleaner.recover_cordon(kube, "node")
+    assert kube.patch_node.call_count == 1
+
+    # cordoned by someone else
+    node_info.metadata.annotations = None
+    cleaner.recover_cordon(kube, "node")
+    assert kube.patch_node.call_count == 1
+
+    # errors are not raised
+    kube.read_node.side_effect = RuntimeError("connection refused")
+    cleaner.recover_cordon(kube, "node")
+
+
+def test_start_pod_images():
+    kube = mock.Mock()
+    kube.list_pod_for_all_namespaces.return_value = V1PodList(
+        items=[], metadata=V1ListMeta(resource_version="1")
+    )
+    with mock.patch.object(cleaner.PodImages, "follow"):
+        assert cleaner.start_pod_images(kube, "node") is not None
+    # RBAC only allows getting and patching nodes
+    kube.list_pod_for_all_namespaces.side_effect = ApiException(status=403)
+    assert cleaner.start_pod_images(kube, "node") is None
+    # other errors are still raised
+    kube.list_pod_for_all_namespaces.side_effect = RuntimeError("connection refused")
+    with pytest.raises(RuntimeError):
+        cleaner.start_pod_images(kube, "node")
+
+
 def test_clean_nothing(dind, dind_dir, absolute_threshold, sleep_stops):
     """
     Tests pulling an image and running the cleaner with a high enough threshold
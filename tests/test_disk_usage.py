@@ -0,0 +1,80 @@
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.disk_usage import DockerDiskUsage, summarize_df
+
+# trimmed down response of /system/df
+df = {
+    "LayersSize": 3000,
+    "Images": [
+        {"Id": "sha256:used", "Size": 1500, "SharedSize": 500, "Containers": 1},
+        {"Id": "sha256:unused", "Size": 2000, "SharedSize": 500, "Containers": 0},
+        {"Id": "sha256:unknown", "Size": 100, "SharedSize": -1, "Containers": 0},
+    ],
+    "Containers": [
+        {"Id": "running", "SizeRw": 10, "State": "running"},
+        {"Id": "exited", "SizeRw": 20, "State": "exited"},
+    ],
+    "Volumes": [
+        {"Name": "v1", "UsageData": {"Size": 300, "RefCount": 0}},
+        {"Name": "v2", "UsageData": {"Size": -1, "RefCount": 1}},
+    ],
+    "BuildCache": [
+        {"ID": "a", "Size": 400, "InUse": False},
+        {"ID": "b", "Size": 50, "InUse": True},
+    ],
+}
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+
+    def df(self):
+        self.calls += 1
+        return df
+
+
+def test_summarize_df():
+    usage = summarize_df(df)
+    assert usage["images"] == {
+        "size": 3000,
+        "reclaimable": 1600,
+        "count": 3,
+        "reclaimable_count": 2,
+    }
+    assert usage["containers"] == {
+        "size": 30,
+        "reclaimable": 20,
+        "count": 2,
+        "reclaimable_count": 1,
+    }
+    assert usage["volumes"]["size"] == 300
+    assert usage["volumes"]["reclaimable"] == 300
+    assert usage["build_cache"]["size"] == 450
+    assert usage["build_cache"]["reclaimable"] == 400
+
+
+def test_summarize_df_empty():
+    usage = summarize_df({"LayersSize": 0, "Images": None, "Containers": None})
+    assert all(usage[kind]["size"] == 0 for kind in usage)
+
+
+def test_docker_disk_usage_ttl():
+    now = 0
+    client = FakeClient()
+    disk_usage = DockerDiskUsage(client, ttl=10, clock=lambda: now)
+    assert disk_usage.total() == 3000 + 30 + 300 + 450
+    assert client.calls == 1
+    now = 9
+    disk_usage.get()
+    assert client.calls == 1
+    now = 10
+    disk_usage.get()
+    assert client.calls == 2
+    disk_usage.invalidate()
+    disk_usage.get()
+    assert client.calls == 3
+
+
+def test_get_docker_size():
+    disk_usage = DockerDiskUsage(FakeClient())
+    assert cleaner.get_docker_size(disk_usage, "/ignored") == 3780 / cleaner.GB
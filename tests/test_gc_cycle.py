@@ -0,0 +1,271 @@
+"""
+End-to-end GC cycles of main() against a fake docker daemon
+
+The daemon (benchmarks/fake_docker.py) simulates images sharing base layers,
+and the cleaner runs in docker threshold mode, see benchmarks/bench_gc.py.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from unittest import mock
+from urllib.request import urlopen
+
+import fake_docker
+import pytest
+from bench_gc import CycleDone, run_gc_cycle
+
+from docker_image_cleaner import cleaner, lru, tracing
+from docker_image_cleaner.rewarm import Rewarmer
+
+
+def gc_cycle(docker, policy="prune", high=0.5, low=0.4, **kwargs):
+    """Run one GC cycle against `docker`, see bench_gc.run_gc_cycle"""
+    return run_gc_cycle(docker, policy, high=high, low=low, **kwargs)
+
+
+@pytest.fixture
+def serve_docker(tmpdir):
+    """
+    Serve fake_docker.FakeDocker daemons until the test is done
+
+    Returns a function serving one, and returning the environment
+    for main() to use it, in docker threshold mode.
+    """
+    servers = []
+
+    def serve(docker):
+        socket_path = str(tmpdir.join("docker.sock"))
+        servers.append(fake_docker.serve(socket_path, docker))
+        return {
+            "DOCKER_HOST": f"unix://{socket_path}",
+            "DOCKER_IMAGE_CLEANER_PATH_TO_CHECK": str(tmpdir),
+            "DOCKER_IMAGE_CLEANER_THRESHOLD_TYPE": "docker",
+        }
+
+    yield serve
+    for server in servers:
+        fake_docker.stop(server)
+
+
+def test_gc_cycle_build_cache():
+    """Pruning build cache first can be enough, keeping all tagged images"""
+    layers_size = fake_docker.FakeDocker(images=50).layers_size()
+    docker = fake_docker.FakeDocker(images=50, build_cache=layers_size)
+    tagged = [i for i, image in docker.images.items() if image["RepoTags"]]
+    seconds, stats = gc_cycle(docker, low=0.5)
+    assert stats["build_cache_bytes_after"] == 0
+    assert set(tagged) <= set(docker.images)
+
+
+@pytest.mark.parametrize(
+    "env",
+    [
+        {"DOCKER_IMAGE_CLEANER_PRUNE_BUILD_CACHE": "false"},
+        {"DOCKER_IMAGE_CLEANER_BUILD_CACHE_KEEP_STORAGE": str(100 * cleaner.GB)},
+    ],
+)
+def test_gc_cycle_keep_build_cache(env):
+    layers_size = fake_docker.FakeDocker(images=50).layers_size()
+    docker = fake_docker.FakeDocker(images=50, build_cache=layers_size)
+    build_cache_size = docker.build_cache_size()
+    seconds, stats = gc_cycle(docker, low=0.5, env=env)
+    assert stats["build_cache_bytes_after"] == build_cache_size
+    # images are pruned instead
+    assert stats["bytes_after"] == build_cache_size
+
+
+def test_gc_cycle_prune_until():
+    """Images pulled long ago are removed first, the most recent ones stay"""
+    docker = fake_docker.FakeDocker(images=50)
+    env = {"DOCKER_IMAGE_CLEANER_PRUNE_UNTIL": "20d,10d"}
+    seconds, stats = gc_cycle(docker, env=env)
+    assert stats["images_deleted"] > 0
+    assert 0 < stats["bytes_after"] < 0.5 * stats["bytes_before"]
+    # fake images were pulled in the last 30 days
+    ages = [
+        time.time() - lru.parse_docker_time(image["Created"])
+        for image in docker.images.values()
+    ]
+    assert max(ages) < 20 * 24 * 3600
+
+
+def test_gc_cycle_prune_until_shared_layers():
+    """
+    Removal stops below the low threshold by the layers it frees,
+    not image sizes, which count shared base layers once per image
+    """
+    docker = fake_docker.FakeDocker(images=50)
+    recent = {
+        image_id
+        for image_id, image in docker.images.items()
+        if image["RepoTags"]
+        and time.time() - lru.parse_docker_time(image["Created"]) < 10 * 24 * 3600
+    }
+    # one batch per step, so usage is estimated until the step is done
+    env = {
+        "DOCKER_IMAGE_CLEANER_PRUNE_UNTIL": "10d",
+        "DOCKER_IMAGE_CLEANER_BATCH_SIZE": "100",
+    }
+    seconds, stats = gc_cycle(docker, env=env, layerdb=True)
+    assert stats["bytes_after"] <= 0.4 * stats["bytes_before"]
+    # removing images pulled more than 10d ago was enough
+    assert recent <= set(docker.images)
+
+
+@pytest.mark.parametrize(
+    "load, emergency, deferred",
+    [
+        ({"ping_latency": 0.2}, 2, True),
+        ({"builds": 2}, 2, True),
+        ({"builds": 1}, 2, False),
+        # usage is above the emergency threshold
+        ({"builds": 2}, 0.9, False),
+    ],
+)
+def test_gc_cycle_busy_daemon(load, emergency, deferred):
+    """GC is put off while the daemon is busy, unless usage is critical"""
+    docker = fake_docker.FakeDocker(images=50, **load)
+    env = {
+        "DOCKER_IMAGE_CLEANER_THRESHOLD_EMERGENCY": str(
+            int(docker.layers_size() * emergency)
+        ),
+        "DOCKER_IMAGE_CLEANER_BUSY_PING_SECONDS": "0.1",
+        "DOCKER_IMAGE_CLEANER_BUILD_LABEL": "build=true",
+        "DOCKER_IMAGE_CLEANER_BUSY_BUILDS": "2",
+    }
+    seconds, stats = gc_cycle(docker, env=env)
+    assert (stats["images_deleted"] == 0) == deferred
+
+
+def test_gc_cycle_rewarm():
+    """Hot images are pulled again after GC"""
+    docker = fake_docker.FakeDocker(images=50)
+    tags = sorted(docker.registry)
+    hot = tags[:3]
+    env = {"DOCKER_IMAGE_CLEANER_REWARM_IMAGES": ",".join(hot + ["missing:1"])}
+    start = Rewarmer.start
+
+    def start_and_wait(self, *args, **kwargs):
+        # pull before the cycle ends, instead of in the background
+        start(self, *args, **kwargs).join()
+
+    with mock.patch.object(Rewarmer, "start", start_and_wait):
+        seconds, stats = gc_cycle(docker, env=env)
+    tags = {tag for image in docker.images.values() for tag in image["RepoTags"]}
+    assert tags == set(hot)
+    assert 0 < stats["bytes_after"] < 0.5 * stats["bytes_before"]
+
+
+def test_gc_cycle_reserve():
+    """A build asks for space between checks, and gets it from a check right away"""
+    docker = fake_docker.FakeDocker(images=50)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {"DOCKER_IMAGE_CLEANER_RESERVE_PORT": str(port)}
+    need = int(0.5 * docker.layers_size())
+    responses = []
+
+    def reserve():
+        url = f"http://127.0.0.1:{port}/reserve?bytes={need}&timeout=10"
+        with urlopen(url, data=b"") as r:
+            responses.append((r.status, json.load(r)))
+
+    thread = threading.Thread(target=reserve)
+
+    async def sleep(scheduler, wake):
+        if thread.is_alive():
+            # answered before sleeping again
+            thread.join()
+            raise CycleDone()
+        # nothing to do at the first check, until the request wakes the loop
+        thread.start()
+        await asyncio.wait_for(wake.wait(), 10)
+        wake.clear()
+
+    # the high threshold is above usage, only the reservation triggers GC
+    seconds, stats = gc_cycle(docker, high=1.5, low=1.5, env=env, sleep=sleep)
+    assert stats["images_deleted"] > 0
+    [(status, body)] = responses
+    assert status == 200
+    assert body["free_bytes"] >= need
+
+
+def test_gc_cycle_traced(tmpdir):
+    trace_path = tmpdir.join("trace.jsonl")
+    profile_path = tmpdir.join("gc.prof")
+    env = {
+        "DOCKER_IMAGE_CLEANER_TRACE_PATH": str(trace_path),
+        "DOCKER_IMAGE_CLEANER_PROFILE_PATH": str(profile_path),
+    }
+    docker = fake_docker.FakeDocker(images=20)
+    try:
+        gc_cycle(docker, env=env)
+    finally:
+        tracing.configure("")
+    spans = [json.loads(line) for line in trace_path.readlines()]
+    cycle = spans[-1]
+    assert cycle["name"] == "cycle"
+    assert cycle["gc"]
+    names = {span["name"] for span in spans}
+    # removing all unused images is a single prune request
+    assert {"measure_usage", "prune_images", "plan", "prune_all_images"} <= names
+    assert all(span["cycle"] == cycle["cycle"] for span in spans)
+    assert profile_path.exists()
+
+
+def test_sigterm(serve_docker):
+    """main() stops cleanly on SIGTERM, while waiting for the next check"""
+    docker = fake_docker.FakeDocker(images=5)
+    environ = {
+        **serve_docker(docker),
+        "DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH": str(100 * cleaner.GB),
+    }
+    timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM))
+    try:
+        with mock.patch.dict(os.environ, environ):
+            timer.start()
+            # returns instead of sleeping for 300 seconds
+            cleaner.main()
+    finally:
+        timer.cancel()
+    assert len(docker.images) == 5
+
+
+def test_sigterm_removing(serve_docker):
+    """SIGTERM while removing images stops starting removals, instead of finishing them"""
+    docker = fake_docker.FakeDocker(images=50, remove_latency=0.1)
+    environ = {
+        **serve_docker(docker),
+        "DOCKER_IMAGE_CLEANER_THRESHOLD_HIGH": str(int(0.5 * docker.layers_size())),
+        "DOCKER_IMAGE_CLEANER_THRESHOLD_LOW": str(cleaner.GB),
+        # removing images one by one, least recently used first
+        "DOCKER_IMAGE_CLEANER_POLICY": "lru",
+        "DOCKER_IMAGE_CLEANER_DELAY_SECONDS": "0",
+    }
+
+    def count_tagged():
+        with docker.lock:
+            return sum(1 for image in docker.images.values() if image["RepoTags"])
+
+    tagged = count_tagged()
+
+    def kill_when_removing():
+        # after pruning dangling images, once tagged images are being removed
+        while count_tagged() == tagged:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    killer = threading.Thread(target=kill_when_removing, daemon=True)
+    with mock.patch.dict(os.environ, environ):
+        killer.start()
+        tic = time.perf_counter()
+        cleaner.main()
+        seconds = time.perf_counter() - tic
+    # removals in progress finish, the others don't start
+    assert len(docker.images) > tagged // 2
+    assert seconds < 2
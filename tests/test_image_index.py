@@ -0,0 +1,143 @@
+import sqlite3
+
+import docker
+import pytest
+
+from docker_image_cleaner.image_index import ImageIndex
+
+
+class FakeAPI:
+    """The low-level docker API calls the index makes"""
+
+    def __init__(self):
+        self.images_ = {}
+        self.inspected = []
+
+    def add(self, image_id, tags=(), parent="", size=100):
+        self.images_[image_id] = {
+            "Id": image_id,
+            "Parent": parent,
+            "RepoTags": list(tags),
+            "RepoDigests": [],
+            "Size": size,
+            "Created": "2023-01-01T00:00:00.000000000Z",
+            "Metadata": {"LastTagTime": "2023-01-02T00:00:00.000000000Z"},
+            "RootFS": {"Type": "layers", "Layers": [f"sha256:layer-{image_id}"]},
+        }
+
+    def images(self, all=False):
+        return [
+            {
+                "Id": image["Id"],
+                "ParentId": image["Parent"],
+                "RepoTags": image["RepoTags"] or ["<none>:<none>"],
+                "RepoDigests": [],
+                "Size": image["Size"],
+            }
+            for image in self.images_.values()
+        ]
+
+    def inspect_image(self, ref):
+        self.inspected.append(ref)
+        for image in self.images_.values():
+            if ref == image["Id"] or ref in image["RepoTags"]:
+                return image
+        raise docker.errors.ImageNotFound(ref)
+
+
+class FakeClient:
+    def __init__(self):
+        self.api = FakeAPI()
+
+
+@pytest.fixture
+def client():
+    client = FakeClient()
+    client.api.add("sha256:a", ["a:1"])
+    client.api.add("sha256:b", ["b:1"], size=200)
+    return client
+
+
+def test_reconcile(client):
+    index = ImageIndex()
+    index.reconcile(client)
+    assert sorted(client.api.inspected) == ["sha256:a", "sha256:b"]
+    images = {image.id: image for image in index.images()}
+    assert images["sha256:b"].tags == ["b:1"]
+    assert images["sha256:b"].attrs["Size"] == 200
+    assert images["sha256:b"].attrs["RootFS"]["Layers"] == ["sha256:layer-sha256:b"]
+    assert images["sha256:b"].short_id == "sha256:b"
+
+    # only new images are inspected
+    client.api.inspected.clear()
+    client.api.add("sha256:c", ["c:1"])
+    del client.api.images_["sha256:a"]
+    client.api.images_["sha256:b"]["RepoTags"] = ["b:1", "b:latest"]
+    index.reconcile(client)
+    assert client.api.inspected == ["sha256:c"]
+    assert index.ids() == {"sha256:b", "sha256:c"}
+    images = {image.id: image for image in index.images()}
+    assert images["sha256:b"].tags == ["b:1", "b:latest"]
+
+
+def test_events(client):
+    index = ImageIndex()
+    index.reconcile(client)
+
+    client.api.add("sha256:c", ["c:1"])
+    index.apply_event(client, {"Action": "pull", "Actor": {"ID": "c:1"}})
+    assert "sha256:c" in index.ids()
+
+    # the tag moves to a new image
+    client.api.images_["sha256:a"]["RepoTags"] = []
+    client.api.add("sha256:d", ["a:1"])
+    index.apply_event(client, {"Action": "tag", "Actor": {"ID": "sha256:d"}})
+    images = {image.id: image for image in index.images()}
+    assert images["sha256:a"].tags == []
+    assert images["sha256:d"].tags == ["a:1"]
+
+    del client.api.images_["sha256:a"]
+    index.apply_event(client, {"Action": "delete", "Actor": {"ID": "sha256:a"}})
+    assert "sha256:a" not in index.ids()
+
+    # untagging an image that is gone removes it
+    del client.api.images_["sha256:b"]
+    index.apply_event(client, {"Action": "untag", "Actor": {"ID": "sha256:b"}})
+    assert index.ids() == {"sha256:c", "sha256:d"}
+    assert index.count() == 2
+
+
+def test_intermediate_images(client):
+    client.api.add("sha256:parent", parent="")
+    client.api.add("sha256:child", ["child:1"], parent="sha256:parent")
+    client.api.add("sha256:dangling")
+    index = ImageIndex()
+    index.reconcile(client)
+    assert "sha256:parent" in {image.id for image in index.images()}
+    top_level = {image.id for image in index.images(all=False)}
+    assert "sha256:parent" not in top_level
+    assert {"sha256:child", "sha256:dangling"} <= top_level
+
+
+def test_persist(client, tmpdir):
+    path = str(tmpdir.join("images.sqlite"))
+    ImageIndex(path).reconcile(client)
+
+    # a restart only inspects what changed
+    client.api.inspected.clear()
+    client.api.add("sha256:c", ["c:1"])
+    index = ImageIndex(path)
+    assert index.count() == 2
+    index.reconcile(client)
+    assert client.api.inspected == ["sha256:c"]
+
+
+def test_schema_change(client, tmpdir):
+    path = str(tmpdir.join("images.sqlite"))
+    ImageIndex(path).reconcile(client)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA user_version = 999")
+    db.commit()
+    db.close()
+    # rebuilt from scratch
+    assert ImageIndex(path).count() == 0
@@ -0,0 +1,103 @@
+import fake_kube
+import kubernetes.client
+import pytest
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.kube import ApiError, KubeClient, KubeObject
+from docker_image_cleaner.pods import PodImages
+
+
+@pytest.fixture
+def kube():
+    kube = fake_kube.FakeKube()
+    kube.add_node("node-1")
+    server = fake_kube.serve(kube)
+    yield kube, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _client(kind, host):
+    if kind == "minimal":
+        return KubeClient(host)
+    config = kubernetes.client.Configuration()
+    config.host = host
+    return kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(config))
+
+
+def test_kube_object():
+    pod = KubeObject(
+        {
+            "metadata": {"resourceVersion": "5", "labels": {"app": "jupyter"}},
+            "status": {"containerStatuses": [{"imageID": "sha256:abc"}]},
+        }
+    )
+    assert pod.metadata.resource_version == "5"
+    assert pod.metadata.labels.get("app") == "jupyter"
+    assert pod.status.container_statuses[0].image_id == "sha256:abc"
+    assert pod.spec is None
+
+
+@pytest.mark.parametrize("kind", ["minimal", "kubernetes"])
+def test_cordon(kube, kind):
+    fake, host = kube
+    client = _client(kind, host)
+    cleaner.cordon(client, "node-1")
+    node = fake.nodes["node-1"]
+    assert node["spec"]["unschedulable"]
+    assert node["metadata"]["annotations"] == {cleaner.annotation_key: "true"}
+    # left cordoned, e.g. by a crash
+    cleaner.recover_cordon(client, "node-1")
+    assert not node["spec"]["unschedulable"]
+    assert node["metadata"]["annotations"] == {}
+
+
+def test_keep_alive(kube):
+    fake, host = kube
+    client = KubeClient(host)
+    for i in range(5):
+        client.read_node("node-1")
+    assert len(fake.clients) == 5
+    assert len(set(fake.clients)) == 1
+
+
+def test_api_error(kube):
+    _, host = kube
+    with pytest.raises(ApiError) as e:
+        KubeClient(host).read_node("node-2")
+    assert e.value.status == 404
+
+
+@pytest.mark.parametrize("kind", ["minimal", "kubernetes"])
+def test_pod_images(kube, kind):
+    fake, host = kube
+    fake.set_pod("a", "node-1", ["ubuntu:22.04"])
+    fake.set_pod("b", "node-2", ["alpine"])
+    pods = PodImages(_client(kind, host), "node-1")
+    pods.list_pods()
+    assert pods.refs() == {"ubuntu:22.04"}
+
+    fake.set_pod("c", "node-1", ["jupyter/base"])
+    fake.set_pod("a", "node-1", ["ubuntu:22.04"], event_type="DELETED")
+    assert pods.watch(timeout_seconds=1) is True
+    assert pods.refs() == {"jupyter/base:latest"}
+    assert pods.resource_version == str(fake.version)
+
+
+def test_from_incluster(monkeypatch, tmpdir):
+    monkeypatch.delenv("KUBERNETES_SERVICE_HOST", raising=False)
+    with pytest.raises(RuntimeError):
+        KubeClient.from_incluster()
+
+    tmpdir.join("token").write("secret\n")
+    monkeypatch.setattr("docker_image_cleaner.kube.SERVICE_ACCOUNT", str(tmpdir))
+    monkeypatch.setenv("KUBERNETES_SERVICE_HOST", "fd00::1")
+    client = KubeClient.from_incluster()
+    assert client.host == "https://[fd00::1]:443"
+    assert client.session.verify == str(tmpdir.join("ca.crt"))
+    assert client._headers()["Authorization"] == "Bearer secret"
+
+
+def test_make_kube_client():
+    with pytest.raises(ValueError):
+        cleaner.make_kube_client("kubectl")
@@ -0,0 +1,109 @@
+import json
+import os
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.layer_cache import (
+    LayerInodeCache,
+    LayerSizeCache,
+    committed_layers,
+)
+
+
+def _make_layer(root, layer_id, size, committed=True):
+    diff = root.join("overlay2", layer_id, "diff")
+    diff.ensure(dir=True)
+    diff.join("file").write_binary(b"x" * size)
+    if committed:
+        layer = root.join("image", "overlay2", "layerdb", "sha256", f"chain-{layer_id}")
+        layer.ensure(dir=True)
+        layer.join("cache-id").write(layer_id)
+
+
+def _get_size(root, cache):
+    return cleaner.get_absolute_size(str(root), cache=cache) * cleaner.GB
+
+
+def test_committed_layers(tmpdir):
+    _make_layer(tmpdir, "a", 1)
+    _make_layer(tmpdir, "b", 1)
+    _make_layer(tmpdir, "container", 1, committed=False)
+    assert committed_layers(str(tmpdir)) == {"a", "b"}
+
+
+def test_layer_cache(tmpdir):
+    _make_layer(tmpdir, "a", 100)
+    _make_layer(tmpdir, "b", 200)
+    _make_layer(tmpdir, "container", 300, committed=False)
+    cache = LayerSizeCache(str(tmpdir))
+    expected = _get_size(tmpdir, None)
+
+    assert _get_size(tmpdir, cache) == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert set(cache.sizes) == {"a", "b"}
+
+    # container layers are always rescanned
+    tmpdir.join("overlay2", "container", "diff", "file").write_binary(b"x" * 30)
+    assert _get_size(tmpdir, cache) == expected - 270
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    # deleted layers are evicted, new layers are scanned
+    tmpdir.join("overlay2", "a").remove()
+    tmpdir.join("image", "overlay2", "layerdb", "sha256", "chain-a").remove()
+    _make_layer(tmpdir, "c", 400)
+    assert _get_size(tmpdir, cache) == expected - 270 - 100 + 400
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert set(cache.sizes) == {"b", "c"}
+
+
+def test_layer_cache_mtime_changed(tmpdir):
+    _make_layer(tmpdir, "a", 100)
+    cache = LayerSizeCache(str(tmpdir))
+    expected = _get_size(tmpdir, None)
+    assert _get_size(tmpdir, cache) == expected
+    tmpdir.join("overlay2", "a", "diff", "new").write_binary(b"x" * 10)
+    diff = str(tmpdir.join("overlay2", "a", "diff"))
+    st = os.stat(diff)
+    os.utime(diff, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert _get_size(tmpdir, cache) == expected + 10
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_layer_cache_persisted(tmpdir):
+    docker_root = tmpdir.mkdir("docker")
+    cache_path = str(tmpdir.join("cache.json"))
+    _make_layer(docker_root, "a", 100)
+    expected = _get_size(docker_root, None)
+    cache = LayerSizeCache(str(docker_root), cache_path)
+    assert _get_size(docker_root, cache) == expected
+
+    with open(cache_path) as f:
+        assert json.load(f)["layers"]["a"]["size"] == 100
+
+    cache = LayerSizeCache(str(docker_root), cache_path)
+    assert _get_size(docker_root, cache) == expected
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_layer_cache_corrupt(tmpdir):
+    cache_path = tmpdir.join("cache.json")
+    cache_path.write("not json")
+    cache = LayerSizeCache(str(tmpdir), str(cache_path))
+    assert cache.sizes == {}
+
+
+def test_layer_inode_cache(tmpdir):
+    _make_layer(tmpdir, "a", 1)
+    _make_layer(tmpdir, "b", 1)
+    for i in range(3):
+        tmpdir.join("overlay2", "b", "diff", f"file{i}").write("x")
+    cache = LayerInodeCache(str(tmpdir), workers=2)
+    layers = ["sha256:chain-a", "sha256:chain-b", "sha256:missing"]
+    # diff and its files
+    expected = {"sha256:chain-a": 2, "sha256:chain-b": 5}
+    assert cache.counts(layers) == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert cache.counts(layers) == expected
+    assert (cache.hits, cache.misses) == (2, 0)
+    # deleted layers are evicted
+    assert cache.counts(["sha256:chain-b"]) == {"sha256:chain-b": 5}
+    assert set(cache.inodes) == {"sha256:chain-b"}
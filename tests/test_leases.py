@@ -0,0 +1,126 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import fake_kube
+import pytest
+from kubernetes.client import ApiException
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.leases import GCSlots
+
+
+@pytest.fixture
+def kube():
+    kube = fake_kube.FakeKube()
+    server = fake_kube.serve(kube)
+    yield kube, fake_kube.coordination_api(server)
+    server.shutdown()
+    server.server_close()
+
+
+def _slots(api, holder, slots=1, clock=None):
+    kwargs = {"clock": clock} if clock else {}
+    return GCSlots(api, "test", holder, slots=slots, lease_seconds=60, **kwargs)
+
+
+def test_slots_limit(kube):
+    _, api = kube
+    a, b, c = (_slots(api, node, slots=2) for node in ["a", "b", "c"])
+    assert a.try_acquire(1.1) == "docker-image-cleaner-gc-0"
+    assert b.try_acquire(1.2) == "docker-image-cleaner-gc-1"
+    assert c.try_acquire(1.3) is None
+    # holding a slot already
+    assert a.try_acquire(1.1) == "docker-image-cleaner-gc-0"
+    a.release("docker-image-cleaner-gc-0")
+    assert c.try_acquire(1.3) == "docker-image-cleaner-gc-0"
+    # not waiting anymore
+    assert set(c.list_leases()) == {
+        "docker-image-cleaner-gc-0",
+        "docker-image-cleaner-gc-1",
+    }
+
+
+def test_fullest_first(kube):
+    _, api = kube
+    a, b, c = (_slots(api, node) for node in ["a", "b", "c"])
+    assert a.try_acquire(1.0) is not None
+    # b and c wait, c is fuller
+    assert b.try_acquire(1.1) is None
+    assert c.try_acquire(1.5) is None
+    a.release("docker-image-cleaner-gc-0")
+    assert b.try_acquire(1.1) is None
+    assert c.try_acquire(1.5) == "docker-image-cleaner-gc-0"
+    c.release("docker-image-cleaner-gc-0")
+    assert b.try_acquire(1.1) == "docker-image-cleaner-gc-0"
+
+
+def test_expired(kube):
+    _, api = kube
+    long_ago = datetime.now(timezone.utc) - timedelta(minutes=5)
+    crashed = _slots(api, "crashed", clock=lambda: long_ago)
+    assert crashed.try_acquire(1.0) is not None
+    # a crashed holder that stopped renewing its slot loses it
+    b = _slots(api, "b")
+    assert b.try_acquire(1.0) == "docker-image-cleaner-gc-0"
+    assert not crashed.renew("docker-image-cleaner-gc-0")
+    # releasing a lost slot leaves it to its new holder
+    crashed.release("docker-image-cleaner-gc-0")
+    assert b.renew("docker-image-cleaner-gc-0")
+
+
+def test_conflict(kube):
+    _, api = kube
+    a, b = _slots(api, "a"), _slots(api, "b")
+    # both see the slot free, b takes it first
+    leases = a.list_leases()
+    assert b.try_acquire(1.0) is not None
+    a.list_leases = lambda: leases
+    assert a.try_acquire(2.0) is None
+
+
+def test_gc_slot(kube):
+    _, api = kube
+    a, b = _slots(api, "a"), _slots(api, "b")
+
+    async def gc():
+        async with cleaner.gc_slot(a, 1.0):
+            assert b.try_acquire(1.0) is None
+        assert b.try_acquire(1.0) is not None
+
+    asyncio.run(gc())
+
+
+def test_gc_slot_release_error(kube):
+    _, api = kube
+    a = _slots(api, "a")
+
+    async def gc():
+        async with cleaner.gc_slot(a, 1.0):
+            pass
+
+    with mock.patch.object(a, "release", side_effect=ApiException(500)):
+        # doesn't raise, the lease expires instead
+        asyncio.run(gc())
+    assert "docker-image-cleaner-gc-0" in a.list_leases()
+
+
+def test_gc_slot_cancelled(kube):
+    _, api = kube
+    a, b = _slots(api, "a"), _slots(api, "b")
+    assert a.try_acquire(1.0) is not None
+
+    async def gc():
+        async with cleaner.gc_slot(b, 1.0):
+            pass
+
+    async def wait_for_slot():
+        task = asyncio.ensure_future(gc())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(wait_for_slot())
+    # b stopped waiting
+    assert "docker-image-cleaner-gc-waiting-b" not in a.list_leases()
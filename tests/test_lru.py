@@ -0,0 +1,156 @@
+import docker
+import requests
+from conftest import FakeClient, FakeImage
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.aimd import AIMDLimit
+from docker_image_cleaner.lru import LastUsed, lru_order, parse_docker_time
+
+
+def test_parse_docker_time():
+    assert parse_docker_time("1970-01-01T00:01:00.123456789Z") == 60
+    assert parse_docker_time("0001-01-01T00:00:00Z") == 0
+    assert parse_docker_time(None) == 0
+
+
+def test_last_used():
+    last_used = LastUsed()
+    a = FakeImage("sha256:a", ["a:latest"], created="1970-01-01T00:00:10Z")
+    b = FakeImage("sha256:b", ["b:latest"], created="1970-01-01T00:00:20Z")
+    c = FakeImage("sha256:c", created="1970-01-01T00:00:30Z")
+    # never used: ordered by creation
+    assert lru_order([c, b, a], last_used) == [a, b, c]
+
+    last_used.record("a:latest", 100)
+    last_used.record_event(
+        {"time": 50, "Actor": {"Attributes": {"image": "sha256:c"}}, "from": "x"}
+    )
+    assert last_used.get(a) == 100
+    assert last_used.get(c) == 50
+    assert lru_order([c, b, a], last_used) == [b, c, a]
+
+    # older uses don't replace newer ones
+    last_used.record("sha256:a", 10)
+    assert last_used.get(a) == 100
+
+    last_used.forget(a)
+    assert last_used.get(a) == 10
+
+
+def test_last_used_untagged_refs():
+    last_used = LastUsed()
+    ubuntu = FakeImage("sha256:u", ["ubuntu:latest"])
+    alpine = FakeImage("sha256:a", ["alpine:3"], digests=["alpine@sha256:abc"])
+    # containers started as "ubuntu", or by digest
+    last_used.record_event({"time": 100, "Actor": {"Attributes": {"image": "ubuntu"}}})
+    last_used.record_event(
+        {"time": 50, "Actor": {"Attributes": {"image": "docker.io/alpine@sha256:abc"}}}
+    )
+    assert last_used.get(ubuntu) == 100
+    assert last_used.get(alpine) == 50
+    assert lru_order([ubuntu, alpine], last_used) == [alpine, ubuntu]
+    last_used.forget(alpine)
+    assert last_used.last_used == {"ubuntu:latest": 100}
+
+
+def test_last_used_persisted(tmpdir):
+    path = str(tmpdir.join("last-used.json"))
+    last_used = LastUsed(path)
+    last_used.record("a:latest", 100)
+    last_used.save()
+    assert LastUsed(path).last_used == {"a:latest": 100}
+
+
+def test_remove_images_until_threshold(no_sleep):
+    client = FakeClient()
+    images = [FakeImage(f"sha256:{i}") for i in range(5)]
+    # 10GB used, each image is 1GB
+    removed, freed, used = cleaner.remove_images(
+        client, images, None, 10, 7.5, delay_seconds=0, estimate=True
+    )
+    assert client.images.removed == ["sha256:0", "sha256:1", "sha256:2"]
+    assert removed == images[:3]
+    assert freed == 3 * cleaner.GB
+    assert used == 7
+
+
+def test_remove_images_get_used(no_sleep):
+    client = FakeClient()
+    images = [FakeImage(f"sha256:{i}") for i in range(5)]
+    usage = iter([70, 60, 50])
+    removed, freed, used = cleaner.remove_images(
+        client, images, lambda: next(usage), 80, 65, delay_seconds=0
+    )
+    assert removed == images[:2]
+    assert used == 60
+
+
+def test_remove_images_skips_errors(no_sleep):
+    client = FakeClient(
+        errors={
+            "sha256:0": docker.errors.APIError("conflict: image is being used"),
+            "sha256:1": docker.errors.ImageNotFound("gone"),
+        }
+    )
+    images = [FakeImage(f"sha256:{i}") for i in range(3)]
+    removed, freed, used = cleaner.remove_images(
+        client, images, None, 10, 0, delay_seconds=0, estimate=True
+    )
+    assert removed == images[2:]
+    assert used == 9
+
+
+def test_remove_images_concurrently(no_sleep):
+    client = FakeClient(latency=0.01)
+    images = [FakeImage(f"sha256:{i}") for i in range(20)]
+    limit = AIMDLimit(maximum=4, target_latency=1)
+    removed, freed, used = cleaner.remove_images(
+        client, images, None, 100, 0, delay_seconds=0, estimate=True, limit=limit
+    )
+    assert len(removed) == 20
+    assert sorted(client.images.removed) == sorted(image.id for image in images)
+    assert client.images.max_concurrent > 1
+    assert limit.limit == 4
+
+
+def test_remove_images_concurrently_stops_at_threshold(no_sleep):
+    client = FakeClient(latency=0.01)
+    images = [FakeImage(f"sha256:{i}") for i in range(20)]
+    limit = AIMDLimit(maximum=4, target_latency=1, initial=4)
+    removed, freed, used = cleaner.remove_images(
+        client, images, None, 10, 5.5, delay_seconds=0, estimate=True, limit=limit
+    )
+    # removals in progress count towards the estimate, so we don't overshoot
+    assert len(removed) == 5
+    assert used == 5
+
+
+def test_remove_images_concurrently_get_used(no_sleep):
+    client = FakeClient(latency=0.01)
+    images = [FakeImage(f"sha256:{i}") for i in range(20)]
+    limit = AIMDLimit(maximum=4, target_latency=1, initial=4)
+
+    def get_used():
+        # rechecked, each image frees 1GB
+        return 10 - len(client.images.removed)
+
+    removed, freed, used = cleaner.remove_images(
+        client, images, get_used, 10, 8.5, delay_seconds=0, limit=limit
+    )
+    # removals in progress count towards the threshold, by image size
+    assert len(removed) == 2
+    assert used == 8
+
+
+def test_remove_images_timeouts(no_sleep):
+    timeout = requests.exceptions.ReadTimeout("timeout")
+    client = FakeClient(errors={f"sha256:{i}": timeout for i in range(3)})
+    images = [FakeImage(f"sha256:{i}") for i in range(5)]
+    limit = AIMDLimit(maximum=2, target_latency=1, initial=2)
+    removed, freed, used = cleaner.remove_images(
+        client, images, None, 10, 0, delay_seconds=0, estimate=True, limit=limit
+    )
+    # concurrency is reduced to 1 after the first timeouts,
+    # and removal stops at the next timeout
+    assert limit.limit == 1
+    assert removed == []
@@ -0,0 +1,54 @@
+import asyncio
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from docker_image_cleaner import cleaner, metrics
+
+
+def _value(name, **labels):
+    return REGISTRY.get_sample_value(f"docker_image_cleaner_{name}", labels) or 0
+
+
+def test_observe_usage_relative():
+    metrics.observe_usage("/", percent=42)
+    assert _value("used_percent") == 42
+    assert _value("used_bytes") > 0
+    assert _value("used_inodes") > 0
+
+
+def test_observe_usage_absolute():
+    metrics.observe_usage("/", nbytes=1234)
+    assert _value("used_bytes") == 1234
+    assert 0 < _value("used_percent") < 100
+
+
+def test_observe_usage_no_path(tmpdir):
+    metrics.observe_usage(str(tmpdir.join("nosuchdir")), nbytes=5678)
+    assert _value("used_bytes") == 5678
+
+
+def test_cordoned_seconds():
+    kube = mock.Mock()
+    before = _value("cordoned_seconds_total")
+    cordons = _value("cordon_duration_seconds_count")
+
+    async def gc():
+        async with cleaner.cordoned(kube, "node"):
+            assert _value("cordoned") == 1
+
+    asyncio.run(gc())
+    assert _value("cordoned") == 0
+    assert _value("cordoned_seconds_total") > before
+    assert _value("cordon_duration_seconds_count") == cordons + 1
+    assert kube.patch_node.call_count == 2
+
+
+def test_prune_timeout():
+    client = mock.Mock()
+    client.images.prune.side_effect = cleaner.requests.exceptions.ReadTimeout()
+    before = _value("docker_api_timeouts_total", operation="prune_all_images")
+    with mock.patch("time.sleep"):
+        assert cleaner.prune(client, "images", 0, dangling=False) is None
+    after = _value("docker_api_timeouts_total", operation="prune_all_images")
+    assert after == before + 1
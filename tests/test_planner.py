@@ -0,0 +1,95 @@
+import hashlib
+
+from conftest import FakeImage
+
+from docker_image_cleaner import planner
+
+MB = 2**20
+
+
+def test_chain_ids():
+    chain = planner.chain_ids(["sha256:a", "sha256:b"])
+    assert chain[0] == "sha256:a"
+    assert chain[1] == "sha256:" + hashlib.sha256(b"sha256:a sha256:b").hexdigest()
+    # the same diff on a different base is a different layer
+    assert planner.chain_ids(["sha256:c", "sha256:b"])[1] != chain[1]
+
+
+def test_plan_removal_unique_bytes():
+    # base is shared by all images, so removing any one of them doesn't free it
+    graph = {
+        "small": ["base", "s"],
+        "big": ["base", "b"],
+        "medium": ["base", "m"],
+    }
+    sizes = {"base": 1000 * MB, "s": 10 * MB, "b": 500 * MB, "m": 100 * MB}
+    plan = planner.plan_removal(graph, sizes, list(graph), 400 * MB)
+    assert plan == [("big", 500 * MB)]
+
+    plan = planner.plan_removal(graph, sizes, list(graph), 550 * MB)
+    assert plan == [("big", 500 * MB), ("medium", 100 * MB)]
+
+    # removing all three frees the shared base as well
+    plan = planner.plan_removal(graph, sizes, list(graph), 2000 * MB)
+    assert [image for image, _ in plan] == ["big", "medium", "small"]
+    assert sum(freed for _, freed in plan) == sum(sizes.values())
+
+
+def test_plan_removal_recomputes_shared_layers():
+    # a and b share a large layer, which is only freed by removing both,
+    # c has a unique layer of medium size, which is picked first
+    # but isn't needed once a and b are removed
+    graph = {
+        "a": ["shared", "a"],
+        "b": ["shared", "b"],
+        "c": ["c"],
+    }
+    sizes = {"shared": 1000 * MB, "a": 1 * MB, "b": 1 * MB, "c": 300 * MB}
+    plan = planner.plan_removal(graph, sizes, list(graph), 800 * MB)
+    assert plan == [("a", 1 * MB), ("b", 1001 * MB)]
+
+    plan = planner.plan_removal(graph, sizes, list(graph), 1200 * MB)
+    assert plan == [("c", 300 * MB), ("a", 1 * MB), ("b", 1001 * MB)]
+
+
+def test_plan_removal_keeps_protected_layers():
+    graph = {
+        "in-use": ["base", "x"],
+        "a": ["base", "a"],
+    }
+    sizes = {"base": 1000 * MB, "x": 10 * MB, "a": 10 * MB}
+    plan = planner.plan_removal(graph, sizes, ["a"], 2000 * MB)
+    assert plan == [("a", 10 * MB)]
+
+
+def test_plan_removal_nothing_to_gain():
+    graph = {"in-use": ["base"], "a": ["base"]}
+    sizes = {"base": 1000 * MB}
+    assert planner.plan_removal(graph, sizes, ["a"], 100 * MB) == []
+
+
+def test_read_layer_sizes(tmpdir):
+    chain = planner.chain_ids(["sha256:aaaa", "sha256:bbbb"])
+    layerdb = tmpdir.join("image", "overlay2", "layerdb", "sha256")
+    layerdb.join(chain[0][len("sha256:") :], "size").write("100", ensure=True)
+    sizes = planner.read_layer_sizes(str(tmpdir), chain)
+    assert sizes == {chain[0]: 100}
+
+
+def test_estimate_layer_sizes():
+    image = FakeImage("a", layers=["sha256:1", "sha256:2", "sha256:3"], size=1000)
+    graph = planner.image_layers([image])
+    layers = graph["a"]
+    sizes = planner.estimate_layer_sizes([image], graph, {layers[0]: 400})
+    assert sizes == {layers[0]: 400, layers[1]: 300, layers[2]: 300}
+
+
+def test_freed_in_order():
+    graph = {
+        "a": ["base", "a"],
+        "b": ["base", "b"],
+        "kept": ["other"],
+    }
+    sizes = {"base": 100, "a": 10, "b": 20, "other": 1000}
+    assert planner.freed_in_order(graph, sizes, ["a", "b"]) == {"a": 10, "b": 120}
+    assert planner.freed_in_order(graph, sizes, ["b"]) == {"b": 20}
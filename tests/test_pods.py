@@ -0,0 +1,155 @@
+from unittest import mock
+
+import pytest
+from conftest import FakeImage
+from kubernetes.client import (
+    ApiException,
+    V1Container,
+    V1ContainerStatus,
+    V1ListMeta,
+    V1ObjectMeta,
+    V1Pod,
+    V1PodList,
+    V1PodSpec,
+    V1PodStatus,
+)
+
+from docker_image_cleaner.kube import ApiError, KubeClient
+from docker_image_cleaner.pods import (
+    PodImages,
+    api_error,
+    normalize_ref,
+    pod_image_refs,
+)
+
+
+def _pod(uid, images, phase="Pending", image_ids=(), resource_version="1"):
+    return V1Pod(
+        metadata=V1ObjectMeta(uid=uid, resource_version=resource_version),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(name=f"c{i}", image=image) for i, image in enumerate(images)
+            ]
+        ),
+        status=V1PodStatus(
+            phase=phase,
+            container_statuses=[
+                V1ContainerStatus(
+                    name=f"c{i}",
+                    image="",
+                    image_id=image_id,
+                    ready=True,
+                    restart_count=0,
+                )
+                for i, image_id in enumerate(image_ids)
+            ],
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "ref, normalized",
+    [
+        ("ubuntu", "ubuntu:latest"),
+        ("docker.io/library/ubuntu:22.04", "ubuntu:22.04"),
+        ("docker.io/jupyter/base", "jupyter/base:latest"),
+        ("localhost:5000/image", "localhost:5000/image:latest"),
+        ("docker-pullable://ubuntu@sha256:abc", "ubuntu@sha256:abc"),
+        ("docker://sha256:abc", "sha256:abc"),
+    ],
+)
+def test_normalize_ref(ref, normalized):
+    assert normalize_ref(ref) == normalized
+
+
+def test_pod_image_refs():
+    pod = _pod(
+        "a",
+        ["ubuntu", "jupyter/base:1"],
+        phase="Running",
+        image_ids=["docker-pullable://ubuntu@sha256:abc"],
+    )
+    assert pod_image_refs(pod) == {
+        "ubuntu:latest",
+        "jupyter/base:1",
+        "ubuntu@sha256:abc",
+    }
+    # finished pods don't need their images
+    assert pod_image_refs(_pod("b", ["ubuntu"], phase="Succeeded")) == set()
+
+
+def test_protects():
+    kube = mock.Mock()
+    kube.list_pod_for_all_namespaces.return_value = V1PodList(
+        metadata=V1ListMeta(resource_version="5"),
+        items=[
+            _pod("a", ["ubuntu:22.04"]),
+            _pod("b", ["ubuntu:22.04", "alpine"]),
+        ],
+    )
+    pods = PodImages(kube, "node-1")
+    pods.list_pods()
+    kube.list_pod_for_all_namespaces.assert_called_with(
+        field_selector="spec.nodeName=node-1"
+    )
+    assert pods.resource_version == "5"
+    assert pods.refs() == {"ubuntu:22.04", "alpine:latest"}
+    assert pods.protects(FakeImage("sha256:1", ["ubuntu:22.04"]))
+    assert not pods.protects(FakeImage("sha256:2", ["ubuntu:20.04"]))
+    assert not pods.protects(FakeImage("sha256:3", digests=["alpine@sha256:abc"]))
+
+    # removing one pod keeps images still used by another
+    pods.apply("DELETED", _pod("a", ["ubuntu:22.04"], resource_version="6"))
+    assert pods.refs() == {"ubuntu:22.04", "alpine:latest"}
+    # a pod finishing releases its images
+    pods.apply("MODIFIED", _pod("b", ["ubuntu:22.04", "alpine"], phase="Failed"))
+    assert pods.refs() == set()
+    # digests of running containers are protected
+    pods.apply(
+        "ADDED",
+        _pod(
+            "c",
+            ["alpine"],
+            phase="Running",
+            image_ids=["docker-pullable://alpine@sha256:abc"],
+        ),
+    )
+    assert pods.protects(FakeImage("sha256:3", digests=["alpine@sha256:abc"]))
+
+
+def test_watch():
+    kube = mock.Mock()
+    pods = PodImages(kube, "node-1")
+    pods.resource_version = "5"
+    events = [
+        {"type": "ADDED", "object": _pod("a", ["ubuntu"], resource_version="6")},
+        {"type": "DELETED", "object": _pod("a", ["ubuntu"], resource_version="7")},
+        {"type": "ADDED", "object": _pod("b", ["alpine"], resource_version="8")},
+    ]
+    with mock.patch("kubernetes.watch.Watch") as Watch:
+        Watch.return_value.stream.return_value = iter(events)
+        assert pods.watch() is True
+    stream_kwargs = Watch.return_value.stream.call_args.kwargs
+    assert stream_kwargs["resource_version"] == "5"
+    assert stream_kwargs["field_selector"] == "spec.nodeName=node-1"
+    assert pods.refs() == {"alpine:latest"}
+    assert pods.resource_version == "8"
+    # watching doesn't list pods
+    kube.list_pod_for_all_namespaces.assert_not_called()
+
+
+def test_watch_expired():
+    pods = PodImages(mock.Mock(), "node-1")
+    with mock.patch("kubernetes.watch.Watch") as Watch:
+        Watch.return_value.stream.side_effect = ApiException(status=410)
+        assert pods.watch() is False
+        Watch.return_value.stream.side_effect = None
+        Watch.return_value.stream.return_value = iter(
+            [{"type": "ERROR", "raw_object": {"code": 410}}]
+        )
+        assert pods.watch() is False
+
+
+def test_api_error():
+    assert api_error(KubeClient("http://127.0.0.1")) is ApiError
+    assert api_error(mock.Mock()) is ApiException
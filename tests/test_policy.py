@@ -0,0 +1,71 @@
+import pytest
+
+from docker_image_cleaner import policy
+
+MB = 2**20
+
+
+def test_should_prune_all():
+    # no dangling images found, nothing else to try
+    assert policy.should_prune_all(0, 10, 50)
+    # dangling images freed enough
+    assert not policy.should_prune_all(3, 40, 50)
+    assert policy.should_prune_all(3, 60, 50)
+
+
+def test_should_defer():
+    assert policy.should_defer(85, 95, True)
+    assert not policy.should_defer(85, 95, False)
+    # critical, can't wait for the daemon
+    assert not policy.should_defer(95, 95, True)
+
+
+def test_removal_order_lru():
+    graph = {"a": ["base", "a"], "b": ["base", "b"], "c": ["c"]}
+    sizes = {"base": 100 * MB, "a": 10 * MB, "b": 20 * MB, "c": 30 * MB}
+    last_used = {"a": 30, "b": 10, "c": 20}
+    order, freed = policy.removal_order(
+        "lru", graph, sizes, ["a", "b", "c"], 0, last_used=last_used
+    )
+    assert order == ["b", "c", "a"]
+    # base is freed along with the last image using it
+    assert freed == {"b": 20 * MB, "c": 30 * MB, "a": 110 * MB}
+
+
+def test_removal_order_layers():
+    graph = {"a": ["base", "a"], "b": ["base", "b"], "c": ["c"]}
+    sizes = {"base": 100 * MB, "a": 10 * MB, "b": 20 * MB, "c": 30 * MB}
+    order, freed = policy.removal_order(
+        "layers", graph, sizes, ["a", "b", "c"], 25 * MB
+    )
+    assert order == ["c"]
+    assert freed == {"c": 30 * MB}
+
+
+def test_removal_order_prune():
+    with pytest.raises(ValueError):
+        policy.removal_order("prune", {}, {}, [], 0)
+
+
+@pytest.mark.parametrize(
+    "age, seconds",
+    [("7d", 7 * 24 * 3600), ("72h", 72 * 3600), ("1h30m", 5400), ("90s", 90)],
+)
+def test_parse_age(age, seconds):
+    assert policy.parse_age(age) == seconds
+
+
+@pytest.mark.parametrize("age", ["", "7", "1w", "h", "1h 30m"])
+def test_parse_age_invalid(age):
+    with pytest.raises(ValueError):
+        policy.parse_age(age)
+
+
+def test_until_steps():
+    # in removal order, seconds since pulled
+    ages = {"a": 10, "b": 100, "c": 1000, "d": 50, "e": 5000}
+    steps = policy.until_steps(ages, [60, 500, 2000])
+    assert steps == [(2000, ["e"]), (500, ["c"]), (60, ["b"]), (None, ["a", "d"])]
+    # steps without images are left out
+    assert policy.until_steps({"a": 10}, [60]) == [(None, ["a"])]
+    assert policy.until_steps({"a": 100}, [60]) == [(60, ["a"])]
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from docker_image_cleaner import reserve
+
+
+@pytest.fixture
+def reservations():
+    loop = mock.Mock()
+    return reserve.Reservations(loop, mock.Mock())
+
+
+def _reserve_in_thread(reservations, nbytes, timeout=5):
+    result = {}
+
+    def run():
+        result["free"] = reservations.reserve(nbytes, timeout)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def _wait_pending(reservations, n):
+    for i in range(100):
+        with reservations._cond:
+            if len(reservations._pending) == n:
+                return
+        time.sleep(0.01)
+    raise TimeoutError()
+
+
+def test_coalesced(reservations):
+    a, result_a = _reserve_in_thread(reservations, 10)
+    b, result_b = _reserve_in_thread(reservations, 30)
+    _wait_pending(reservations, 2)
+    assert reservations.loop.call_soon_threadsafe.called
+    # both served by the same check, which frees enough for the largest
+    assert reservations.begin() == (30, 2)
+    # arriving during the check, for the next one
+    c, result_c = _reserve_in_thread(reservations, 5)
+    _wait_pending(reservations, 1)
+    reservations.finish(20)
+    a.join()
+    b.join()
+    assert result_a == result_b == {"free": 20}
+    assert reservations.begin() == (5, 1)
+    reservations.finish(20)
+    c.join()
+    assert result_c == {"free": 20}
+
+
+def test_timeout(reservations):
+    assert reservations.reserve(10, 0.01) is None
+    assert reservations.begin() == (0, 0)
+
+
+@pytest.fixture
+def server():
+    loop = asyncio.new_event_loop()
+    reservations = reserve.Reservations(loop, asyncio.Event(), max_timeout=5)
+    server = reserve.serve(reservations, 0)
+    yield reservations, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    loop.close()
+
+
+def _post(url):
+    try:
+        with urlopen(url, data=b"") as r:
+            return r.status, json.load(r)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+@pytest.mark.parametrize("free, status", [(100, 200), (50, 507)])
+def test_serve(server, free, status):
+    reservations, url = server
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(response=_post(f"{url}/reserve?bytes=100"))
+    )
+    thread.start()
+    _wait_pending(reservations, 1)
+    reservations.begin()
+    reservations.finish(free)
+    thread.join()
+    assert result["response"] == (
+        status,
+        {"requested_bytes": 100, "free_bytes": free},
+    )
+
+
+def test_serve_errors(server):
+    _, url = server
+    assert _post(f"{url}/reserve?bytes=100&timeout=0.01")[0] == 503
+    assert _post(f"{url}/reserve?bytes=lots")[0] == 400
+    assert _post(f"{url}/nope")[0] == 404
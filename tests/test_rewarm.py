@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+from conftest import FakeImage
+
+from docker_image_cleaner import cleaner
+from docker_image_cleaner.rewarm import Rewarmer, missing_refs, parse_refs
+
+
+class FakePulls:
+    def __init__(self, latency=0, errors=()):
+        self.pulled = []
+        self.latency = latency
+        self.errors = set(errors)
+        self.lock = threading.Lock()
+
+    def pull(self, ref):
+        time.sleep(self.latency)
+        if ref in self.errors:
+            raise RuntimeError(f"pull access denied for {ref}")
+        with self.lock:
+            self.pulled.append(ref)
+        return FakeImage(f"sha256:{ref}", [ref])
+
+
+class FakeClient:
+    def __init__(self, **kwargs):
+        self.images = FakePulls(**kwargs)
+
+
+def test_parse_refs():
+    assert parse_refs("jupyter/base, ubuntu:22.04,,docker.io/jupyter/base") == [
+        "jupyter/base:latest",
+        "ubuntu:22.04",
+    ]
+
+
+def test_missing_refs():
+    images = [FakeImage("sha256:a", ["ubuntu:22.04"])]
+    refs = ["jupyter/base:latest", "ubuntu:22.04", "sha256:a", "alpine:latest"]
+    assert missing_refs(refs, images) == ["jupyter/base:latest", "alpine:latest"]
+
+
+def test_rewarm_priority():
+    client = FakeClient()
+    rewarmer = Rewarmer(client, ["a:1", "b:1", "c:1", "d:1"], max_concurrency=1)
+    images = [FakeImage("sha256:b", ["b:1"])]
+    pulled, pulled_bytes = rewarmer.run(images, 0, 10)
+    assert pulled == client.images.pulled == ["a:1", "c:1", "d:1"]
+    assert pulled_bytes == 3 * cleaner.GB
+
+
+def test_rewarm_errors():
+    client = FakeClient(errors=["a:1"])
+    pulled, _ = Rewarmer(client, ["a:1", "b:1"]).run([], 0, 10)
+    assert pulled == ["b:1"]
+
+
+@pytest.mark.parametrize(
+    "limit, get_used, expected",
+    [
+        # estimated, 1GB per image
+        (2.5, None, ["a:1", "b:1", "c:1"]),
+        # rechecked
+        (2.5, iter([1, 5]).__next__, ["a:1", "b:1"]),
+        # already near the threshold
+        (0, None, []),
+    ],
+)
+def test_rewarm_limit(limit, get_used, expected):
+    client = FakeClient()
+    rewarmer = Rewarmer(client, ["a:1", "b:1", "c:1", "d:1"], max_concurrency=1)
+    pulled, _ = rewarmer.run([], 0, limit, get_used=get_used)
+    assert pulled == expected
+
+
+def test_rewarm_budgets():
+    refs = [f"{i}:1" for i in range(10)]
+    pulled, _ = Rewarmer(FakeClient(), refs, max_bytes=2 * cleaner.GB).run([], 0, 100)
+    # pulls in progress finish
+    assert 2 <= len(pulled) <= 3
+
+    client = FakeClient(latency=0.05)
+    rewarmer = Rewarmer(client, refs, max_concurrency=2, time_budget=0.01)
+    pulled, _ = rewarmer.run([], 0, 100)
+    assert len(pulled) == 2
+
+
+def test_rewarm_stop():
+    client = FakeClient(latency=0.05)
+    refs = [f"{i}:1" for i in range(10)]
+    rewarmer = Rewarmer(client, refs, max_concurrency=2)
+    rewarmer.start([], 0, 100)
+    time.sleep(0.02)
+    rewarmer.stop()
+    assert len(client.images.pulled) == 2
@@ -0,0 +1,123 @@
+import os
+import random
+
+import pytest
+
+from docker_image_cleaner import scanner
+
+
+def _make_tree(root, layers=5, files=4, size=1000):
+    """
+    Make an overlay2-like tree
+
+    Returns the total size of the files in it.
+    """
+    total = 0
+    for i in range(layers):
+        diff = root.join("overlay2", f"layer{i}", "diff", "usr", "lib")
+        diff.ensure(dir=True)
+        for n in range(files):
+            diff.join(f"file{n}").write_binary(b"x" * size)
+            total += size
+    root.join("top-level-file").write_binary(b"x" * 10)
+    total += 10
+    return total
+
+
+def _walk_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fname))
+    return total
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_scan_size(tmpdir, workers):
+    expected = _make_tree(tmpdir)
+    assert scanner.scan_size(str(tmpdir), workers=workers) == expected
+    assert expected == _walk_size(str(tmpdir))
+
+
+@pytest.mark.parametrize("split_depth", [1, 2, 5])
+def test_scan_size_split_depth(tmpdir, split_depth):
+    expected = _make_tree(tmpdir)
+    assert (
+        scanner.scan_size(str(tmpdir), workers=2, split_depth=split_depth) == expected
+    )
+
+
+def test_scan_size_hardlinks_counted_once(tmpdir):
+    expected = _make_tree(tmpdir, layers=2)
+    src = tmpdir.join("overlay2", "layer0", "diff", "usr", "lib", "file0")
+    os.link(str(src), str(tmpdir.join("overlay2", "layer1", "diff", "hardlink")))
+    os.link(str(src), str(tmpdir.join("hardlink")))
+    assert scanner.scan_size(str(tmpdir), workers=4) == expected
+
+
+def test_scan_size_skips_symlinks(tmpdir):
+    expected = _make_tree(tmpdir, layers=2)
+    os.symlink("layer0/diff", str(tmpdir.join("overlay2", "l")))
+    os.symlink("file0", str(tmpdir.join("overlay2", "layer1", "diff", "link")))
+    assert scanner.scan_size(str(tmpdir), workers=4) == expected
+
+
+def test_count_inodes(tmpdir):
+    _make_tree(tmpdir, layers=2, files=4)
+    # tmpdir, top-level-file, overlay2, and per layer: layer, diff, usr, lib, files
+    assert scanner.count_inodes(str(tmpdir)) == 3 + 2 * (4 + 4)
+    src = tmpdir.join("overlay2", "layer0", "diff", "usr", "lib", "file0")
+    os.link(str(src), str(tmpdir.join("hardlink")))
+    os.symlink("file0", str(tmpdir.join("symlink")))
+    assert scanner.count_inodes(str(tmpdir)) == 3 + 2 * (4 + 4) + 1
+    assert scanner.count_inodes(str(tmpdir.join("nosuchdir"))) == 0
+
+
+def test_scan_size_no_such_dir(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        scanner.scan_size(str(tmpdir.join("nosuchdir")))
+
+
+def _make_uneven_tree(root, layers=100, seed=0):
+    """An overlay2-like tree with layers of different sizes"""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(layers):
+        diff = root.join("overlay2", f"layer{i}", "diff")
+        diff.ensure(dir=True)
+        size = rng.randint(1000, 3000)
+        diff.join("file").write_binary(b"x" * size)
+        total += size
+    return total
+
+
+def test_estimate_size(tmpdir):
+    expected = _make_uneven_tree(tmpdir)
+    estimate = scanner.estimate_size(
+        str(tmpdir), expected * 2, max_error=0.1, workers=4, rng=random.Random(1)
+    )
+    # far from the threshold, a sample is enough
+    assert estimate.tasks == 100
+    assert estimate.sampled < 100
+    assert estimate.low <= expected <= estimate.high
+    assert estimate.high - estimate.size <= 0.1 * estimate.size
+
+
+def test_estimate_size_near_threshold(tmpdir):
+    expected = _make_uneven_tree(tmpdir)
+    estimate = scanner.estimate_size(
+        str(tmpdir), expected, max_error=0.1, rng=random.Random(1)
+    )
+    # too close to call, everything is scanned
+    assert estimate.sampled == 100
+    assert estimate.size == estimate.low == estimate.high == expected
+
+
+def test_estimate_size_time_budget(tmpdir):
+    expected = _make_uneven_tree(tmpdir)
+    estimate = scanner.estimate_size(
+        str(tmpdir), expected * 10, max_error=0, time_budget=0, rng=random.Random(1)
+    )
+    # stops sampling after the first round
+    assert estimate.sampled == 10
+    assert estimate.low < estimate.size < estimate.high < expected * 10
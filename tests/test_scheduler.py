@@ -0,0 +1,81 @@
+import pytest
+
+from docker_image_cleaner.scheduler import PollScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _scheduler(clock, **kwargs):
+    kwargs.setdefault("min_interval", 10)
+    kwargs.setdefault("max_interval", 3600)
+    return PollScheduler(80, 300, clock=clock, **kwargs)
+
+
+def test_first_interval(clock):
+    scheduler = _scheduler(clock)
+    assert scheduler.next_interval() == 300
+    scheduler.record(50)
+    assert scheduler.fill_rate() is None
+    assert scheduler.next_interval() == 300
+
+
+def test_fill_rate(clock):
+    scheduler = _scheduler(clock)
+    for used in (50, 51, 52):
+        scheduler.record(used)
+        clock.now += 100
+    assert scheduler.fill_rate() == pytest.approx(0.01)
+    # 28% to go at 1% per 100s
+    assert scheduler.time_to_threshold() == pytest.approx(2800)
+    assert scheduler.next_interval() == pytest.approx(1400)
+
+
+def test_filling_fast(clock):
+    scheduler = _scheduler(clock)
+    for used in (70, 75):
+        scheduler.record(used)
+        clock.now += 300
+    # 5% to go at 5% per 300s: check again before reaching the threshold
+    assert scheduler.next_interval() == pytest.approx(150)
+    scheduler.record(79.9)
+    assert scheduler.next_interval() == 10
+
+
+def test_idle_backoff(clock):
+    scheduler = _scheduler(clock)
+    intervals = []
+    for i in range(8):
+        scheduler.record(50)
+        intervals.append(scheduler.next_interval())
+        clock.now += intervals[-1]
+    assert intervals == [300, 600, 1200, 2400, 3600, 3600, 3600, 3600]
+
+    scheduler.reset()
+    assert scheduler.next_interval() == 300
+
+
+def test_idle_near_threshold(clock):
+    scheduler = _scheduler(clock)
+    for i in range(4):
+        scheduler.record(75)
+        clock.now += 300
+    assert scheduler.next_interval() == 300
+
+
+def test_fixed_interval_by_default(clock):
+    scheduler = PollScheduler(80, 300, clock=clock)
+    for used in (10, 79):
+        scheduler.record(used)
+        clock.now += 300
+    assert scheduler.next_interval() == 300
@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+from docker_image_cleaner import simulate
+
+GB = 2**30
+
+
+def pull(time, image, *layers):
+    return {
+        "time": time,
+        "event": "pull",
+        "image": image,
+        "layers": [{"id": layer, "size": size} for layer, size in layers],
+    }
+
+
+def event(time, kind, image):
+    return {"time": time, "event": kind, "image": image}
+
+
+@pytest.fixture
+def trace():
+    # three images sharing a base, pulled while the disk fills,
+    # "hot" is started over and over, "cold" only once,
+    # "new" is pulled over an older version, leaving it dangling
+    return [
+        pull(0, "hot", ("base", 2 * GB), ("hot", 2 * GB)),
+        pull(0, "cold", ("base", 2 * GB), ("cold", 2 * GB)),
+        pull(0, "new", ("new-1", 2 * GB)),
+        event(10, "start", "cold"),
+        event(20, "stop", "cold"),
+        event(30, "start", "hot"),
+        event(40, "stop", "hot"),
+        pull(50, "new", ("new-2", 2 * GB)),
+        {"time": 60, "event": "usage", "bytes": 2 * GB},
+        event(400, "start", "hot"),
+        event(410, "stop", "hot"),
+        event(500, "start", "cold"),
+        event(510, "stop", "cold"),
+        event(600, "start", "hot"),
+    ]
+
+
+def test_below_threshold(trace):
+    stats = simulate.simulate(trace, threshold_high=100 * GB)
+    assert stats["gc_runs"] == 0
+    assert stats["images_deleted"] == 0
+    assert stats["peak_bytes"] == 12 * GB
+
+
+def test_prune(trace):
+    stats = simulate.simulate(trace, threshold_high=9 * GB, threshold_low=8 * GB)
+    # dangling new-1 isn't enough, everything unused is pruned at t=300
+    assert stats["gc_runs"] == 1
+    assert stats["images_deleted"] == 4
+    assert stats["bytes_deleted"] == 10 * GB
+    # hot and cold are pulled again
+    assert stats["repulls"] == 2
+    assert stats["repulled_bytes"] == 6 * GB
+    # the dangling image is deleted before cordoning
+    assert stats["cordoned_seconds"] == 3 * 2
+
+
+def test_prune_until(trace):
+    # until cold is started again
+    trace = [e for e in trace if e["time"] < 500]
+    stats = simulate.simulate(
+        trace, threshold_high=9 * GB, threshold_low=8 * GB, prune_until=[280]
+    )
+    # at t=300, removing dangling new-1, then hot and cold, pulled 300s ago,
+    # is enough, new, pulled 250s ago, stays
+    assert stats["images_deleted"] == 3
+    assert stats["bytes_deleted"] == 8 * GB
+    # hot is pulled again at t=400
+    assert stats["repulls"] == 1
+
+
+def test_lru(trace):
+    stats = simulate.simulate(
+        trace, policy="lru", threshold_high=9 * GB, threshold_low=8.5 * GB
+    )
+    # at t=300, after the dangling image,
+    # removing the least recently used (cold) is enough.
+    # at t=600, after cold is pulled again, new-2 is the least recently used
+    assert stats["gc_runs"] == 2
+    assert stats["images_deleted"] == 3
+    assert stats["bytes_deleted"] == 6 * GB
+    # the hot image is never deleted
+    assert stats["repulls"] == 1
+    # the base layer is still on the node
+    assert stats["repulled_bytes"] == 2 * GB
+    assert stats["cordoned_seconds"] == 2 + 2
+
+
+def test_cordon_min_images(trace):
+    stats = simulate.simulate(
+        trace,
+        policy="lru",
+        threshold_high=9 * GB,
+        threshold_low=8.5 * GB,
+        cordon_min_images=4,
+    )
+    # at most 3 images to choose from
+    assert stats["images_deleted"] == 3
+    assert stats["cordoned_seconds"] == 0
+
+
+def test_in_use_not_deleted(trace):
+    # hot is running when usage is checked
+    trace = [e for e in trace if not (e["event"] == "stop" and e["image"] == "hot")]
+    stats = simulate.simulate(trace, threshold_high=9 * GB, threshold_low=8 * GB)
+    assert stats["repulls"] == 1
+
+
+def test_start_before_pull():
+    with pytest.raises(ValueError):
+        simulate.simulate([event(0, "start", "x")])
+
+
+def test_main(trace, tmpdir, capsys):
+    path = tmpdir.join("trace.jsonl")
+    path.write("\n".join(json.dumps(e) for e in trace))
+    simulate.main(
+        [str(path), "--threshold-high", str(9 * GB), "--policy", "prune", "lru"]
+    )
+    report = capsys.readouterr().out
+    assert "re-pulls" in report
+    assert "lru" in report
+
+    simulate.main([str(path), "--threshold-high", str(9 * GB), "--json"])
+    results = json.loads(capsys.readouterr().out)
+    assert results["prune"]["repulls"] == 2
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import pstats
+
+import pytest
+
+from docker_image_cleaner import cleaner, tracing
+
+
+@pytest.fixture
+def trace_path(tmpdir):
+    path = str(tmpdir.join("trace.jsonl"))
+    tracing.configure(path)
+    yield path
+    tracing.configure("")
+
+
+def read_spans(path):
+    with open(path) as f:
+        return {span["name"]: span for span in map(json.loads, f)}
+
+
+def test_span(trace_path):
+    with tracing.span("cycle", cycle=3):
+        with tracing.span("prune_images") as attrs:
+            attrs["deleted"] = 2
+        with pytest.raises(ValueError):
+            with tracing.span("plan"):
+                raise ValueError("oops")
+    spans = read_spans(trace_path)
+    cycle = spans["cycle"]
+    assert cycle["parent"] is None
+    assert spans["prune_images"]["parent"] == cycle["id"]
+    assert spans["prune_images"]["cycle"] == 3
+    assert spans["prune_images"]["deleted"] == 2
+    assert spans["plan"]["error"] == "ValueError"
+    assert cycle["duration"] >= spans["prune_images"]["duration"]
+
+
+def test_span_off():
+    with tracing.span("cycle", cycle=1) as attrs:
+        attrs["gc"] = True
+
+
+def test_span_in_executor(trace_path):
+    def measure():
+        with tracing.span("measure_usage"):
+            pass
+
+    async def check():
+        with tracing.span("cycle", cycle=1):
+            await asyncio.gather(
+                cleaner.in_executor(measure), cleaner.in_executor(measure)
+            )
+
+    asyncio.run(check())
+    with open(trace_path) as f:
+        spans = [json.loads(line) for line in f]
+    cycle = spans[-1]
+    assert cycle["name"] == "cycle"
+    assert [span["parent"] for span in spans[:-1]] == [cycle["id"]] * 2
+
+
+def spin():
+    return sum(i * i for i in range(10000))
+
+
+@pytest.mark.parametrize("gc", [True, False])
+def test_profiler(tmpdir, gc):
+    path = str(tmpdir.join("gc.prof"))
+
+    async def cycles():
+        profiler = tracing.Profiler(path, asyncio.get_running_loop())
+        with profiler.cycle({"gc": gc}):
+            await cleaner.in_executor(spin)
+        return profiler
+
+    profiler = asyncio.run(cycles())
+    assert profiler.done == gc
+    assert tmpdir.join("gc.prof").exists() == gc
+    if gc:
+        # work done in executor threads is in the profile
+        functions = {name for _, _, name in pstats.Stats(path).stats}
+        assert "spin" in functions